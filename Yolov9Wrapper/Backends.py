@@ -0,0 +1,438 @@
+"""
+# Backends.py
+Yolov9の推論バックエンド(PyTorch / ONNX Runtime / OpenVINO / OpenCV DNN)を切り替えるモジュール。
+
+## 使い方
+```py
+from Yolov9Wrapper import Yolov9
+
+# ---いちばん速いバックエンドを自動で選ぶ
+model = Yolov9(weights="./20240625.pt", device="cpu", backend="auto")
+print(model.backend)  # "onnx" など
+
+# ---バックエンドを指定する
+model = Yolov9(weights="./20240625.pt", device="cpu", backend="openvino")
+```
+
+## 仕組み
+- .ptの重みを、yolov9/export.pyで各形式にエクスポートする
+    - エクスポート結果は `model_cache/<重みのファイル名>-<重みのハッシュ>-<imgsz>/` にキャッシュされる
+    - 重みが変わればハッシュが変わるので、再エクスポートされる
+- backend="auto"では、起動時に代表画像で各バックエンドを計測し、
+  PyTorchと結果が一致するもののうち、いちばん速いものを使う
+    - 選んだバックエンドはキャッシュディレクトリのselected_backend.jsonに記録し、
+      重み・imgsz・device・候補が同じなら、次の起動からは計測せずにそれを使う
+    - 代表画像でPyTorchが何も検出しない場合(ログに画像がなく、灰色の画像で計測した場合など)は、
+      一致を確かめられないので"pt"を使い、記録しない
+
+## 開発メモ
+- PyTorch以外は入力サイズ固定(imgsz)でエクスポートするので、letterboxは最小パディングではなくimgszぴったりになる
+- OpenCV DNNはONNXのメタデータを読まないので、エクスポート時にmodel.yamlにstride・namesを書き出しておく
+- "onnx_int8"はQuantization.pyで量子化したモデルを読み込む。PyTorchと結果が完全には一致しないので、autoの候補には入らない
+- fast_start(Yolov9の引数)では、Conv+BN・RepConvNをfuse済みのモデルを
+  `model_cache/<重みのファイル名>-<重みのハッシュ>/model_fused.pt`に保存しておき、起動時はfuseせずに読み込む
+"""
+
+import ast
+import hashlib
+import importlib.util
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Literal
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from Yolov9Wrapper.Yolov9Wrapper import Yolov9, Yolov9Result
+
+Backend = Literal["pt", "onnx", "openvino", "dnn", "onnx_int8"]
+
+CACHE_DIR = Path("./model_cache")  # エクスポートしたモデルの保存先
+INT8_MODEL_NAME = "model_int8.onnx"  # Quantization.pyで量子化したモデルのファイル名
+FUSED_MODEL_NAME = "model_fused.pt"  # fuse済みのPyTorchモデルのファイル名
+SELECTED_BACKEND_NAME = "selected_backend.json"  # backend="auto"で選んだバックエンドの記録
+
+# 結果が一致しているとみなす条件
+MATCH_IOU_THRESHOLD = 0.9  # 同じラベルのbbox同士のIoUが、これ以上
+MATCH_CONF_TOLERANCE = 0.05  # 確信度の差が、これ以下
+
+
+def weights_hash(weights: str | Path, length: int = 12) -> str:
+    """重みファイルのハッシュ(sha256の先頭length文字)を返す
+
+    Args:
+        weights (str | Path): 重みファイルのパス
+        length (int, optional): ハッシュの長さ. Defaults to 12.
+
+    Returns:
+        str: ハッシュ
+    """
+    sha = hashlib.sha256()
+    with open(weights, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()[:length]
+
+
+def available_backends() -> list[Backend]:
+    """このマシンで使えるバックエンドの一覧を返す(PyTorchは常に含む)"""
+    backends: list[Backend] = ["pt"]
+    if importlib.util.find_spec("onnx") is not None:
+        if importlib.util.find_spec("onnxruntime") is not None:
+            backends.append("onnx")
+        if importlib.util.find_spec("openvino") is not None:
+            backends.append("openvino")
+        backends.append("dnn")  # OpenCV DNNはcv2だけで動く
+    return backends
+
+
+def cache_dir_for(
+    weights: str | Path, imgsz: tuple[int, int], cache_dir: str | Path = CACHE_DIR
+) -> Path:
+    """重みに対応するキャッシュディレクトリを返す
+
+    Args:
+        weights (str | Path): .ptの重みファイルのパス
+        imgsz (tuple[int, int]): エクスポートする入力サイズ(height, width)
+        cache_dir (str | Path, optional): キャッシュの親ディレクトリ. Defaults to CACHE_DIR.
+
+    Returns:
+        Path: キャッシュディレクトリ
+    """
+    weights = Path(weights)
+    return (
+        Path(cache_dir)
+        / f"{weights.stem}-{weights_hash(weights)}-{imgsz[0]}x{imgsz[1]}"
+    )
+
+
+def fused_weights_path(weights: str | Path, cache_dir: str | Path = CACHE_DIR) -> Path:
+    """fuse済みのモデルの保存先を返す。fuseは入力サイズによらないので、imgszはパスに含めない
+
+    Args:
+        weights (str | Path): .ptの重みファイルのパス
+        cache_dir (str | Path, optional): キャッシュの親ディレクトリ. Defaults to CACHE_DIR.
+
+    Returns:
+        Path: fuse済みのモデルのパス
+    """
+    weights = Path(weights)
+    return Path(cache_dir) / f"{weights.stem}-{weights_hash(weights)}" / FUSED_MODEL_NAME
+
+
+def _is_fused(module) -> bool:
+    # RepConvNはfuse_convsでconvが作られ、Conv/DWConvはfuseでbnが消える
+    if hasattr(module, "fuse_convs"):
+        return hasattr(module, "conv")
+    return not hasattr(module, "bn")
+
+
+def restore_fused_forward(model) -> int:
+    """fuse済みのモデルを読み込んだあと、fuseした層のforwardをforward_fuseに戻す。
+    fuse時にインスタンスに差し込まれるforwardは、保存時に外しているため
+
+    Args:
+        model (torch.nn.Module): export_fusedで保存したモデル
+
+    Returns:
+        int: forward_fuseに戻した層の数
+    """
+    restored = 0
+    for module in model.modules():
+        if hasattr(type(module), "forward_fuse") and _is_fused(module):
+            module.forward = module.forward_fuse
+            restored += 1
+    return restored
+
+
+def export_fused(weights: str | Path, cache_dir: str | Path = CACHE_DIR) -> str:
+    """Conv+BN・RepConvNをfuseしたモデルを保存し、そのパスを返す。キャッシュがあればそれを返す。
+    保存したモデルはDetectMultiBackend(fuse=False)で読み込み、restore_fused_forwardを呼ぶ
+
+    Args:
+        weights (str | Path): .ptの重みファイルのパス
+        cache_dir (str | Path, optional): キャッシュの親ディレクトリ. Defaults to CACHE_DIR.
+
+    Returns:
+        str: fuse済みのモデルのパス
+    """
+    target = fused_weights_path(weights, cache_dir)
+    if target.exists():
+        return str(target)
+
+    import torch
+    from yolov9.models.experimental import attempt_load
+
+    print(f"\033[36m[Backends] fusing {weights}...\033[0m")
+    model = attempt_load(weights, device=torch.device("cpu"), inplace=True, fuse=True)
+    # fuseで差し込まれたforward(bound method)は保存せず、読み込み時にrestore_fused_forwardで戻す
+    for module in model.modules():
+        module.__dict__.pop("forward", None)
+
+    # 書き込み途中で落ちても壊れたキャッシュが残らないように、別名で保存してから置き換える
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp = target.with_suffix(".tmp")
+    torch.save({"model": model, "fused": True}, tmp)
+    os.replace(tmp, target)
+    print(f"\033[36m[Backends] saved {target}\033[0m")
+    return str(target)
+
+
+def export_backend(
+    weights: str | Path,
+    backend: Backend,
+    imgsz: tuple[int, int] = (640, 640),
+    cache_dir: str | Path = CACHE_DIR,
+) -> str:
+    """重みを指定したバックエンド用にエクスポートし、そのパスを返す。キャッシュがあればそれを返す
+
+    Args:
+        weights (str | Path): .ptの重みファイルのパス
+        backend (Backend): バックエンド
+        imgsz (tuple[int, int], optional): 入力サイズ(height, width). Defaults to (640, 640).
+        cache_dir (str | Path, optional): キャッシュの親ディレクトリ. Defaults to CACHE_DIR.
+
+    Returns:
+        str: DetectMultiBackendに渡すパス
+    """
+    if backend == "pt":
+        return str(weights)
+
+    work_dir = cache_dir_for(weights, imgsz, cache_dir)
+    if backend == "onnx_int8":
+        # 量子化にはキャリブレーション用のログ画像が必要なので、Quantization.pyで事前に作っておく
+        int8_path = work_dir / INT8_MODEL_NAME
+        if not int8_path.exists():
+            raise FileNotFoundError(
+                f"{int8_path} does not exist. run `python -m Yolov9Wrapper.Quantization --weights {weights}` first"
+            )
+        return str(int8_path)
+
+    model_pt = work_dir / "model.pt"
+    model_onnx = work_dir / "model.onnx"
+    model_openvino = work_dir / "model_openvino_model"
+    target = model_openvino if backend == "openvino" else model_onnx
+    if target.exists():
+        return str(target)
+
+    # ---重みをキャッシュディレクトリにコピーし、そこでエクスポートする
+    print(f"\033[36m[Backends] exporting {weights} for {backend}...\033[0m")
+    work_dir.mkdir(parents=True, exist_ok=True)
+    if not model_pt.exists():
+        shutil.copyfile(weights, model_pt)
+
+    from yolov9.export import run as export_run
+    from yolov9.utils.general import yaml_save
+
+    include = ("onnx",) if backend in ("onnx", "dnn") else ("openvino",)
+    # InferenceSchedulerでバッチ推論できるように、バッチ次元は可変(dynamic)にしておく
+    export_run(
+        weights=model_pt,
+        imgsz=list(imgsz),
+        device="cpu",
+        include=include,
+        dynamic=True,
+    )
+    if not target.exists():
+        raise RuntimeError(f"export failed: {backend} ({weights})")
+
+    # ---OpenCV DNN用に、ONNXのメタデータをmodel.yamlにも書き出しておく
+    if model_onnx.exists():
+        import onnx
+
+        meta = {p.key: p.value for p in onnx.load(model_onnx).metadata_props}
+        if "stride" in meta:
+            yaml_save(
+                model_onnx.with_suffix(".yaml"),
+                {"stride": int(meta["stride"]), "names": ast.literal_eval(meta["names"])},
+            )
+
+    print(f"\033[36m[Backends] exported {target}\033[0m")
+    return str(target)
+
+
+def results_match(reference: "Yolov9Result", target: "Yolov9Result") -> bool:
+    """2つの推論結果が一致しているかを返す。
+    各bboxについて、同じラベル・IoUがMATCH_IOU_THRESHOLD以上・確信度の差がMATCH_CONF_TOLERANCE以下のものがあれば一致とみなす
+
+    Args:
+        reference (Yolov9Result): 基準となる結果(PyTorch)
+        target (Yolov9Result): 比較する結果
+
+    Returns:
+        bool: 一致していればTrue
+    """
+    ref_boxes, target_boxes = list(reference["boxes"]), list(target["boxes"])
+    if len(ref_boxes) != len(target_boxes):
+        return False
+
+    for ref in ref_boxes:
+        matched = False
+        for box in target_boxes:
+            if box["label"] != ref["label"]:
+                continue
+            if abs(box["confidence"] - ref["confidence"]) > MATCH_CONF_TOLERANCE:
+                continue
+            if _iou(ref["xyxy"], box["xyxy"]) >= MATCH_IOU_THRESHOLD:
+                matched = True
+                break
+        if not matched:
+            return False
+    return True
+
+
+def _iou(a, b) -> float:
+    """2つのbbox(xyxy)のIoUを返す"""
+    w = max(0.0, min(a[2], b[2]) - max(a[0], b[0]))
+    h = max(0.0, min(a[3], b[3]) - max(a[1], b[1]))
+    inter = w * h
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+
+def representative_frame(logging_dir: str | Path = "Logging") -> np.ndarray:
+    """バックエンドの計測に使う代表画像を返す。
+    ログ(Logging/YYYYMMDD/*.jpg)に実際のトレー画像があれば最新のものを、なければ灰色の画像を返す
+
+    Args:
+        logging_dir (str | Path, optional): ログの保存先. Defaults to "Logging".
+
+    Returns:
+        np.ndarray: 画像(BGR)
+    """
+    import cv2
+
+    logged_images = sorted(Path(logging_dir).glob("*/*.jpg"))
+    if logged_images:
+        frame = cv2.imread(str(logged_images[-1]))
+        if frame is not None:
+            return frame
+    return np.full((480, 640, 3), 114, dtype=np.uint8)
+
+
+def _load_selected_backend(path: Path, device, candidates: list[Backend]) -> Backend | None:
+    """前回選んだバックエンドの記録を読む。条件(device・候補)が変わっていればNone"""
+    try:
+        with open(path, mode="r", encoding="utf-8") as f:
+            record = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if record.get("device") != str(device) or record.get("candidates") != list(candidates):
+        return None
+    backend = record.get("backend")
+    return backend if backend in candidates else None
+
+
+def _save_selected_backend(path: Path, backend: Backend, device, candidates: list[Backend]):
+    """選んだバックエンドを記録する(一時ファイルに書いてから置き換える)"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, mode="w", encoding="utf-8") as f:
+        json.dump({"backend": backend, "device": str(device), "candidates": list(candidates)}, f)
+    os.replace(tmp_path, path)
+
+
+def _measure(model: "Yolov9", frame: np.ndarray, repeat: int) -> tuple["Yolov9Result", float]:
+    """1回目(計測しない)の結果と、repeat回の処理時間の中央値(ms)を返す"""
+    result, _ = model.predict_frame(frame)
+    times: list[float] = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        model.predict_frame(frame)
+        times.append(time.perf_counter() - t0)
+    return result, float(np.median(times)) * 1e3
+
+
+def select_backend(
+    weights: str | Path,
+    frame: np.ndarray | None = None,
+    candidates: list[Backend] | None = None,
+    repeat: int = 10,
+    cache_dir: str | Path = CACHE_DIR,
+    use_cache: bool = True,
+    **kwargs,
+) -> tuple[Backend, str]:
+    """各バックエンドで代表画像を推論し、PyTorchと結果が一致するもののうちいちばん速いものを選ぶ。
+    基準の結果は、candidatesの順番に関係なくPyTorchのモデルで作る。
+    PyTorchが代表画像で何も検出しない場合は、一致を確かめられないので"pt"を選ぶ。
+    PyTorchのモデルを読み込めない場合は、一致の確認をせずに、いちばん速いものを選ぶ。
+    どちらの場合も、選んだバックエンドは記録しない(次の起動でやり直す)
+
+    Args:
+        weights (str | Path): .ptの重みファイルのパス
+        frame (np.ndarray | None, optional): 代表画像(BGR)。Noneの場合はrepresentative_frame(). Defaults to None.
+        candidates (list[Backend] | None, optional): 試すバックエンド。Noneの場合はavailable_backends(). Defaults to None.
+        repeat (int, optional): 計測する回数. Defaults to 10.
+        cache_dir (str | Path, optional): キャッシュの親ディレクトリ. Defaults to CACHE_DIR.
+        use_cache (bool, optional): 前回選んだバックエンド(selected_backend.json)があれば、計測せずにそれを使う. Defaults to True.
+        **kwargs: Yolov9のコンストラクタに渡す引数(device, imgszなど)
+
+    Returns:
+        tuple[Backend, str]: 選ばれたバックエンドと、DetectMultiBackendに渡すパス
+    """
+    from Yolov9Wrapper.Yolov9Wrapper import Yolov9
+
+    candidates = list(candidates or available_backends())
+    imgsz = kwargs.get("imgsz", (640, 640))
+    device = kwargs.get("device", "cpu")
+    record_path = cache_dir_for(weights, imgsz, cache_dir) / SELECTED_BACKEND_NAME
+
+    # ---前回の記録があれば、計測せずに使う
+    if use_cache:
+        backend = _load_selected_backend(record_path, device, candidates)
+        if backend is not None:
+            print(f"\033[36m[Backends] using cached selection {backend} for {weights}\033[0m")
+            return backend, export_backend(weights, backend, imgsz, cache_dir=cache_dir)
+
+    if frame is None:
+        frame = representative_frame()
+
+    # ---基準(PyTorch)の結果を作る
+    reference: "Yolov9Result | None" = None
+    best: tuple[float, Backend, str] | None = None
+    try:
+        model = Yolov9(weights, backend="pt", cache_dir=cache_dir, **kwargs)
+        reference, latency = _measure(model, frame, repeat)
+        if "pt" in candidates:
+            print(f"\033[36m[Backends] pt: {latency:.1f}ms\033[0m")
+            best = (latency, "pt", model.weights)
+    except Exception as e:
+        print(f"\033[33m[Backends] pt reference is not available, skip output check: {e}\033[0m")
+
+    # ---基準が何も検出しない画像では、空の結果どうしが一致してしまい、確認にならない
+    if reference is not None and len(reference["boxes"]) == 0:
+        print(
+            f"\033[33m[Backends] pt found no boxes in the representative frame, "
+            f"cannot check outputs; using pt for {weights}\033[0m"
+        )
+        return "pt", model.weights
+
+    for backend in candidates:
+        if backend == "pt":
+            continue
+        try:
+            model = Yolov9(weights, backend=backend, cache_dir=cache_dir, **kwargs)
+            result, latency = _measure(model, frame, repeat)
+        except Exception as e:
+            print(f"\033[33m[Backends] {backend} is not available: {e}\033[0m")
+            continue
+
+        # ---PyTorchの結果と一致するか確認する
+        if reference is not None and not results_match(reference, result):
+            print(f"\033[33m[Backends] {backend} output does not match, skipped\033[0m")
+            continue
+
+        print(f"\033[36m[Backends] {backend}: {latency:.1f}ms\033[0m")
+        if best is None or latency < best[0]:
+            best = (latency, backend, model.weights)
+
+    if best is None:
+        raise RuntimeError(f"no backend is available for {weights}")
+    print(f"\033[36m[Backends] selected {best[1]} for {weights}\033[0m")
+    # 一致を確認できた場合だけ記録する(確認できなかった選択は、次の起動でやり直す)
+    if reference is not None:
+        _save_selected_backend(record_path, best[1], device, candidates)
+    return best[1], best[2]
@@ -0,0 +1,200 @@
+"""
+# Evaluation.py
+ログ(LabelMe形式)に保存された実際のトレー画像を使って、Yolov9の精度(mAP)を評価するモジュール。
+
+## 使い方
+```py
+from Yolov9Wrapper.Evaluation import evaluate_map, load_labelme_samples
+
+samples = load_labelme_samples("./Logging", limit=200)
+metrics = evaluate_map(model, samples)
+print(metrics["map50"], metrics["map50_95"])
+```
+
+## 開発メモ
+- ログは `modules.Logging.log_as_labelme` で `Logging/YYYYMMDD/*.json` に保存されたもの
+- モデルのクラス名(model.names)にないラベルは、評価から除外する
+    - お皿モデルで評価するときは、商品のラベルは除外される
+"""
+
+import json
+import random
+from pathlib import Path
+from typing import TYPE_CHECKING, TypedDict
+
+import cv2
+import numpy as np
+
+if TYPE_CHECKING:
+    from Yolov9Wrapper.Yolov9Wrapper import Yolov9
+
+
+class LabeledSample(TypedDict):
+    """正解ラベル付きの画像1枚分のデータクラス。
+
+    Example:
+    ```json
+    {
+        "image_path": str,  # 画像のパス
+        "labels": list[str],  # 各bboxのラベル
+        "xyxy": list[list[float]],  # 各bboxの座標(ピクセル)
+    }
+    ```
+    """
+
+    image_path: str  # 画像のパス
+    labels: list[str]  # 各bboxのラベル
+    xyxy: list[list[float]]  # 各bboxの座標(ピクセル)
+
+
+def load_labelme_samples(
+    logging_dir: str | Path = "Logging",
+    limit: int | None = None,
+    seed: int = 0,
+) -> list[LabeledSample]:
+    """ログディレクトリから、LabelMe形式の正解ラベル付き画像を読み込む
+
+    Args:
+        logging_dir (str | Path, optional): ログの保存先. Defaults to "Logging".
+        limit (int | None, optional): 読み込む最大枚数。指定した場合はランダムに選ぶ. Defaults to None.
+        seed (int, optional): ランダムに選ぶときのシード. Defaults to 0.
+
+    Returns:
+        list[LabeledSample]: 正解ラベル付き画像のリスト
+    """
+    json_paths = sorted(Path(logging_dir).glob("**/*.json"))
+    if limit is not None and len(json_paths) > limit:
+        json_paths = sorted(random.Random(seed).sample(json_paths, limit))
+
+    samples: list[LabeledSample] = []
+    for json_path in json_paths:
+        with open(json_path, "r", encoding="utf-8") as f:
+            labelme = json.load(f)
+        # imagePathは保存時のカレントディレクトリからの相対パスなので、jsonと同じ場所を探す
+        image_path = json_path.with_name(Path(labelme["imagePath"]).name)
+        if not image_path.exists():
+            continue
+
+        labels: list[str] = []
+        xyxy: list[list[float]] = []
+        for shape in labelme["shapes"]:
+            if shape["shape_type"] != "rectangle":
+                continue
+            (x0, y0), (x1, y1) = shape["points"]
+            labels.append(shape["label"])
+            xyxy.append([min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)])
+        samples.append({"image_path": str(image_path), "labels": labels, "xyxy": xyxy})
+
+    return samples
+
+
+def box_iou_np(box1: np.ndarray, box2: np.ndarray) -> np.ndarray:
+    """bbox(xyxy)同士のIoUを、総当たりで計算する
+
+    Args:
+        box1 (np.ndarray): (n, 4)
+        box2 (np.ndarray): (m, 4)
+
+    Returns:
+        np.ndarray: (n, m)のIoU
+    """
+    lt = np.maximum(box1[:, None, :2], box2[None, :, :2])
+    rb = np.minimum(box1[:, None, 2:], box2[None, :, 2:])
+    inter = np.clip(rb - lt, 0, None).prod(2)
+    area1 = (box1[:, 2:] - box1[:, :2]).prod(1)
+    area2 = (box2[:, 2:] - box2[:, :2]).prod(1)
+    return inter / (area1[:, None] + area2[None, :] - inter + 1e-7)
+
+
+def _match_predictions(
+    pred_xyxy: np.ndarray,
+    pred_cls: np.ndarray,
+    gt_xyxy: np.ndarray,
+    gt_cls: np.ndarray,
+    iouv: np.ndarray,
+) -> np.ndarray:
+    """予測と正解を対応づけ、各IoUしきい値でのTPを返す(yolov9/val.pyのprocess_batchと同じ)
+
+    Returns:
+        np.ndarray: (予測数, len(iouv))のbool配列
+    """
+    correct = np.zeros((len(pred_xyxy), len(iouv)), dtype=bool)
+    if len(pred_xyxy) == 0 or len(gt_xyxy) == 0:
+        return correct
+    iou = box_iou_np(gt_xyxy, pred_xyxy)
+    correct_class = gt_cls[:, None] == pred_cls[None, :]
+    for i, threshold in enumerate(iouv):
+        x = np.nonzero((iou >= threshold) & correct_class)
+        if not len(x[0]):
+            continue
+        matches = np.stack([x[0], x[1], iou[x[0], x[1]]], axis=1)
+        if len(x[0]) > 1:
+            matches = matches[matches[:, 2].argsort()[::-1]]
+            matches = matches[np.unique(matches[:, 1], return_index=True)[1]]
+            matches = matches[np.unique(matches[:, 0], return_index=True)[1]]
+        correct[matches[:, 1].astype(int), i] = True
+    return correct
+
+
+def evaluate_map(
+    model: "Yolov9",
+    samples: list[LabeledSample],
+    conf_thres: float = 0.001,
+    iou_thres: float = 0.6,
+) -> dict[str, float]:
+    """正解ラベル付き画像で、モデルのmAPを計算する
+
+    Args:
+        model (Yolov9): 評価するモデル
+        samples (list[LabeledSample]): 正解ラベル付き画像のリスト
+        conf_thres (float, optional): 確信度のしきい値。mAPの計算用に低くしておく. Defaults to 0.001.
+        iou_thres (float, optional): NMSのIoUしきい値. Defaults to 0.6.
+
+    Returns:
+        dict[str, float]: map50, map50_95, 評価した画像数(images)、正解bbox数(labels)
+    """
+    from yolov9.utils.metrics import ap_per_class
+
+    name_to_cls = {name: cls for cls, name in model.names.items()}
+    iouv = np.linspace(0.5, 0.95, 10)
+
+    stats: list[tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]] = []
+    n_labels = 0
+    for sample in samples:
+        frame = cv2.imread(sample["image_path"])
+        if frame is None:
+            continue
+        height, width = frame.shape[:2]
+
+        # ---正解ラベル(モデルが知っているものだけ)
+        known = [i for i, label in enumerate(sample["labels"]) if label in name_to_cls]
+        gt_cls = np.array([name_to_cls[sample["labels"][i]] for i in known], dtype=int)
+        gt_xyxy = np.array([sample["xyxy"][i] for i in known], dtype=float).reshape(-1, 4)
+        n_labels += len(known)
+
+        # ---推論結果(0-1の座標をピクセルに戻す)
+        result, _ = model.predict_frame(frame, conf_thres=conf_thres, iou_thres=iou_thres)
+        boxes = list(result["boxes"])
+        pred_cls = np.array([name_to_cls[box["label"]] for box in boxes], dtype=int)
+        pred_conf = np.array([box["confidence"] for box in boxes], dtype=float)
+        pred_xyxy = (
+            np.array([box["xyxy"] for box in boxes], dtype=float).reshape(-1, 4)
+            * [width, height, width, height]
+        )
+
+        correct = _match_predictions(pred_xyxy, pred_cls, gt_xyxy, gt_cls, iouv)
+        stats.append((correct, pred_conf, pred_cls, gt_cls))
+
+    if not stats or n_labels == 0:
+        return {"map50": 0.0, "map50_95": 0.0, "images": len(stats), "labels": n_labels}
+
+    tp, conf, pred_cls, target_cls = (np.concatenate(x, 0) for x in zip(*stats))
+    if len(tp) == 0:
+        return {"map50": 0.0, "map50_95": 0.0, "images": len(stats), "labels": n_labels}
+    _, _, _, _, _, ap, _ = ap_per_class(tp, conf, pred_cls, target_cls, names=model.names)
+    return {
+        "map50": float(ap[:, 0].mean()),
+        "map50_95": float(ap.mean(1).mean()),
+        "images": len(stats),
+        "labels": n_labels,
+    }
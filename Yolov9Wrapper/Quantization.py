@@ -0,0 +1,201 @@
+"""
+# Quantization.py
+ログに溜まった実際のトレー画像をキャリブレーションに使って、Yolov9をINT8に量子化するモジュール。
+
+## 使い方
+```sh
+# お皿モデルを量子化し、FP32とのmAPの差を表示する
+python -m Yolov9Wrapper.Quantization --weights ./weights/osara.pt --logging-dir ./Logging
+```
+
+```py
+# 量子化したモデルを読み込む
+model = Yolov9(weights="./weights/osara.pt", device="cpu", backend="onnx_int8")
+```
+
+## 仕組み
+- backend="onnx"と同じ手順で、FP32のONNXをエクスポートする(Backends.export_backend)
+- `Logging/YYYYMMDD/*.jpg` からランダムに選んだ画像をletterboxして、ONNX Runtimeの静的量子化(QDQ形式)のキャリブレーションに使う
+- 量子化したモデルは、FP32のONNXと同じキャッシュディレクトリに `model_int8.onnx` として保存する
+- キャリブレーションに使わなかったログ画像で、FP32とINT8のmAPを比較する
+
+## 開発メモ
+- onnx, onnxruntimeが必要
+- INT8は結果がPyTorchと完全には一致しないので、backend="auto"の候補には入れない。mAPの差を見てから明示的に指定する
+"""
+
+import argparse
+import ast
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from Yolov9Wrapper.Backends import (
+    CACHE_DIR,
+    INT8_MODEL_NAME,
+    cache_dir_for,
+    export_backend,
+)
+from Yolov9Wrapper.Evaluation import LabeledSample, evaluate_map, load_labelme_samples
+
+
+class LoggedImageCalibrationReader:
+    """ONNX Runtimeの静的量子化に、ログ画像を渡すためのクラス(CalibrationDataReaderと同じインターフェース)"""
+
+    def __init__(
+        self,
+        image_paths: list[str],
+        input_name: str,
+        imgsz: tuple[int, int] = (640, 640),
+        stride: int = 32,
+    ):
+        self.image_paths = image_paths
+        self.input_name = input_name
+        self.imgsz = imgsz
+        self.stride = stride
+        self._iter = iter(self.image_paths)
+
+    def get_next(self) -> dict[str, np.ndarray] | None:
+        """次のキャリブレーション画像を、モデルの入力形式で返す。最後まで来たらNoneを返す"""
+        from yolov9.utils.augmentations import letterbox
+
+        for image_path in self._iter:
+            frame = cv2.imread(image_path)
+            if frame is None:
+                continue
+            im = letterbox(frame, self.imgsz, stride=self.stride, auto=False)[0]
+            im = im.transpose((2, 0, 1))[::-1]  # HWC to CHW, BGR to RGB
+            im = np.ascontiguousarray(im, dtype=np.float32)[None] / 255
+            return {self.input_name: im}
+        return None
+
+    def rewind(self):
+        self._iter = iter(self.image_paths)
+
+
+def int8_model_path(
+    weights: str | Path,
+    imgsz: tuple[int, int] = (640, 640),
+    cache_dir: str | Path = CACHE_DIR,
+) -> Path:
+    """量子化したモデルの保存先を返す"""
+    return cache_dir_for(weights, imgsz, cache_dir) / INT8_MODEL_NAME
+
+
+def quantize_int8(
+    weights: str | Path,
+    calibration_samples: list[LabeledSample],
+    imgsz: tuple[int, int] = (640, 640),
+    cache_dir: str | Path = CACHE_DIR,
+    per_channel: bool = True,
+) -> str:
+    """重みをINT8に静的量子化し、そのパスを返す
+
+    Args:
+        weights (str | Path): .ptの重みファイルのパス
+        calibration_samples (list[LabeledSample]): キャリブレーションに使うログ画像
+        imgsz (tuple[int, int], optional): 入力サイズ(height, width). Defaults to (640, 640).
+        cache_dir (str | Path, optional): キャッシュの親ディレクトリ. Defaults to CACHE_DIR.
+        per_channel (bool, optional): 重みをチャネルごとに量子化する. Defaults to True.
+
+    Returns:
+        str: 量子化したONNXモデルのパス
+    """
+    import onnx
+    from onnxruntime.quantization import (
+        CalibrationMethod,
+        QuantFormat,
+        QuantType,
+        quantize_static,
+    )
+    from yolov9.utils.general import yaml_save
+
+    if not calibration_samples:
+        raise ValueError("calibration_samples is empty")
+
+    # ---FP32のONNXを用意する
+    fp32_path = Path(export_backend(weights, "onnx", imgsz, cache_dir=cache_dir))
+    fp32_model = onnx.load(fp32_path)
+    input_name = fp32_model.graph.input[0].name
+    metadata = {p.key: p.value for p in fp32_model.metadata_props}
+
+    # ---ログ画像でキャリブレーションして、量子化する
+    int8_path = int8_model_path(weights, imgsz, cache_dir)
+    print(
+        f"\033[36m[Quantization] calibrating with {len(calibration_samples)} images...\033[0m"
+    )
+    reader = LoggedImageCalibrationReader(
+        [sample["image_path"] for sample in calibration_samples],
+        input_name,
+        imgsz=imgsz,
+        stride=int(metadata.get("stride", 32)),
+    )
+    quantize_static(
+        str(fp32_path),
+        str(int8_path),
+        reader,
+        quant_format=QuantFormat.QDQ,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+        per_channel=per_channel,
+        calibrate_method=CalibrationMethod.MinMax,
+    )
+
+    # ---stride・namesのメタデータを引き継ぐ(DetectMultiBackendが読む)
+    int8_model = onnx.load(int8_path)
+    del int8_model.metadata_props[:]
+    for key, value in metadata.items():
+        meta = int8_model.metadata_props.add()
+        meta.key, meta.value = key, value
+    onnx.save(int8_model, int8_path)
+    if "stride" in metadata:
+        yaml_save(
+            int8_path.with_suffix(".yaml"),
+            {"stride": int(metadata["stride"]), "names": ast.literal_eval(metadata["names"])},
+        )
+
+    print(f"\033[36m[Quantization] saved {int8_path}\033[0m")
+    return str(int8_path)
+
+
+def main():
+    from Yolov9Wrapper.Yolov9Wrapper import Yolov9
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--weights", required=True, help=".ptの重みファイルのパス")
+    parser.add_argument("--logging-dir", default="Logging", help="ログの保存先")
+    parser.add_argument("--calib", type=int, default=100, help="キャリブレーションに使う枚数")
+    parser.add_argument("--eval", type=int, default=200, help="mAPの評価に使う枚数")
+    parser.add_argument("--imgsz", type=int, nargs=2, default=[640, 640])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    imgsz = tuple(args.imgsz)
+
+    # ---キャリブレーション用と評価用に、ログ画像を分ける
+    samples = load_labelme_samples(
+        args.logging_dir, limit=args.calib + args.eval, seed=args.seed
+    )
+    calibration_samples, eval_samples = samples[: args.calib], samples[args.calib :]
+    print(
+        f"\033[36m[Quantization] calibration: {len(calibration_samples)}, eval: {len(eval_samples)}\033[0m"
+    )
+
+    quantize_int8(args.weights, calibration_samples, imgsz=imgsz)
+
+    # ---FP32とINT8のmAPを比較する
+    fp32 = evaluate_map(Yolov9(args.weights, device="cpu", backend="onnx", imgsz=imgsz), eval_samples)
+    int8 = evaluate_map(
+        Yolov9(args.weights, device="cpu", backend="onnx_int8", imgsz=imgsz), eval_samples
+    )
+    print(f"FP32: mAP50={fp32['map50']:.4f}, mAP50-95={fp32['map50_95']:.4f}")
+    print(f"INT8: mAP50={int8['map50']:.4f}, mAP50-95={int8['map50_95']:.4f}")
+    print(
+        f"delta: mAP50={int8['map50'] - fp32['map50']:+.4f}, "
+        f"mAP50-95={int8['map50_95'] - fp32['map50_95']:+.4f} "
+        f"({int8['images']} images, {int8['labels']} labels)"
+    )
+
+
+if __name__ == "__main__":
+    main()
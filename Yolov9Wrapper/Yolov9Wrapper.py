@@ -50,6 +50,28 @@ model.predict_stream(0, on_detect=on_detect)
     - 不要なコードの削除
 
 ## 更新履歴
+- 20261018
+    - predict_frame/predict_framesを追加した
+        - LoadImages・tqdm・warmupを通さずに、np.ndarrayを直接推論する(会計APIの高速化用)
+        - stride・imgszはコンストラクタで前計算して使いまわす
+    - predict_tensor/input_signatureを追加した
+        - 同じ画像をお皿・商品モデルで推論するとき、前処理を1回で済ませるため
+    - backend引数を追加した(Backends.py)
+        - "onnx", "openvino", "dnn"を指定すると、エクスポートしてキャッシュしたモデルで推論する
+        - "auto"を指定すると、起動時に計測していちばん速いバックエンドを選ぶ
+    - ログ画像でキャリブレーションしたINT8モデルを読めるようにした(Quantization.py, backend="onnx_int8")
+    - predict_frame系は、デフォルトでbboxを描画しないようにした(annotate=False)
+        - 描画が必要なときは、render()で元画像とbboxからあとで描画する
+    - NMS後の処理をtensor演算でまとめて行い、boxesをYolov9Detections(列ごとのnumpy配列)で返すようにした
+        - list[Yolov9ResultBox]と同じように使える
+    - モデルごとに入力サイズ(imgsz)を指定できるようにした。predict_image・predict_streamも、コンストラクタのimgszを使う
+        - imgszは320のように1つでも、(480, 640)のように長方形でも指定できる
+        - rect=True(デフォルト)では、PyTorchのとき最小パディングのletterboxにする
+        - benchmarks/sweep_imgsz.pyで、ログ画像を使って入力サイズごとの速度と精度を比較できる
+    - 起動を速くした
+        - 学習用のモジュール(plots, dataloaders, pandas, matplotlib)は、使うときに読み込むようにした
+        - fast_start=Trueでは、fuse済みのモデルをキャッシュ(model_cache)から読み込み、fuseを省く
+        - benchmarks/bench_startup.pyで、import・モデルの読み込み・最初の推論の時間を計測できる
 - 20241012
     - np.ndarrayを直接推論できるようにした
     - Yolov9Annotatorを追加した
@@ -70,19 +92,18 @@ model.predict_stream(0, on_detect=on_detect)
 
 from pathlib import Path
 import platform
-from typing import Tuple
+from typing import Literal, Tuple
 
 import numpy as np
 import torch
 import sys
 import base64
 import json
-from tqdm import tqdm
 
 print(f"\033[36m[YoloV9Wrapper] importing yolov9...\033[0m")
 sys.path.append(r"./yolov9")
 from yolov9.models.common import DetectMultiBackend
-from yolov9.utils.dataloaders import LoadImages, LoadStreams
+from yolov9.utils.augmentations import letterbox
 from yolov9.utils.general import (
     Profile,
     check_img_size,
@@ -92,7 +113,6 @@ from yolov9.utils.general import (
     scale_boxes,
     xyxy2xywh,
 )
-from yolov9.utils.plots import Annotator, colors, save_one_box
 from yolov9.utils.torch_utils import select_device, smart_inference_mode
 
 print(f"\033[36m[YoloV9Wrapper] imported yolov9!\033[0m")
@@ -122,6 +142,8 @@ class Yolov9Annotator:
             pil (bool, optional): 不明。 Defaults to False.
             names (list[str], optional): ラベルのリスト. Defaults to None.
         """
+        from yolov9.utils.plots import Annotator
+
         self.annotator = Annotator(
             image,
             line_width=line_width,
@@ -172,6 +194,8 @@ class Yolov9Annotator:
             if name == label:
                 color_index = index
                 break
+        from yolov9.utils.plots import colors
+
         return colors(index, True)
 
 
@@ -198,6 +222,83 @@ class Yolov9ResultBox(TypedDict):
         return f"Yolov9ResultBox(label={self.label}, confidence={self.confidence}, bbox={self.xyxy})"
 
 
+class Yolov9Detections:
+    """NMS後の検出結果を、列ごとのnumpy配列で保持するクラス。
+
+    list[Yolov9ResultBox]と同じように使える(len・インデックス・for)。
+    各bboxのdict(Yolov9ResultBox)は、アクセスされたときに初めて作り、キャッシュする。
+    (キャッシュするので、取り出したdictに書き込んだ値は保持される)
+
+    example:
+    ```py
+    detections.xyxy  # (n, 4) float32。bboxの座標(0-1)
+    detections.conf  # (n,) float32。確信度
+    detections.cls  # (n,) int64。クラスのインデックス
+    detections.labels  # list[str]。ラベル
+    detections[0]  # {"label": str, "confidence": float, "xyxy": [float, float, float, float]}
+    ```
+    """
+
+    __slots__ = ("xyxy", "conf", "cls", "names", "_views")
+
+    def __init__(
+        self,
+        xyxy: np.ndarray,
+        conf: np.ndarray,
+        cls: np.ndarray,
+        names: dict[int, str],
+    ) -> None:
+        self.xyxy = xyxy
+        self.conf = conf
+        self.cls = cls
+        self.names = names
+        self._views: list[Yolov9ResultBox | None] = [None] * len(conf)
+
+    @classmethod
+    def empty(cls, names: dict[int, str]) -> "Yolov9Detections":
+        """検出結果が0個のYolov9Detectionsを返す"""
+        return cls(
+            np.zeros((0, 4), dtype=np.float32),
+            np.zeros((0,), dtype=np.float32),
+            np.zeros((0,), dtype=np.int64),
+            names,
+        )
+
+    def __len__(self) -> int:
+        return len(self.conf)
+
+    def __getitem__(self, index: int | slice) -> Yolov9ResultBox | list[Yolov9ResultBox]:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        view = self._views[index]
+        if view is None:
+            view = {
+                "label": self.names[int(self.cls[index])],
+                "confidence": float(self.conf[index]),
+                "xyxy": self.xyxy[index].tolist(),
+            }
+            self._views[index] = view
+        return view
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self):
+        return f"Yolov9Detections(n={len(self)}, labels={self.labels})"
+
+    @property
+    def labels(self) -> list[str]:
+        """各bboxのラベルのリスト"""
+        return [self.names[int(c)] for c in self.cls]
+
+    def to_list(self) -> list[Yolov9ResultBox]:
+        """すべてのbboxを、Yolov9ResultBoxのリストにして返す"""
+        return list(self)
+
+
 class Yolov9Result(TypedDict):
     """Yolov9の推論結果を保存するクラス
 
@@ -207,7 +308,7 @@ class Yolov9Result(TypedDict):
     {
         "image": np.ndarray,  # bboxの画像
         "path": str|None,  # 画像のパス。numpyの場合はNone
-        "boxes": [
+        "boxes": [  # Yolov9Detections(predict_streamはlist)。各要素は下のdict
             {
                 "label": str,  # ラベル
                 "confidence": float,  # 確信度
@@ -222,7 +323,9 @@ class Yolov9Result(TypedDict):
 
     image: np.ndarray  # bboxの画像
     path: str  # 画像のパス
-    boxes: list[Yolov9ResultBox]  # bboxのリスト
+    # bboxの結果。predict_image・predict_frame系・predict_tensorはYolov9Detections、predict_streamはlist[Yolov9ResultBox]
+    # どちらもlen・インデックス・forで各bboxのdict(label, confidence, xyxy)を取り出せる
+    boxes: Yolov9Detections | list[Yolov9ResultBox]
     annotator: Yolov9Annotator  # annotator
 
     def __repr__(self):
@@ -275,11 +378,46 @@ class Yolov9:
         data="./yolov9/data/coco.yaml",  # dataset.yaml path
         dnn=False,  # use OpenCV DNN for ONNX inference
         half=False,  # FP16 half-precision inference
+        imgsz: int | Tuple[int, int] = (640, 640),  # inference size (height, width)
+        rect: bool = True,  # minimal-padding letterbox (PyTorch only)
+        backend: Literal["pt", "onnx", "openvino", "dnn", "onnx_int8", "auto"] = "pt",  # inference backend
+        cache_dir: str = "./model_cache",  # exported model cache
+        fast_start: bool = False,  # load a cached pre-fused model (PyTorch only)
     ) -> None:
+        # 320のように1つだけ指定した場合は、正方形にする
+        if isinstance(imgsz, int):
+            imgsz = (imgsz, imgsz)
+
+        # ---バックエンドに合わせて、重みをエクスポートする(Backends.py)
+        if backend == "auto":
+            from Yolov9Wrapper.Backends import select_backend
+
+            backend, weights = select_backend(
+                weights,
+                cache_dir=cache_dir,
+                device=device,
+                data=data,
+                half=half,
+                imgsz=imgsz,
+                rect=rect,
+            )
+        elif backend != "pt":
+            from Yolov9Wrapper.Backends import export_backend
+
+            weights = export_backend(weights, backend, imgsz, cache_dir=cache_dir)
+
+        # ---fuse済みのモデルをキャッシュから読み込み、起動時のfuseを省く(Backends.py)
+        fast_start = fast_start and backend == "pt"
+        if fast_start:
+            from Yolov9Wrapper.Backends import export_fused
+
+            weights = export_fused(weights, cache_dir=cache_dir)
+
         self.weights = weights
+        self.backend = backend
         self.device = device
         self.data = data
-        self.dnn = dnn
+        self.dnn = dnn or backend == "dnn"
         self.half = half
         # ---モデルの読み込み
         self.device = select_device(device)
@@ -289,14 +427,322 @@ class Yolov9:
             dnn=self.dnn,
             data=self.data,
             fp16=self.half,
+            fuse=not fast_start,
+        )
+        if fast_start:
+            from Yolov9Wrapper.Backends import restore_fused_forward
+
+            restore_fused_forward(self.model.model)
+        if self.dnn:
+            # OpenCV DNNはONNXのメタデータを読まないので、エクスポート時に書き出したものを使う
+            stride, names = DetectMultiBackend._load_metadata(
+                Path(self.weights).with_suffix(".yaml")
+            )
+            if names is not None:
+                self.model.stride, self.model.names = stride, names
+
+        # ---推論用のパラメータを前計算しておく(predict_frameで毎回計算しないように)
+        self.stride, self.names, self.pt = (
+            self.model.stride,
+            self.model.names,
+            self.model.pt,
+        )
+        self.imgsz = check_img_size(imgsz, s=self.stride)
+        # 最小パディング(長方形)のletterboxは、入力サイズが可変なPyTorchのときだけ使える
+        self.auto = bool(rect and self.pt)
+        self.model.warmup(imgsz=(1, 3, *self.imgsz))
+
+    def preprocess(
+        self, frame: np.ndarray, imgsz: Tuple[int, int] | None = None
+    ) -> np.ndarray:
+        """1枚の画像(BGR)を、推論用の配列(CHW, RGB, uint8)に変換する
+
+        Args:
+            frame (np.ndarray): 推論する画像(BGR)
+            imgsz (Tuple[int, int] | None, optional): 入力サイズ(height, width)。
+                指定した場合は、バッチにまとめられるように必ずそのサイズにする(お皿の切り抜きなど). Defaults to None(self.imgsz).
+
+        Returns:
+            np.ndarray: letterbox済みの配列(CHW, RGB, uint8)
+        """
+        if imgsz is None:
+            im = letterbox(frame, self.imgsz, stride=self.stride, auto=self.auto)[0]
+        else:
+            im = letterbox(frame, imgsz, stride=self.stride, auto=False)[0]
+        im = im.transpose((2, 0, 1))[::-1]  # HWC to CHW, BGR to RGB
+        return np.ascontiguousarray(im)
+
+    def to_tensor(self, ims: np.ndarray) -> torch.Tensor:
+        """前処理済みの配列(NCHW, uint8)を、モデルに入力できるtensorに変換する
+
+        Args:
+            ims (np.ndarray): 前処理済みの配列(NCHW, uint8)
+
+        Returns:
+            torch.Tensor: 0-1に正規化したtensor
+        """
+        im = torch.from_numpy(ims).to(self.model.device)
+        im = im.half() if self.model.fp16 else im.float()  # uint8 to fp16/32
+        im /= 255  # 0 - 255 to 0.0 - 1.0
+        if len(im.shape) == 3:
+            im = im[None]  # expand for batch dim
+        return im
+
+    def _build_result(
+        self,
+        det: torch.Tensor,
+        im_shape: tuple[int, int],
+        im0s: np.ndarray,
+        path: str | Path,
+        line_thickness=3,
+        hide_labels=False,
+        hide_conf=False,
+        annotate=True,
+    ) -> Yolov9Result:
+        """NMS後の1画像分の検出結果から、Yolov9Resultを作成する
+
+        Args:
+            det (torch.Tensor): NMS後の検出結果(n, 6)
+            im_shape (tuple[int, int]): モデルに入力した画像のサイズ(height, width)
+            im0s (np.ndarray): 元画像
+            path (str | Path): 画像のパス。numpyの場合は""
+            annotate (bool): Trueの場合、bboxを描画した画像とannotatorを返す。
+                Falseの場合、imageには元画像をそのまま入れ(コピーしない)、annotatorはNoneにする
+
+        Returns:
+            Yolov9Result: 推論結果
+        """
+        names = self.names
+        result: Yolov9Result = Yolov9Result()  # 推論結果を保存するクラス
+        im0 = im0s.copy() if annotate else im0s
+
+        gn = torch.tensor(im0.shape)[[1, 0, 1, 0]]  # 幅、高さを0-1にするための値
+
+        # ---annotatorの初期化
+        annotator, annotator_new = None, None
+        if annotate:
+            annotator = Yolov9Annotator(im0, line_width=line_thickness, names=names)
+            im0_copy = im0.copy()
+            annotator_new = Yolov9Annotator(
+                im0_copy, line_width=line_thickness, names=names
+            )
+
+        detections = Yolov9Detections.empty(names)  # bboxの結果
+        if len(det):
+            # Rescale boxes from img_size to im0 size
+            det[:, :4] = scale_boxes(im_shape, det[:, :4], im0.shape).round()
+
+            # ---全bboxをまとめて処理する(座標の並べ替え・0-1への正規化・クリップ)
+            det = det.flip(0)  # 従来どおり、確信度の低い順にする
+            x_sorted = det[:, [0, 2]].sort(dim=1).values
+            y_sorted = det[:, [1, 3]].sort(dim=1).values
+            new_xyxy = torch.stack(
+                [x_sorted[:, 0], y_sorted[:, 0], x_sorted[:, 1], y_sorted[:, 1]], dim=1
+            )
+            normalized_xyxy = (new_xyxy / gn.to(new_xyxy.device)).clamp(0, 1)
+            detections = Yolov9Detections(
+                normalized_xyxy.float().cpu().numpy(),
+                det[:, 4].float().cpu().numpy(),
+                det[:, 5].long().cpu().numpy(),
+                names,
+            )
+
+            # ---bboxの描画
+            if annotator is not None:
+                from yolov9.utils.plots import colors
+
+                pixel_xyxy = new_xyxy.cpu().numpy()
+                for xyxy, conf, c in zip(pixel_xyxy, detections.conf, detections.cls):
+                    c = int(c)
+                    label = (
+                        None
+                        if hide_labels
+                        else (names[c] if hide_conf else f"{names[c]} {conf:.2f}")
+                    )
+                    color = colors(c, True)
+                    annotator.box_label(xyxy.tolist(), label, color=color)
+
+        # ---result(1画像の結果)を用意
+        result["image"] = annotator.result() if annotator is not None else im0
+        result["path"] = str(path) if type(path) == Path else None
+        result["boxes"] = detections
+        result["annotator"] = annotator_new  # 追記用にannotatorも返す
+        return result
+
+    def render(
+        self,
+        frame: np.ndarray,
+        boxes: list[Yolov9ResultBox],
+        line_thickness=3,
+        hide_labels=False,
+        hide_conf=False,
+    ) -> np.ndarray:
+        """元画像と推論結果のbboxから、bboxを描画した画像を作る。
+        annotate=Falseで推論した結果を、あとから(デバッグ・ログ・管理画面などで)描画するために使う
+
+        Args:
+            frame (np.ndarray): 元画像
+            boxes (list[Yolov9ResultBox]): 推論結果のbbox(0-1の座標)
+
+        Returns:
+            np.ndarray: bboxを描画した画像(元画像は変更しない)
+        """
+        height, width = frame.shape[:2]
+        annotator = Yolov9Annotator(frame.copy(), line_width=line_thickness, names=self.names)
+        for box in boxes:
+            xyxy = box["xyxy"]
+            pixel_xyxy = [xyxy[0] * width, xyxy[1] * height, xyxy[2] * width, xyxy[3] * height]
+            label = (
+                None
+                if hide_labels
+                else (box["label"] if hide_conf else f'{box["label"]} {box["confidence"]:.2f}')
+            )
+            annotator.box_label(pixel_xyxy, label, color=annotator.get_color(box["label"]))
+        return annotator.result()
+
+    def input_signature(self) -> tuple:
+        """前処理結果を左右する設定をまとめたものを返す。
+        これが一致するモデル同士は、preprocess・to_tensorの結果を共有できる。
+
+        Returns:
+            tuple: (imgsz, stride, auto, fp16, device)
+        """
+        return (
+            tuple(self.imgsz),
+            int(self.stride),
+            self.auto,
+            bool(self.model.fp16),
+            str(self.model.device),
         )
 
+    @smart_inference_mode()
+    def predict_tensor(
+        self,
+        im: torch.Tensor,
+        im0s: list[np.ndarray],
+        **kwargs,
+    ) -> Tuple[list[Yolov9Result], Tuple[float, float, float]]:
+        """前処理済みのtensor(to_tensorの結果)を推論する。
+        同じ画像を複数のモデルで推論するときに、前処理を共有するために使う。
+
+        Args:
+            im (torch.Tensor): to_tensorで作成したtensor(NCHW)
+            im0s (list[np.ndarray]): 元画像のリスト。imのバッチと同じ順番
+            **kwargs: predict_framesと同じ推論パラメータ
+
+        Returns:
+            Tuple[list[Yolov9Result], Tuple[float, float, float]]: 推論結果と処理時間(ms)。前処理時間は0
+        """
+        dt = (Profile(), Profile(), Profile())
+        results = self._predict_batch(im, im0s, dt, **kwargs)
+        t = tuple(x.t * 1e3 for x in dt)
+        return results, t
+
+    def _predict_batch(
+        self,
+        im: torch.Tensor,
+        im0s: list[np.ndarray],
+        dt: tuple[Profile, Profile, Profile],
+        conf_thres=0.25,  # confidence threshold
+        iou_thres=0.45,  # NMS IOU threshold
+        max_det=1000,  # maximum detections per image
+        classes=None,  # filter by class: --class 0, or --class 0 2 3
+        agnostic_nms=False,  # class-agnostic NMS
+        augment=False,  # augmented inference
+        line_thickness=3,  # bounding box thickness (pixels)
+        hide_labels=False,  # hide labels
+        hide_conf=False,  # hide confidences
+        annotate=False,  # draw boxes on a copy of the image
+    ) -> list[Yolov9Result]:
+        """1バッチ分のtensorを推論して、NMS・結果の作成まで行う"""
+        # ---実際の推論
+        with dt[1]:
+            pred = self.model(im, augment=augment)
+
+        # ---NMS
+        with dt[2]:
+            pred = non_max_suppression(
+                pred, conf_thres, iou_thres, classes, agnostic_nms, max_det=max_det
+            )
+
+        # ---結果の作成
+        return [
+            self._build_result(
+                det,
+                im.shape[2:],
+                im0,
+                "",
+                line_thickness=line_thickness,
+                hide_labels=hide_labels,
+                hide_conf=hide_conf,
+                annotate=annotate,
+            )
+            for det, im0 in zip(pred, im0s)
+        ]
+
+    @smart_inference_mode()
+    def predict_frames(
+        self,
+        frames: list[np.ndarray],
+        **kwargs,
+    ) -> Tuple[list[Yolov9Result], Tuple[float, float, float]]:
+        """メモリ上の画像(np.ndarray)を直接推論する。会計APIなどのホットパス用。
+
+        predict_imageと違い、LoadImages・tqdm・warmup・check_img_sizeを毎回実行しない。
+        前処理後のサイズがすべて同じ場合は、1回のforwardでまとめて推論する。
+
+        Args(主なもの):
+            frames (list[np.ndarray]): 推論する画像(BGR)のリスト
+            conf_thres, iou_thres, max_det, classes, agnostic_nms, augment,
+            line_thickness, hide_labels, hide_conf: predict_imageと同じ
+            annotate (bool): bboxを描画するか。デフォルトはFalse(描画はrenderであとから行う)
+
+        Returns:
+            Tuple[list[Yolov9Result], Tuple[float, float, float]]: 推論結果と処理時間(ms)
+        """
+        dt = (Profile(), Profile(), Profile())
+        if not frames:
+            return [], (0.0, 0.0, 0.0)
+
+        # ---画像の前処理
+        with dt[0]:
+            ims = [self.preprocess(frame) for frame in frames]
+            # 前処理後のサイズが揃っていればまとめて、そうでなければ1枚ずつ推論する
+            if all(im.shape == ims[0].shape for im in ims):
+                batches = [(self.to_tensor(np.stack(ims)), frames)]
+            else:
+                batches = [
+                    (self.to_tensor(im), [frame]) for im, frame in zip(ims, frames)
+                ]
+
+        results: list[Yolov9Result] = []
+        for im, im0s in batches:
+            results.extend(self._predict_batch(im, im0s, dt, **kwargs))
+
+        # ---処理時間の計測
+        t = tuple(x.t * 1e3 for x in dt)
+        return results, t
+
+    def predict_frame(
+        self, frame: np.ndarray, **kwargs
+    ) -> Tuple[Yolov9Result, Tuple[float, float, float]]:
+        """メモリ上の画像(np.ndarray)を1枚だけ推論する。引数はpredict_framesと同じ。
+
+        Args:
+            frame (np.ndarray): 推論する画像(BGR)
+
+        Returns:
+            Tuple[Yolov9Result, Tuple[float, float, float]]: 推論結果と処理時間(ms)
+        """
+        results, t = self.predict_frames([frame], **kwargs)
+        return results[0], t
+
     @smart_inference_mode()
     def predict_image(
         self,
         images: str | list[str] | np.ndarray | list[np.ndarray],  # image path
         save_dir: str | None = None,  # save image path
-        imgsz=(640, 640),  # inference size (height, width)
+        imgsz=None,  # inference size (height, width). None: self.imgsz
         conf_thres=0.25,  # confidence threshold
         iou_thres=0.45,  # NMS IOU threshold
         max_det=1000,  # maximum detections per image
@@ -320,8 +766,11 @@ class Yolov9:
         stride, names, pt = self.model.stride, self.model.names, self.model.pt
 
         # ---画像の読み込み
-        imgsz = check_img_size(imgsz, s=stride)  # check image size
-        dataset = LoadImages(images, img_size=imgsz, stride=stride, auto=pt)
+        from tqdm import tqdm
+        from yolov9.utils.dataloaders import LoadImages
+
+        imgsz = check_img_size(imgsz or self.imgsz, s=stride)  # check image size
+        dataset = LoadImages(images, img_size=imgsz, stride=stride, auto=self.auto)
 
         # ---推論の実行
         self.model.warmup(imgsz=(1, 3, *imgsz))
@@ -351,84 +800,27 @@ class Yolov9:
                 )
 
             # ---結果の表示
-            # det = pred[0]
-            result: Yolov9Result = Yolov9Result()  # 推論結果を保存するクラス
             for det in pred:  # pred、len(pred)=1確定じゃね？
-                # print("\033[32m", "="*20, "\033[0m")
-                p, im0, frame = path, im0s.copy(), getattr(dataset, "frame", 0)
-
+                p = path
                 if type(p) == str:
                     p = Path(p)  # to Path
                 elif isinstance(p, np.ndarray):
                     p = ""
 
-                gn = torch.tensor(im0.shape)[
-                    [1, 0, 1, 0]
-                ]  # 幅、高さを0-1にするための値
-
-                # ---annotatorの初期化
-                # annotator = Annotator(
-                #     im0, line_width=line_thickness, example=str(names)
-                # )
-                annotator = Yolov9Annotator(im0, line_width=line_thickness, names=names)
-                im0_copy=im0.copy()
-                annotator_new=Yolov9Annotator(im0_copy, line_width=line_thickness, names=names)
-
-                box_results: list[Yolov9ResultBox] = []  # 各bboxの結果を保存するリスト
-                if len(det):
-                    # Rescale boxes from img_size to im0 size
-                    det[:, :4] = scale_boxes(
-                        im.shape[2:], det[:, :4], im0.shape
-                    ).round()
-
-                    # ---各検出bboxに対して処理する
-                    for *xyxy, conf, cls in reversed(det):
-                        x_sorted = sorted([xyxy[0], xyxy[2]])
-                        y_sorted = sorted([xyxy[1], xyxy[3]])
-                        new_xyxy = [x_sorted[0], y_sorted[0], x_sorted[1], y_sorted[1]]
-                        xywh = (
-                            (xyxy2xywh(torch.tensor(new_xyxy).view(1, 4)) / gn)
-                            .view(-1)
-                            .tolist()
-                        )  # normalized xywh
-                        normalized_xyxy = (
-                            (torch.tensor(new_xyxy).view(1, 4) / gn).view(-1).tolist()
-                        )
-                        # print(f"{names[int(cls)]} {conf:.2f} {xywh}")
-
-                        # ---bboxの描画
-                        c = int(cls)
-                        label = (
-                            None
-                            if hide_labels
-                            else (names[c] if hide_conf else f"{names[c]} {conf:.2f}")
-                        )
-                        color=colors(c, True)
-                        annotator.box_label(new_xyxy, label, color=color)
-
-                        # ---bboxの結果を追加
-                        box_results.append(
-                            {
-                                "label": names[int(cls)],
-                                "confidence": float(conf),
-                                "xyxy": normalized_xyxy,
-                            }
-                        )
-                        # ---1つのbboxを保存する処理っぽい
-                        # save_one_box(new_xyxy, imc, file=save_dir / 'crops' /
-                        #              names[c] / f'{p.stem}.jpg', BGR=True)
-
-                    # Save results (image with detections)
-                    if save_dir:
-                        save_path = f"{save_dir}/{p.stem}.jpg"
-                        cv2.imwrite(save_path, im0)
-                im0 = annotator.result()
+                result = self._build_result(
+                    det,
+                    im.shape[2:],
+                    im0s,
+                    p,
+                    line_thickness=line_thickness,
+                    hide_labels=hide_labels,
+                    hide_conf=hide_conf,
+                )
 
-                # ---result(1画像の結果)を用意
-                result["image"] = im0
-                result["path"] = str(p) if type(p) == Path else None
-                result["boxes"] = box_results
-                result["annotator"] = annotator_new  # 追記用にannotatorも返す
+                # Save results (image with detections)
+                if save_dir and len(det):
+                    save_path = f"{save_dir}/{p.stem}.jpg"
+                    cv2.imwrite(save_path, result["image"])
 
                 # ---results(全画像の結果)に追加
                 results.append(result)
@@ -446,7 +838,7 @@ class Yolov9:
         self,
         video_index: int,
         on_detect: callable = None,
-        imgsz=(640, 640),  # inference size (height, width)
+        imgsz=None,  # inference size (height, width). None: self.imgsz
         conf_thres=0.25,  # confidence threshold
         iou_thres=0.45,  # NMS IOU threshold
         max_det=1000,  # maximum detections per image
@@ -462,12 +854,16 @@ class Yolov9:
         stride, names, pt = self.model.stride, self.model.names, self.model.pt
 
         # ---ストリームの読み込み
+        from yolov9.utils.dataloaders import LoadStreams
+        from yolov9.utils.plots import Annotator, colors
+
+        imgsz = check_img_size(imgsz or self.imgsz, s=stride)  # check image size
         view_img = check_imshow(warn=True)
         dataset = LoadStreams(
             str(video_index),
             img_size=imgsz,
             stride=stride,
-            auto=pt,
+            auto=self.auto,
             vid_stride=vid_stride,
         )
         bs = len(dataset)
@@ -5,22 +5,29 @@ from flask_cors import CORS
 import os
 import cv2
 import numpy as np
-import base64
 import warnings
 import random
 import json
-from flask import Flask, send_file, abort
-
-import simpleaudio
+import time
+from flask import Flask, send_file, abort, Response
 
 from Yolov9Wrapper.Yolov9Wrapper import Yolov9
 from incomings.variables import EnvVariables
 from jph.Speech import choose_voice, encode_voice_data
+from jph.VoiceAssets import VoiceAssetRegistry
 from modules.Logging import log_as_labelme
 from modules.MenuCache import MenuCache
-from modules.Types import MenuObject, Nutrition
-from modules.inference import inference_osara_shohin
-from modules.menu import Menu
+from modules.Types import MenuObject, Nutrition, OsaraShohinResult
+from modules.inference import cascade_crop_size, configure_parallel_inference, inference_osara_shohin, inference_osara_shohin_trays, render_osara_shohin_result
+from modules.InferenceScheduler import InferenceScheduler
+from modules.InferenceWorkerPool import InferenceWorkerPool
+from modules.FrameCache import FrameResultCache
+from modules.JobQueue import Job, JobQueue, JobQueueFull
+from modules.Metrics import METRICS, STAGE_SECONDS
+from modules.SideEffects import SideEffectWorker
+from modules.menu import Menu, vector_to_nutrition
+from modules.MenuSearch import SEARCH_FIELDS
+from modules.upload import base64str_to_ndarray, bytes_to_ndarray, request_to_ndarray
 
 #############################################
 ##           初期設定(パスなど)             ##
@@ -36,6 +43,61 @@ SSL_CRT=ENVVAL.SSL_CRT
 SSL_KEY=ENVVAL.SSL_KEY
 
 DEVICE="cpu" # 0:Windows GPU, mps:Mac GPU, cpu:CPU
+# pt, onnx, openvino, dnn, auto(起動時に計測して、いちばん速いものを選ぶ)
+# autoは、Logging/にトレーの画像が溜まってから使う(画像がないと"pt"になる)
+BACKEND="pt"
+# Trueの場合、fuse済みのモデルをmodel_cacheから読み込んで、起動を速くする(PyTorchのみ。初回はfuseして保存する)
+MODEL_FAST_START=True
+
+# モデルごとの入力サイズ(height, width)。benchmarks/sweep_imgszで、ログ画像での速度と精度を比べて決める
+# お皿は大きいので小さくしても見つかりやすい(例: 320)。カメラの縦横比に合わせるなら(480, 640)
+MODEL_OSARA_IMGSZ=(640, 640)
+MODEL_SHOHIN_IMGSZ=(640, 640)
+
+# 複数の端末から同時に来た推論を、まとめてバッチ推論するための設定
+INFERENCE_MAX_BATCH_SIZE=4 # 1回のforwardにまとめる最大枚数。1でまとめない
+INFERENCE_MAX_WAIT_MS=15 # 最初の1枚が来てから、他の端末の画像を待つ最大時間(ms)
+# 推論を別のワーカープロセスで行う場合のプロセス数。0でWebのプロセス内(INFERENCE_SCHEDULER)で推論する
+# 画像は共有メモリで渡すので、コアを増やしたぶんだけ会計をさばけるようになる
+# 1以上の場合、Webのプロセスはモデルを読み込まない。INFERENCE_CASCADEとは一緒に使えない。gunicornのワーカーは1つにする
+INFERENCE_WORKER_PROCESSES=0
+INFERENCE_MAX_FRAME_SHAPE=(1080, 1920, 3) # 共有メモリの1スロットに入る画像の最大サイズ(height, width, channels)
+INFERENCE_TIMEOUT_SECONDS=60.0 # ワーカープロセスの推論を待つ最大時間(秒)。超えたら会計はエラーになる
+# Trueの場合、広角カメラの画像に写った複数のトレーを、トレーごとに会計する(レスポンスのtrays)
+MULTI_TRAY=False
+TRAY_LINK_DISTANCE=0.25 # お皿の中心の距離がこれ以下なら同じトレーとみなす(0-1の座標)
+# Trueの場合、お皿を見つけてから、お皿の切り抜きだけを商品モデルで推論する
+# 会計のスレッドで1枚ずつ推論し、INFERENCE_SCHEDULERで他の端末の画像とまとめない(端末が多いとスループットが下がる)
+INFERENCE_CASCADE=False
+
+# 撮り直し用のキャッシュ。同じ端末から、ほぼ同じ画像が続けて来たら前の結果を返す
+FRAME_CACHE_ENABLED=True
+FRAME_CACHE_TTL_SECONDS=5.0 # 前の結果を使い回す時間(秒)
+FRAME_CACHE_MAX_DISTANCE=8 # 同じ画像とみなすdHash(256bit)のハミング距離の上限。大きいほど使い回しやすい
+
+# /search_menuで返す最大件数(リクエストのlimitで変えられる)
+MENU_SEARCH_LIMIT=50
+
+# 非同期の会計(/start_inference?async=1)の設定
+CHECKOUT_QUEUE_SIZE=8 # 処理待ちの会計の上限。超えたら503を返す
+CHECKOUT_WORKERS=2 # 会計を処理するスレッドの数(推論自体はINFERENCE_SCHEDULERでまとめる)
+
+# [デバッグ用]検出画像を描画してoutput/detected_image_XX.jpgに保存する割合(0-1)。0で保存しない
+# 保存はバックグラウンドで行う。0でも、/debug/detected_imageで最後の会計の検出画像を見られる
+DEBUG_SNAPSHOT_RATE=0.0
+DEBUG_SNAPSHOT_RING_SIZE=10 # 保存する検出画像のファイル数。古いものから上書きする
+# サーバー側で音声を再生するか(Raspberry Piにスピーカーをつないだ場合など)
+PLAY_AUDIO_ON_SERVER=True
+
+# 一食分の栄養素の目安。栄養素の割合(nutrition_ratio)の分母
+ONE_MEAL_NUTRITION:Nutrition={
+    'energy': 750,
+    'protein': 20,
+    'fat': 22,
+    'carbohydrates': 80,
+    'fiber': 8,
+    'vegetables': 100,
+}
 
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
@@ -50,9 +112,15 @@ CORS(
     )
 
 # ---メニューの読み込み
-menu_all=Menu()
+menu_all=Menu(one_meal_nutrition=ONE_MEAL_NUTRITION)
 menu_all.load_menu(MENU_CSV,encoding)
 
+# ---撮り直し用のキャッシュ
+FRAME_CACHE=FrameResultCache(ttl_seconds=FRAME_CACHE_TTL_SECONDS,max_distance=FRAME_CACHE_MAX_DISTANCE) if FRAME_CACHE_ENABLED else None
+
+# ---音声の読み込み(会計のレスポンスには、URLだけを入れる)
+VOICE_ASSETS=VoiceAssetRegistry("jph/voices")
+
 # ---最近入力されたメニューの読み込み
 menu_cache=MenuCache()
 if os.path.exists("menu_cache.json"):
@@ -63,13 +131,160 @@ else:
         f.write("[\n]")
 
 # ---モデルの読み込み
-MODEL_OSARA=Yolov9(MODEL_OSARA_WEIGHT,device=DEVICE)
-MODEL_SHOHIN=Yolov9(MODEL_SHOHIN_WEIGHT,device=DEVICE)
+# INFERENCE_WORKER_PROCESSESの場合は、ワーカープロセスだけがモデルを持つ(Webのプロセスでは読み込まない)
+if INFERENCE_CASCADE and INFERENCE_WORKER_PROCESSES > 0:
+    # カスケードはお皿の結果を待ってから商品モデルを動かすので、ワーカープロセスでは推論できない
+    raise ValueError("INFERENCE_CASCADE cannot be used with INFERENCE_WORKER_PROCESSES > 0")
+if INFERENCE_WORKER_PROCESSES > 0:
+    MODEL_OSARA, MODEL_SHOHIN = None, None
+else:
+    MODEL_OSARA=Yolov9(MODEL_OSARA_WEIGHT,device=DEVICE,imgsz=MODEL_OSARA_IMGSZ,backend=BACKEND,fast_start=MODEL_FAST_START)
+    MODEL_SHOHIN=Yolov9(MODEL_SHOHIN_WEIGHT,device=DEVICE,imgsz=MODEL_SHOHIN_IMGSZ,backend=BACKEND,fast_start=MODEL_FAST_START)
+if INFERENCE_CASCADE:
+    # 入力サイズ固定のバックエンドが選ばれた場合は、切り抜きもモデルのimgszで推論する
+    print(f"\033[36m[cascade] shohin backend: {MODEL_SHOHIN.backend}, crop size: {cascade_crop_size(MODEL_SHOHIN)}\033[0m")
 
 # セッションのためのシークレットキー
 app.secret_key = 'your_secret_key' 
 
-socketio = SocketIO(app, cors_allowed_origins="*")
+# 複数のワーカー(gunicorn)で動かすときは、SOCKETIO_MESSAGE_QUEUE(redis://...)で
+# ワーカー間のemitを中継する。ジョブ・キャッシュなどはワーカーごとに持つ(gunicorn.conf.pyの「注意」を参照)
+socketio = SocketIO(
+    app,
+    cors_allowed_origins="*",
+    message_queue=os.environ.get("SOCKETIO_MESSAGE_QUEUE"),
+)
+
+# ---メトリクス(/metrics)。段階ごとの処理時間は、STAGE_SECONDSにstageのラベルで記録する
+CHECKOUT_REQUESTS=METRICS.counter(
+    "checkout_requests_total",
+    "Checkout requests by transport and response status.",
+    labelnames=("transport", "status"),
+)
+METRICS.gauge("checkout_queue_depth", "Checkout jobs waiting in the async queue.", lambda: CHECKOUT_QUEUE.qsize())
+METRICS.gauge("inference_queue_depth", "Frames waiting for the inference scheduler.", lambda: INFERENCE_SCHEDULER.qsize())
+METRICS.gauge("side_effects_queue_depth", "Snapshots/audio waiting for the side effect worker.", lambda: SIDE_EFFECTS.qsize())
+
+def emit_checkout_result(job: Job):
+    """非同期の会計が終わったら、結果を端末のroomに送る"""
+    # キューで待っていた時間を含めた、ジョブ全体の時間
+    STAGE_SECONDS.observe(job.finished_at - job.created_at, stage="job")
+    CHECKOUT_REQUESTS.inc(transport="async", status=job.status)
+    if job.room is None:
+        return
+    socketio.emit('inference_result', job.to_dict(), to=job.room)
+
+# ---バックグラウンドのスレッド(バッチ推論・非同期の会計・副作用)
+# スレッドはforkで引き継がれないので、gunicornではfork後に各ワーカーでstart_background_workers()を呼ぶ
+INFERENCE_SCHEDULER: InferenceScheduler | InferenceWorkerPool = None
+CHECKOUT_QUEUE: JobQueue = None
+SIDE_EFFECTS: SideEffectWorker = None
+
+def start_background_workers(torch_threads: int | None = None):
+    """バックグラウンドのスレッドを起動する。起動したらreadyになる(/readyz)
+
+    Args:
+        torch_threads (int | None, optional): このプロセスで推論に使うコアの数(gunicornではコア数/ワーカー数)。
+            Noneの場合はCPUのコア数. Defaults to None.
+    """
+    global INFERENCE_SCHEDULER, CHECKOUT_QUEUE, SIDE_EFFECTS
+    if INFERENCE_WORKER_PROCESSES > 0:
+        # ---推論はワーカープロセスで行い、Webのプロセスは画像の受け取りと結果の返送だけを行う
+        # BACKEND="auto"の場合、選んだバックエンドはweightsごとに保存されるので、計測は初回だけ行う
+        INFERENCE_SCHEDULER=InferenceWorkerPool(
+            dict(weights=MODEL_OSARA_WEIGHT,device=DEVICE,imgsz=MODEL_OSARA_IMGSZ,backend=BACKEND,fast_start=MODEL_FAST_START),
+            dict(weights=MODEL_SHOHIN_WEIGHT,device=DEVICE,imgsz=MODEL_SHOHIN_IMGSZ,backend=BACKEND,fast_start=MODEL_FAST_START),
+            workers=INFERENCE_WORKER_PROCESSES,
+            max_frame_shape=INFERENCE_MAX_FRAME_SHAPE,
+            max_batch_size=INFERENCE_MAX_BATCH_SIZE,
+            torch_threads=max(1, (os.cpu_count() or 1) // INFERENCE_WORKER_PROCESSES),
+            timeout=INFERENCE_TIMEOUT_SECONDS,
+        )
+    else:
+        # 推論はスケジューラの1つのスレッドだけが行うので、お皿と商品の2つのforwardでコアを分け合う
+        configure_parallel_inference(concurrency=1, threads=torch_threads)
+        INFERENCE_SCHEDULER=InferenceScheduler(
+            MODEL_OSARA,
+            MODEL_SHOHIN,
+            max_batch_size=INFERENCE_MAX_BATCH_SIZE,
+            max_wait_ms=INFERENCE_MAX_WAIT_MS,
+        )
+
+    # ---非同期の会計用のキュー。HTTPのワーカーは、ジョブIDを返したらすぐに空く
+    CHECKOUT_QUEUE=JobQueue(
+        run_checkout_job,
+        max_queue_size=CHECKOUT_QUEUE_SIZE,
+        workers=CHECKOUT_WORKERS,
+        on_done=emit_checkout_result,
+    )
+
+    # ---検出画像の保存・音声の再生は、リクエストを待たせないようにバックグラウンドで行う
+    SIDE_EFFECTS=SideEffectWorker(
+        render=lambda frame, boxes: render_osara_shohin_result(frame, boxes, shohin_names()),
+        snapshot_rate=DEBUG_SNAPSHOT_RATE,
+        snapshot_ring_size=DEBUG_SNAPSHOT_RING_SIZE,
+        play_audio=PLAY_AUDIO_ON_SERVER,
+    )
+
+def run_checkout_job(payload: tuple) -> dict:
+    """非同期の会計(JobQueue)の本体。会計がエラー(4xx・5xx)を返した場合は、ジョブをerrorにするために例外を投げる"""
+    response, status = checkout_frame(*payload)
+    if status >= 400:
+        raise RuntimeError(response.get('error', f'checkout failed with status {status}'))
+    return response
+
+def shohin_names() -> dict[int, str]:
+    """描画に使う商品モデルのクラス名。ワーカープロセスで推論する場合は、ワーカーから受け取ったものを使う"""
+    if MODEL_SHOHIN is not None:
+        return MODEL_SHOHIN.names
+    return INFERENCE_SCHEDULER.names_shohin
+
+def stop_background_workers():
+    """バックグラウンドのスレッドを止める。受け付けた会計・副作用は処理してから止まる"""
+    global INFERENCE_SCHEDULER, CHECKOUT_QUEUE, SIDE_EFFECTS
+    # 会計がスケジューラを使うので、会計のキューから止める
+    for worker in (CHECKOUT_QUEUE, INFERENCE_SCHEDULER, SIDE_EFFECTS):
+        if worker is not None:
+            worker.close()
+    INFERENCE_SCHEDULER, CHECKOUT_QUEUE, SIDE_EFFECTS = None, None, None
+
+###############################################
+##          ヘルスチェック(gunicorn用)         ##
+###############################################
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """プロセスが動いているかを返すAPI(liveness)"""
+    return jsonify({'status': 'ok', 'pid': os.getpid()})
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """会計を受け付けられるかを返すAPI(readiness)。バックグラウンドのスレッドが動いていなければ503"""
+    ready = INFERENCE_SCHEDULER is not None and CHECKOUT_QUEUE is not None
+    return jsonify({
+        'status': 'ready' if ready else 'starting',
+        'pid': os.getpid(),
+        # ワーカープロセスで推論する場合は、設定したBACKENDを返す
+        'backend': {
+            'osara': MODEL_OSARA.backend if MODEL_OSARA is not None else BACKEND,
+            'shohin': MODEL_SHOHIN.backend if MODEL_SHOHIN is not None else BACKEND,
+        },
+        'queue_depth': CHECKOUT_QUEUE.qsize() if ready else None,
+    }), 200 if ready else 503
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """メトリクスをPrometheusのテキスト形式で返すAPI
+    
+    - checkout_stage_seconds{stage=...}: 段階ごとの処理時間のヒストグラム
+        - decode, preprocess, inference_osara, nms_osara, inference_shohin, nms_shohin,
+          detect(スケジューラの待ち時間を含む), cascade, association, menu, voice, serialization, checkout, job
+    - checkout_requests_total{transport, status}: 会計のリクエスト数
+    - frame_cache_lookups_total{result}: 撮り直し用のキャッシュのヒット・ミスの数
+    - *_queue_depth: 各キューの長さ
+    
+    値はワーカー(プロセス)ごとに持つので、全ての値にworker_pid(このワーカーのpid)のラベルをつける
+    """
+    return Response(METRICS.render(const_labels={'worker_pid': str(os.getpid())}), mimetype='text/plain; version=0.0.4')
 
 # UUIDリスト->ユーザーネームとパスワード，同一端末でのアクセスを同じUUIDでのログインにより識別する
 uuid_list = {
@@ -135,8 +350,14 @@ def start_inference():
     - リクエスト仕様
         - エンドポイント: /start_inference
         - メソッド: POST
-        - パラメータ:
-            - image: Base64形式の画像データ
+        - パラメータ(いずれか):
+            - multipart/form-data: imageフィールドにJPEG画像
+            - application/octet-stream, image/jpeg: リクエストボディがJPEG画像
+            - application/json: image: Base64形式の画像データ(従来の端末用)
+        - クエリパラメータ:
+            - async: 1の場合、ジョブIDだけを返し、結果はSocket.IOの'inference_result'でroomに送る
+            - room: 結果を送るroom(端末のUUID)。asyncのときに指定する。撮り直し用のキャッシュのキーにも使う
+            - voice: inlineの場合、音声をbase64でも返す(base64 JSONで送ってきた場合は、常にbase64でも返す)
     
     - レスポンス仕様
         - レスポンス形式: application/json
@@ -144,6 +365,7 @@ def start_inference():
             - image: Base64形式の画像データ
             - items: 検出されたメニューアイテムのリスト
             - total: 合計金額
+            - trays: MULTI_TRAYの場合、トレーごとの結果(nutrition_totals, boxes, total, voice)のリスト。左のトレーから順
     """
     
     # ----------
@@ -153,37 +375,176 @@ def start_inference():
     if request.method == "OPTIONS":
         return jsonify({"success": True})
     
-    # ---リクエストデータを取得
-    request_data = request.json
-    image_base64 = request_data.get('image')
-    frame=base64str_to_ndarray(image_base64) # base64形式の画像データをNumPy配列に変換する
+    # ---リクエストから画像を取り出す(バイナリの場合は、base64を通さずにデコードする)
+    with STAGE_SECONDS.time(stage="decode"):
+        frame=request_to_ndarray(request)
+    if frame is None:
+        CHECKOUT_REQUESTS.inc(transport="http", status="400")
+        return jsonify({'error': 'Failed to decode image'}), 400
     
     # [デバッグ用]frameを仮で保存する
     # cv2.imwrite('output/input_image.jpg', frame)
     
+    # 従来の端末(base64 JSONで送ってくる)は、音声のURLを知らないので、音声もbase64で返す
+    inline_voice = request.mimetype == 'application/json' or request.args.get('voice') == 'inline'
+    # 撮り直し用のキャッシュは、端末ごとに分ける
+    kiosk = request.args.get('room') or session.get('uuid')
+    
+    # ---非同期の場合、キューに入れてジョブIDを返す
+    if request.args.get('async') == '1':
+        try:
+            job = CHECKOUT_QUEUE.submit((frame, inline_voice, kiosk), room=request.args.get('room'))
+        except JobQueueFull:
+            # 混雑しているので、少し待ってから送り直してもらう
+            CHECKOUT_REQUESTS.inc(transport="async", status="503")
+            response = jsonify({'error': 'Server is busy', 'queue_depth': CHECKOUT_QUEUE.qsize()})
+            response.headers['Retry-After'] = '1'
+            return response, 503
+        return jsonify({'job_id': job.id, 'status': job.status, 'queue_depth': CHECKOUT_QUEUE.qsize()}), 202
+    
+    response, status = checkout_frame(frame, inline_voice, kiosk)
+    CHECKOUT_REQUESTS.inc(transport="http", status=str(status))
+    with STAGE_SECONDS.time(stage="serialization"):
+        response = jsonify(response)
+    return response, status
+
+@app.route('/inference_jobs/<job_id>', methods=['GET'])
+def get_inference_job(job_id):
+    """非同期の会計の状態・結果を返すAPI(Socket.IOを使えない端末のポーリング用)
+    
+    - レスポンスデータ:
+        - job_id: ジョブID
+        - status: queued, running, done, error
+        - result: 会計の結果(/start_inferenceと同じ形式)。done以外はnull
+        - error: エラーメッセージ
+    """
+    # ジョブはワーカーごとに持つので、別のワーカーが受け付けたジョブは404になる(端末は待ち続ける)
+    job = CHECKOUT_QUEUE.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found', 'pid': os.getpid()}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/inference_queue', methods=['GET'])
+def get_inference_queue():
+    """推論待ちの数を返すAPI。値はこのワーカー(pid)の分だけ"""
+    return jsonify({
+        'pid': os.getpid(),
+        'queue_depth': CHECKOUT_QUEUE.qsize(),
+        'max_queue_size': CHECKOUT_QUEUE.max_queue_size,
+        'scheduler_queue_depth': INFERENCE_SCHEDULER.qsize(),
+        'frame_cache': FRAME_CACHE.stats() if FRAME_CACHE is not None else None,
+    })
+
+@socketio.on('start_inference')
+def handle_start_inference(data):
+    """Socket.IOで画像を受け取り、推論を開始する。結果は'inference_result'で送信元に返す
+    
+    - data: {'image': JPEG画像のバイナリ(またはBase64形式の画像データ), 'room': 端末のUUID(任意)}
+    """
+    image = data.get('image') if isinstance(data, dict) else data
+    with STAGE_SECONDS.time(stage="decode"):
+        if isinstance(image, (bytes, bytearray)):
+            frame = bytes_to_ndarray(image)
+        elif isinstance(image, str):
+            frame = base64str_to_ndarray(image)
+        else:
+            frame = None
+    if frame is None:
+        CHECKOUT_REQUESTS.inc(transport="socketio", status="400")
+        emit('inference_result', {'error': 'Failed to decode image'})
+        return
+    
+    # 撮り直し用のキャッシュは、端末ごと(roomがなければ接続ごと)に分ける
+    kiosk = (data.get('room') if isinstance(data, dict) else None) or request.sid
+    response, status = checkout_frame(frame, inline_voice=isinstance(image, str), kiosk=kiosk)
+    CHECKOUT_REQUESTS.inc(transport="socketio", status=str(status))
+    emit('inference_result', response)
+
+def checkout_frame(frame: np.ndarray, inline_voice: bool = False, kiosk: str | None = None) -> tuple[dict, int]:
+    """画像を推論し、メニュー・合計金額・栄養素・音声をまとめる(会計の本体)
+    
+    MULTI_TRAYの場合は、画像に写った複数のトレーを1回の推論で会計し、trays(左のトレーから順)に入れる。
+    従来の端末用に、先頭のトレーの結果も今まで通りの位置に入れる
+    
+    Args:
+        frame (np.ndarray): 推論する画像
+        inline_voice (bool, optional): Trueの場合、音声のURLに加えて、音声をbase64でも返す(従来の端末用). Defaults to False.
+        kiosk (str | None, optional): 端末のID。指定した場合、撮り直しの画像には前の推論結果を使う. Defaults to None.
+    
+    Returns:
+        tuple[dict, int]: レスポンスデータと、HTTPステータスコード
+    """
+    # 会計全体の処理時間(/metricsのstage="checkout")
+    t0=time.perf_counter()
+    
     # ----------
     # ---推論・結果の取得
     # ----------
-    # ---推論する
-    inference_result=inference_osara_shohin(frame,MODEL_OSARA,MODEL_SHOHIN)
+    # ---推論する(同じ端末の撮り直しなら、前の結果を使う)
+    use_cache = FRAME_CACHE is not None and kiosk is not None
+    inference_results: list[OsaraShohinResult]=FRAME_CACHE.get(kiosk,frame) if use_cache else None
+    if inference_results is None:
+        if MULTI_TRAY:
+            inference_results=inference_osara_shohin_trays(frame,MODEL_OSARA,MODEL_SHOHIN,scheduler=INFERENCE_SCHEDULER,link_distance=TRAY_LINK_DISTANCE)
+        else:
+            inference_results=[inference_osara_shohin(frame,MODEL_OSARA,MODEL_SHOHIN,scheduler=INFERENCE_SCHEDULER,cascade=INFERENCE_CASCADE)]
+        if use_cache:
+            FRAME_CACHE.put(kiosk,frame,inference_results)
     
     # ---結果から、画像・メニューオブジェクト・合計金額を取得する
-    annotated_image=inference_result['image']
-    if annotated_image is None:
-        return jsonify({'error': 'Failed to grab frame from webcam'}), 500
+    # 描画はしていないので、imageは元画像のまま
+    if inference_results[0]['image'] is None:
+        STAGE_SECONDS.observe(time.perf_counter()-t0, stage="checkout")
+        return {'error': 'Failed to grab frame from webcam'}, 500
+    
+    # ---トレーごとに会計する
+    trays: list[dict]=[]
+    voice_paths: list[str]=[]
+    for inference_result in inference_results:
+        tray, voice_path=checkout_tray(inference_result, inline_voice)
+        trays.append(tray)
+        voice_paths.append(voice_path)
+    
+    # [デバッグ用]最後の会計を覚えておく(描画は/debug/detected_imageで必要なときだけ行う)
+    all_boxes=[box for inference_result in inference_results for box in inference_result['boxes']]
+    # 複数の会計のスレッドから書き込むので、画像と結果を1つのタプルにして1回で入れ替える
+    global LAST_INFERENCE
+    LAST_INFERENCE=(frame, all_boxes)
+    SIDE_EFFECTS.snapshot(frame, all_boxes)
+    
+    # ---音声を再生する
+    # NOTE: 本来はブラウザから音声が再生されるが、
+    # Raspberry Piにはスピーカーが付いていないため、
+    # サーバー側で音声を再生する……
+    
+    # バックグラウンドで再生する(レスポンスは待たせない)。複数トレーの場合は、先頭のトレーの音声だけ
+    SIDE_EFFECTS.play_audio("./"+voice_paths[0])
+        
+    # ---レスポンスを返す
+    # OsaraShohinResultとほぼ同じ形式で返す
+    response={**trays[0]}
+    if MULTI_TRAY:
+        response['trays']=trays
+    STAGE_SECONDS.observe(time.perf_counter()-t0, stage="checkout")
+    return response, 200
+
+def checkout_tray(inference_result: OsaraShohinResult, inline_voice: bool = False) -> tuple[dict, str]:
+    """1つのトレーの推論結果から、メニュー・合計金額・栄養素・音声をまとめる
+    
+    Args:
+        inference_result (OsaraShohinResult): 1つのトレーの推論結果
+        inline_voice (bool, optional): Trueの場合、音声をbase64でも返す. Defaults to False.
+    
+    Returns:
+        tuple[dict, str]: トレーのレスポンスデータと、音声ファイルのパス
+    """
     # menu_objects=menu_all.find_menu_by_OsaraShohinResult(inference_result)
+    t_menu=time.perf_counter()
     new_osresult=menu_all.find_menu_by_OsaraShohinResult(inference_result)
     
-    # [デバッグ用]検出画像を保存する
-    cv2.imwrite('output/detected_image.jpg', annotated_image)
-    
     # ----------
     # ---値の返却
     # ----------
-    # ---アノテーション結果をBase64形式にエンコード
-    _, buffer = cv2.imencode('.jpg', annotated_image)
-    image_base64 = base64.b64encode(buffer).decode('utf-8')
-    
     # `detected_items` がリストであることを確認し、空なら空リストにする
     # menu_objects = menu_objects if menu_objects else []
     
@@ -200,93 +561,75 @@ def start_inference():
     for item in menu_objects:
         total_price += item['price']
 
-    # ---各合計の栄養素を計算
-    nutrition_totals:Nutrition = {
-        'energy': 0,
-        'protein': 0,
-        'fat': 0,
-        'carbohydrates': 0,
-        'fiber': 0,
-        'vegetables': 0,
-    }
-
-    for item in menu_objects:
-        nutrition = item.get('nutrition')
-        # 各栄養素の合計値を更新
-        if nutrition.get('energy'):
-            nutrition_totals['energy'] += float(nutrition['energy'])
-        if nutrition.get('protein'):
-            nutrition_totals['protein'] += float(nutrition['protein'])
-        if nutrition.get('fat'):
-            nutrition_totals['fat'] += float(nutrition['fat'])
-        if nutrition.get('carbohydrates'):
-            nutrition_totals['carbohydrates'] += float(nutrition['carbohydrates'])
-        if nutrition.get('fiber'):
-            nutrition_totals['fiber'] += float(nutrition['fiber'])
-        if nutrition.get('vegetables'):
-            nutrition_totals['vegetables'] += float(nutrition['vegetables'])
-            
-    # ---一食分の栄養素に占める割合を計算
-    ONE_MEAL_NUTRITION = {
-        'energy': 750,
-        'protein': 20,
-        'fat': 22,
-        'carbohydrates': 80,
-        'fiber': 8,
-        'vegetables': 100,
-    }
-        
-    nutrition_ratio ={
-        "energy": nutrition_totals['energy'] / ONE_MEAL_NUTRITION['energy'],
-        "protein": nutrition_totals['protein'] / ONE_MEAL_NUTRITION['protein'],
-        "fat": nutrition_totals['fat'] / ONE_MEAL_NUTRITION['fat'],
-        "carbohydrates": nutrition_totals['carbohydrates'] / ONE_MEAL_NUTRITION['carbohydrates'],
-        "fiber": nutrition_totals['fiber'] / ONE_MEAL_NUTRITION['fiber'],
-        "vegetables": nutrition_totals['vegetables'] / ONE_MEAL_NUTRITION['vegetables'],
-    }
+    # ---栄養素の合計と、一食分の栄養素に占める割合を計算する
+    # 栄養素はメニューの読み込み時に数値の行列にしてあるので、まとめて足すだけ
+    nutrition_totals_vector=menu_all.nutrition_totals(menu_objects)
+    nutrition_totals:Nutrition=vector_to_nutrition(nutrition_totals_vector)
+    nutrition_ratio:Nutrition=vector_to_nutrition(menu_all.nutrition_ratio(nutrition_totals_vector))
+    STAGE_SECONDS.observe(time.perf_counter()-t_menu, stage="menu")
     
     # ---[JPHacks用]音声を選び、エンコード・返却する
-    voice_data=choose_voice(menu_objects,nutrition_ratio)
-    voice_base64=encode_voice_data(voice_data)
-    
-    # ---音声を再生する
-    # NOTE: 本来はブラウザから音声が再生されるが、
-    # Raspberry Piにはスピーカーが付いていないため、
-    # サーバー側で音声を再生する……
+    # 音声は起動時に読み込んだものを、URLで返す(端末側でキャッシュされる)
+    with STAGE_SECONDS.time(stage="voice"):
+        voice_data=choose_voice(menu_objects,nutrition_ratio)
+        voice_asset=VOICE_ASSETS.find_by_path(voice_data['voice_path'])
+        voice_response={
+            "text": voice_data["voice"],
+            "id": voice_asset.id if voice_asset else None,
+            "url": voice_asset.url if voice_asset else None,
+        }
+        if inline_voice or voice_asset is None:
+            voice_response["base64"]=voice_asset.base64 if voice_asset else encode_voice_data(voice_data)
     
-    # エクスプローラーで音声ファイルを開く
-    audio_path="./"+voice_data['voice_path']
-    os.system(f"start {audio_path}")
-        
-    # ---レスポンスを返す
-    # OsaraShohinResultとほぼ同じ形式で返す
-    return jsonify({
+    return {
         # 'image': image_base64,
         'nutrition_totals': nutrition_totals,
-        "boxes": new_osresult["boxes"],
+        "boxes": new_osresult["boxes"].to_json(),
         'total': total_price,
-        "voice": {
-            "text": voice_data["voice"],
-            "base64": voice_base64
-        }
-    })
+        "voice": voice_response
+    }, voice_data['voice_path']
 
 ###############################################
-##             撮影画像補正               ##
+##                 音声の配信                  ##
 ###############################################
-def base64str_to_ndarray(base64str:str)->np.ndarray:
-    """
-    base64形式の画像データを、cv2で使えるNumPy配列に変換する
-    """
+@app.route('/voices', methods=['GET'])
+def list_voices():
+    """全ての音声のIDとURLを返すAPI(端末が起動時に先読みする用)"""
+    return jsonify([{'id': asset.id, 'url': asset.url} for asset in VOICE_ASSETS.assets()])
+
+@app.route('/voices/<voice_id>.wav', methods=['GET'])
+def get_voice(voice_id):
+    """音声を返すAPI。IDは中身のハッシュなので、ずっとキャッシュしてよい"""
+    asset = VOICE_ASSETS.get(voice_id)
+    if asset is None:
+        abort(404)
+    headers = {
+        'ETag': asset.etag,
+        'Cache-Control': 'public, max-age=31536000, immutable',
+    }
+    if asset.etag in request.headers.get('If-None-Match', ''):
+        return Response(status=304, headers=headers)
+    return Response(asset.data, mimetype=asset.mimetype, headers=headers)
+
+###############################################
+##         [デバッグ用]検出画像の確認          ##
+###############################################
+# 最後の会計の(元画像, 結果)。描画は/debug/detected_imageが呼ばれたときだけ行う
+LAST_INFERENCE: tuple[np.ndarray | None, list] = (None, [])
 
-    # データURIスキームの場合、最初のコンマ以降を取り出す
-    if base64str.startswith('data:image'):
-        base64str = base64str.split(',')[1]
-    image_bytes = base64.b64decode(base64str)
-    np_array = np.frombuffer(image_bytes, np.uint8)
-    cv2_image = cv2.imdecode(np_array, cv2.IMREAD_COLOR)
+@app.route('/debug/detected_image', methods=['GET'])
+def debug_detected_image():
+    """最後の会計の検出結果を描画した画像を返すAPI
     
-    return cv2_image
+    - レスポンス仕様
+        - レスポンス形式: image/jpeg
+    """
+    frame, boxes=LAST_INFERENCE  # 同じ会計の画像と結果を、1回で読む
+    if frame is None:
+        abort(404, description="まだ会計されていません")
+    annotated_image=render_osara_shohin_result(frame, boxes, shohin_names())
+    _, buffer = cv2.imencode('.jpg', annotated_image)
+    return Response(buffer.tobytes(), mimetype='image/jpeg')
 
 # ----------
 # ---メニューの検索用API
@@ -302,11 +645,15 @@ def search_menu():
         - パラメータ:
             - key: 検索キー。display_name, romaji, yolo_name, jan_code, priceのいずれか
             - value: 検索値
+            - limit: (任意)返す最大件数。デフォルトはMENU_SEARCH_LIMIT。display_name, romajiの場合だけ
+            - prefix: (任意)1の場合、名前または単語の前方一致だけを返す。display_name, romajiの場合だけ
             
     - レスポンス仕様
         - レスポンス形式: application/json
         - レスポンスデータ:
             - 検索結果のリスト(list[MenuObject])
+            - display_name, romajiの場合は、完全一致 → 前方一致 → 単語の前方一致 → 部分一致の順
+              (全角・半角、ひらがな・カタカナ、大文字・小文字を区別しない)
     """
     # ---検索クエリを取得する
     # クエリは小文字に変換しておく
@@ -319,7 +666,13 @@ def search_menu():
         return jsonify([])
 
     # ---メニューを検索する
-    search_results=menu_all.find_menu_by_kv(key, value,search_type="partial")
+    if key in SEARCH_FIELDS:
+        # 名前は検索インデックスから、順位の高い順にlimit件だけ返す
+        limit=request.args.get('limit', MENU_SEARCH_LIMIT, type=int)
+        prefix=request.args.get('prefix', '0')=='1'
+        search_results=menu_all.search_menu(value, fields=(key,), limit=limit, prefix=prefix)
+    else:
+        search_results=menu_all.find_menu_by_kv(key, value,search_type="partial")
 
     return jsonify(search_results)
 
@@ -546,7 +899,9 @@ def run_hit_script():
         return jsonify({'error': str(e)}), 500
 
 # 最後に実行する必要あり
+# 本番(複数ワーカー)では、gunicorn.conf.pyを参照
 if __name__ == '__main__':
+    start_background_workers()
     app.run(
         use_reloader=False,
         host='0.0.0.0', 
@@ -0,0 +1,100 @@
+"""
+# bench_association.py
+お皿と料理の紐づけ(assign_osara_shohin)を、合成したトレーで計測する。
+以前の貪欲法(お皿の順番に、距離内で最も信頼度が高い料理を選ぶ)と、処理時間・紐づいた数・距離の合計を比べる。
+
+## 使い方
+```sh
+python -m benchmarks.bench_association --plates 1 5 10 50 --dishes 4 20 50 200
+```
+"""
+
+import argparse
+
+import numpy as np
+
+from benchmarks.common import measure, summarize
+from modules.inference import (
+    OSARA_SHOHIN_DISTANCE_THRESHOLD,
+    association_cost_matrix,
+    assign_osara_shohin,
+)
+
+
+def synthetic_tray(
+    n_plates: int, n_dishes: int, rng: np.random.Generator
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """お皿と、お皿の近くに散らばった料理のbbox(0-1)を作る
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: お皿のxyxy, 料理のxyxy, 料理の信頼度
+    """
+    plate_size = min(0.3, 1.0 / np.sqrt(max(n_plates, 1)))
+    plate_centers = rng.uniform(plate_size / 2, 1 - plate_size / 2, size=(n_plates, 2))
+    plates = np.concatenate(
+        [plate_centers - plate_size / 2, plate_centers + plate_size / 2], axis=1
+    )
+
+    # 料理は、いずれかのお皿の中心の近くに置く(誤検出として、ばらばらの位置のものも混ぜる)
+    owners = rng.integers(0, n_plates, size=n_dishes)
+    dish_centers = plate_centers[owners] + rng.normal(0, plate_size / 4, size=(n_dishes, 2))
+    noise = rng.random(n_dishes) < 0.2
+    dish_centers[noise] = rng.uniform(0, 1, size=(int(noise.sum()), 2))
+    dish_size = plate_size * 0.6
+    dishes = np.clip(
+        np.concatenate([dish_centers - dish_size / 2, dish_centers + dish_size / 2], axis=1),
+        0,
+        1,
+    )
+    return plates.astype(np.float32), dishes.astype(np.float32), rng.random(n_dishes).astype(np.float32)
+
+
+def greedy_assign(
+    plates: np.ndarray,
+    dishes: np.ndarray,
+    conf: np.ndarray,
+    distance_threshold: float = OSARA_SHOHIN_DISTANCE_THRESHOLD,
+) -> tuple[np.ndarray, np.ndarray]:
+    """比較用の、以前の貪欲法による紐づけ"""
+    distances = association_cost_matrix(plates, dishes)
+    associated = np.zeros(len(dishes), dtype=bool)
+    pairs: list[tuple[int, int]] = []
+    for i, row in enumerate(distances):
+        candidates = (row < distance_threshold) & ~associated
+        if not candidates.any():
+            continue
+        j = int(np.where(candidates, conf, -np.inf).argmax())
+        pairs.append((i, j))
+        associated[j] = True
+    if not pairs:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    osara_indices, shohin_indices = np.array(pairs).T
+    return osara_indices, shohin_indices
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--plates", type=int, nargs="+", default=[1, 5, 10, 50])
+    parser.add_argument("--dishes", type=int, nargs="+", default=[4, 20, 50, 200])
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    print("plates, dishes, method, pairs, total distance")
+    for n_plates in args.plates:
+        for n_dishes in args.dishes:
+            plates, dishes, conf = synthetic_tray(n_plates, n_dishes, rng)
+            distances = association_cost_matrix(plates, dishes)
+            for name, fn in (
+                ("greedy", lambda: greedy_assign(plates, dishes, conf)),
+                ("optimal", lambda: assign_osara_shohin(plates, dishes)),
+            ):
+                osara_indices, shohin_indices = fn()
+                total = float(distances[osara_indices, shohin_indices].sum())
+                print(f"{n_plates}, {n_dishes}, {name}, {len(osara_indices)}, {total:.3f}")
+                summarize(f"{name} {n_plates}x{n_dishes}", measure(fn, args.repeat))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+# bench_menu_lookup.py
+メニューの検索(find_menu_by_kvの完全一致、価格の範囲検索)を、大学全体の食堂を想定した
+合成メニュー(既定で5,000品)で計測する。以前の全件走査と、load_menuで作るインデックスを比べる。
+
+## 使い方
+```sh
+python -m benchmarks.bench_menu_lookup --items 5000 --cafeterias 20
+```
+"""
+
+import argparse
+import csv
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.common import measure, summarize
+from modules.menu import Menu
+
+CSV_HEADER = (
+    "料理コード", "JANコード", "お客様向け名称", "ローマ字", "販売価格(税込)",
+    "エネルギー", "タンパク質", "脂質", "炭水化物", "食塩相当量", "野菜量", "検出名",
+)
+
+
+def write_synthetic_menu(path: str, n_items: int, n_cafeterias: int, rng: np.random.Generator):
+    """食堂ごとに料理を並べた合成メニューのCSVを書き出す。
+    3品に1品は小・中・大のサイズ違いにして、同じ検出名(yolo_name)を共有させる"""
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(CSV_HEADER)
+        i = 0
+        dish = 0
+        while i < n_items:
+            cafeteria = dish % n_cafeterias
+            sizes = ("小", "中", "大") if dish % 3 == 0 else ("",)
+            for size in sizes[: n_items - i]:
+                menu_code = 100000 + cafeteria * 10000 + i
+                writer.writerow([
+                    menu_code,
+                    f"{2000000000000 + menu_code}",
+                    f"{size}料理{dish}",
+                    f"{size}RYOURI {dish}",
+                    int(rng.integers(50, 1000)),
+                    *np.round(rng.uniform(0, 100, size=6), 1).tolist(),
+                    f"dish_{cafeteria}_{dish}",
+                ])
+                i += 1
+            dish += 1
+
+
+def scan_by_kv(menu: Menu, key: str, value: str) -> list:
+    """比較用の、以前の全件走査による完全一致の検索"""
+    return [
+        menu_object
+        for menu_object in menu.menu.values()
+        if menu_object[key] == str(value)
+    ]
+
+
+def scan_by_price_range(menu: Menu, min_price: int, max_price: int) -> list:
+    """比較用の、全件走査による価格の範囲検索"""
+    return [
+        menu_object
+        for menu_object in menu.menu.values()
+        if min_price <= menu_object["price"] <= max_price
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=5000, help="メニューの品数")
+    parser.add_argument("--cafeterias", type=int, default=20, help="食堂の数")
+    parser.add_argument("--lookups", type=int, default=20, help="1トレーあたりの検索回数(検出された料理の数)")
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "menu.csv")
+        write_synthetic_menu(path, args.items, args.cafeterias, rng)
+        menu = Menu()
+        t0 = time.perf_counter()
+        menu.load_menu(path)
+        print(f"load_menu ({len(menu.menu)} items): {(time.perf_counter() - t0) * 1e3:.1f}ms")
+
+    menu_objects = list(menu.menu.values())
+    picks = [menu_objects[i] for i in rng.integers(0, len(menu_objects), size=args.lookups)]
+    for key in ("menu_code", "jan_code", "yolo_name"):
+        values = [menu_object[key] for menu_object in picks]
+        # 結果が同じことを確かめてから計測する
+        for value in values:
+            assert scan_by_kv(menu, key, value) == menu.find_menu_by_kv(key, value)
+        summarize(
+            f"scan {key} x{args.lookups}",
+            measure(lambda: [scan_by_kv(menu, key, value) for value in values], args.repeat),
+        )
+        summarize(
+            f"index {key} x{args.lookups}",
+            measure(lambda: [menu.find_menu_by_kv(key, value) for value in values], args.repeat),
+        )
+
+    ranges = [(300, 400), (0, 100), (900, 1000)]
+    for min_price, max_price in ranges:
+        assert {id(m) for m in scan_by_price_range(menu, min_price, max_price)} == {
+            id(m) for m in menu.find_menu_by_price_range(min_price, max_price)
+        }
+    summarize(
+        f"scan price range x{len(ranges)}",
+        measure(lambda: [scan_by_price_range(menu, *r) for r in ranges], args.repeat),
+    )
+    summarize(
+        f"index price range x{len(ranges)}",
+        measure(lambda: [menu.find_menu_by_price_range(*r) for r in ranges], args.repeat),
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+# bench_menu_resolve.py
+検出した料理のラベル・お皿の種類・面積からメニューを決める処理を計測する。
+以前の1bboxずつの方法(候補を検索 → classify_by_size → display_nameの先頭で候補を探す)と、
+load_menuで作る表(resolution_table)を使ってトレーの全てのbboxをまとめて決める方法
+(Menu.resolve_menu_objects)を比べる。
+
+合成メニュー(bench_menu_lookupと同じ)では、サイズ違いが検出名(yolo_name)を共有するので、
+サイズの閾値の設定ファイルのkeyをyolo_nameにして計測する。
+
+## 使い方
+```sh
+python -m benchmarks.bench_menu_resolve --items 5000 --boxes 5 20 100
+```
+"""
+
+import argparse
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from benchmarks.bench_menu_lookup import write_synthetic_menu
+from benchmarks.common import measure, summarize
+from modules.menu import DEFAULT_SIZE_THRESHOLDS_PATH, Menu, load_size_thresholds, unknown_menu_object
+
+
+def legacy_resolve(menu: Menu, labels: list, osara_types: list, areas: list) -> list:
+    """比較用の、以前の1bboxずつの方法"""
+    thresholds = menu.size_thresholds["osara_types"]
+    results = []
+    for label, osara_type, area in zip(labels, osara_types, areas):
+        if label is None:
+            results.append(None)
+            continue
+        candidates = menu.find_menu_by_kv(menu.size_thresholds["key"], label)
+        if len(candidates) > 1:
+            size = menu.classify_by_size(area, thresholds[osara_type]) if osara_type in thresholds else ""
+            results.append(next((c for c in candidates if c["display_name"].startswith(size)), None))
+        elif len(candidates) == 1:
+            results.append(candidates[0])
+        else:
+            results.append(unknown_menu_object())
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=5000, help="メニューの品数")
+    parser.add_argument("--cafeterias", type=int, default=20, help="食堂の数")
+    parser.add_argument("--boxes", type=int, nargs="+", default=[5, 20, 100], help="1トレーのbboxの数")
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "menu.csv")
+        write_synthetic_menu(path, args.items, args.cafeterias, rng)
+        config = load_size_thresholds(DEFAULT_SIZE_THRESHOLDS_PATH)
+        config["key"] = "yolo_name"
+        with open(os.path.splitext(path)[0] + ".sizes.json", "w", encoding="utf-8") as f:
+            json.dump(config, f, ensure_ascii=False)
+        menu = Menu()
+        menu.load_menu(path)
+
+    yolo_names = list(menu.kv_index["yolo_name"])
+    osara_type_names = [*menu.size_thresholds["osara_types"], "OTHER"]
+    for n_boxes in args.boxes:
+        labels = np.array(
+            [yolo_names[i] for i in rng.integers(0, len(yolo_names), size=n_boxes)] + [None, "not_in_menu"],
+            dtype=object,
+        )
+        osara_types = np.array(
+            [osara_type_names[i] for i in rng.integers(0, len(osara_type_names), size=len(labels))], dtype=object
+        )
+        areas = rng.uniform(0.0, 0.3, size=len(labels))
+        areas[:3] = [0.02441, 0.03906, 0.1953]  # 閾値ちょうどの面積も混ぜる
+
+        # 結果が同じことを確かめてから計測する(unknownは毎回作るので、display_nameで比べる)
+        expected = legacy_resolve(menu, labels.tolist(), osara_types.tolist(), areas.tolist())
+        resolved = menu.resolve_menu_objects(labels, osara_types, areas)
+        assert [m and m["display_name"] for m in expected] == [m and m["display_name"] for m in resolved]
+
+        summarize(
+            f"legacy {n_boxes} boxes",
+            measure(lambda: legacy_resolve(menu, labels.tolist(), osara_types.tolist(), areas.tolist()), args.repeat),
+        )
+        summarize(
+            f"table {n_boxes} boxes",
+            measure(lambda: menu.resolve_menu_objects(labels, osara_types, areas), args.repeat),
+        )
+
+
+if __name__ == "__main__":
+    main()
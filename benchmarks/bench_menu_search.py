@@ -0,0 +1,89 @@
+"""
+# bench_menu_search.py
+/search_menuの部分一致検索を、メニュー数を増やしながら計測する。
+以前の全件の部分文字列の比較と、MenuSearchIndex(bigramの転置インデックス・トライ木)を比べ、
+メニュー数が増えても1回の検索時間がほぼ変わらないかを確かめる。
+
+ラベル付けの画面で1文字ずつ入力する場合を想定して、クエリの先頭から1文字ずつ伸ばしながら検索する。
+一致する件数が多いクエリ(SINGLE_QUERIES)1回ずつの時間も計測し、limitで検索時間が決まるかを確かめる。
+
+## 使い方
+```sh
+python -m benchmarks.bench_menu_search --items 1000 5000 20000 50000
+```
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from benchmarks.common import measure, summarize
+from modules.MenuSearch import MenuSearchIndex
+
+# 料理名の部品(カタカナ・漢字・ひらがなを混ぜる)
+NAME_PARTS = (
+    ("カレー", "KARE"), ("うどん", "UDON"), ("そば", "SOBA"), ("ラーメン", "RAMEN"),
+    ("カツ", "KATSU"), ("丼", "DON"), ("唐揚げ", "KARAAGE"), ("定食", "TEISHOKU"),
+    ("サラダ", "SARADA"), ("味噌汁", "MISOSHIRU"), ("自家製", "JIKASEI"), ("チキン", "CHIKIN"),
+    ("オムライス", "OMURAISU"), ("ハンバーグ", "HANBAGU"), ("焼き魚", "YAKIZAKANA"), ("豚汁", "TONJIRU"),
+)
+QUERIES = ("カレー", "ｶﾂ", "からあげ", "omu", "ていしょく")
+# 一致する件数が多いクエリ(メニュー数に比例して一致する)
+SINGLE_QUERIES = ("か", "カレ")
+
+
+def synthetic_menu(n_items: int, rng: np.random.Generator) -> list[dict]:
+    """料理名の部品を組み合わせた合成メニューを作る"""
+    menu_objects = []
+    for i in range(n_items):
+        parts = [NAME_PARTS[j] for j in rng.choice(len(NAME_PARTS), size=int(rng.integers(1, 4)), replace=False)]
+        menu_objects.append(
+            {
+                "menu_code": str(100000 + i),
+                "display_name": "".join(name for name, _ in parts) + f"{i % 97}",
+                "romaji": " ".join(romaji for _, romaji in parts) + f" {i % 97}",
+            }
+        )
+    return menu_objects
+
+
+def scan_partial(menu_objects: list[dict], key: str, value: str) -> list[dict]:
+    """比較用の、以前の全件走査による部分一致の検索"""
+    return [menu_object for menu_object in menu_objects if str(value) in menu_object[key]]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, nargs="+", default=[1000, 5000, 20000, 50000], help="メニューの品数")
+    parser.add_argument("--limit", type=int, default=50, help="返す最大件数")
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    for n_items in args.items:
+        menu_objects = synthetic_menu(n_items, rng)
+        t0 = time.perf_counter()
+        index = MenuSearchIndex(menu_objects)
+        print(f"build index ({n_items} items): {(time.perf_counter() - t0) * 1e3:.1f}ms")
+
+        # 1文字ずつ入力したときのクエリ
+        keystrokes = [query[:i] for query in QUERIES for i in range(1, len(query) + 1)]
+        summarize(
+            f"scan {n_items} items x{len(keystrokes)} keystrokes",
+            measure(lambda: [scan_partial(menu_objects, "display_name", q) for q in keystrokes], args.repeat),
+        )
+        summarize(
+            f"index {n_items} items x{len(keystrokes)} keystrokes",
+            measure(lambda: [index.search(q, limit=args.limit) for q in keystrokes], args.repeat),
+        )
+        for query in SINGLE_QUERIES:
+            summarize(
+                f"index {n_items} items {query!r}",
+                measure(lambda: index.search(query, limit=args.limit), args.repeat),
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+# bench_osara_shohin.py
+お皿・商品モデルを順番に推論した場合と、detect_osara_shohin(前処理共有+並行推論)、
+detect_osara_shohin_cascade(お皿の切り抜きだけを商品モデルで推論)の処理時間を比較する。
+カスケードはお皿の数で処理時間が変わるので、実際のトレー画像(--image)で計測する。
+
+## 使い方
+```sh
+python -m benchmarks.bench_osara_shohin --osara ./weights/osara.pt --shohin ./weights/shohin.pt
+```
+"""
+
+import argparse
+
+from benchmarks.common import load_frame, measure, summarize
+from modules.inference import detect_osara_shohin, detect_osara_shohin_cascade
+from Yolov9Wrapper.Yolov9Wrapper import Yolov9
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--osara", required=True, help="お皿モデルのパス")
+    parser.add_argument("--shohin", required=True, help="商品モデルのパス")
+    parser.add_argument("--image", default=None, help="画像のパス。なければランダム画像")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    model_osara = Yolov9(args.osara, device=args.device)
+    model_shohin = Yolov9(args.shohin, device=args.device)
+    frame = load_frame(args.image)
+
+    def sequential():
+        model_osara.predict_frame(frame)
+        model_shohin.predict_frame(frame)
+
+    before = summarize("sequential", measure(sequential, args.repeat))
+    after = summarize(
+        "detect_osara_shohin",
+        measure(lambda: detect_osara_shohin(frame, model_osara, model_shohin), args.repeat),
+    )
+    print(f"speedup(mean): x{before['mean'] / after['mean']:.2f}")
+
+    _, result_shohin, _ = detect_osara_shohin_cascade(frame, model_osara, model_shohin)
+    cascade = summarize(
+        f"detect_osara_shohin_cascade ({len(result_shohin['boxes'])} dishes)",
+        measure(
+            lambda: detect_osara_shohin_cascade(frame, model_osara, model_shohin),
+            args.repeat,
+        ),
+    )
+    print(f"speedup(mean, cascade): x{before['mean'] / cascade['mean']:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+# bench_postprocess.py
+NMS後の処理について、従来のbboxごとのPythonループと、Yolov9._build_result(tensor演算でまとめて処理)を比較する。
+モデルは使わず、ランダムな検出結果で計測する。
+
+## 使い方
+```sh
+python -m benchmarks.bench_postprocess --counts 10 100 1000
+```
+"""
+
+import argparse
+
+import numpy as np
+import torch
+
+from benchmarks.common import measure, summarize
+from Yolov9Wrapper.Yolov9Wrapper import Yolov9
+from yolov9.utils.general import scale_boxes, xyxy2xywh
+
+
+def random_det(n: int, im_shape=(480, 640), nc=80) -> torch.Tensor:
+    """ランダムな検出結果(n, 6)を作る"""
+    g = torch.Generator().manual_seed(0)
+    xy = torch.rand(n, 2, generator=g) * torch.tensor([im_shape[1], im_shape[0]])
+    wh = torch.rand(n, 2, generator=g) * 100
+    conf = torch.rand(n, 1, generator=g)
+    cls = torch.randint(0, nc, (n, 1), generator=g).float()
+    return torch.cat([xy, xy + wh, conf, cls], dim=1)
+
+
+def legacy_postprocess(det: torch.Tensor, im_shape, im0: np.ndarray, names) -> list[dict]:
+    """従来の(bboxごとにtensorを作る)処理"""
+    gn = torch.tensor(im0.shape)[[1, 0, 1, 0]]
+    box_results = []
+    det[:, :4] = scale_boxes(im_shape, det[:, :4], im0.shape).round()
+    for *xyxy, conf, cls in reversed(det):
+        x_sorted = sorted([xyxy[0], xyxy[2]])
+        y_sorted = sorted([xyxy[1], xyxy[3]])
+        new_xyxy = [x_sorted[0], y_sorted[0], x_sorted[1], y_sorted[1]]
+        xywh = (xyxy2xywh(torch.tensor(new_xyxy).view(1, 4)) / gn).view(-1).tolist()
+        normalized_xyxy = (torch.tensor(new_xyxy).view(1, 4) / gn).view(-1).tolist()
+        box_results.append(
+            {"label": names[int(cls)], "confidence": float(conf), "xyxy": normalized_xyxy}
+        )
+    return box_results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--counts", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    names = {i: f"class{i}" for i in range(80)}
+    im0 = np.zeros((480, 640, 3), dtype=np.uint8)
+    im_shape = (480, 640)
+
+    # モデルを読み込まずに、_build_resultだけを使う
+    model = Yolov9.__new__(Yolov9)
+    model.names = names
+
+    for n in args.counts:
+        det = random_det(n)
+        summarize(
+            f"legacy n={n}",
+            measure(lambda: legacy_postprocess(det.clone(), im_shape, im0, names), args.repeat),
+        )
+        summarize(
+            f"vectorized n={n}",
+            measure(
+                lambda: model._build_result(det.clone(), im_shape, im0, "", annotate=False),
+                args.repeat,
+            ),
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+"""
+# bench_predict_frame.py
+従来のpredict_image(LoadImages経由)と、predict_frame(np.ndarrayを直接推論)の処理時間を比較する。
+
+## 使い方
+```sh
+python -m benchmarks.bench_predict_frame --weights ./weights/osara.pt --image ./sample.jpg
+```
+"""
+
+import argparse
+
+from benchmarks.common import load_frame, measure, summarize
+from Yolov9Wrapper.Yolov9Wrapper import Yolov9
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--weights", required=True, help="モデルのパス")
+    parser.add_argument("--image", default=None, help="画像のパス。なければランダム画像")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    model = Yolov9(args.weights, device=args.device)
+    frame = load_frame(args.image)
+
+    before = summarize(
+        "predict_image", measure(lambda: model.predict_image(frame), args.repeat)
+    )
+    after = summarize(
+        "predict_frame", measure(lambda: model.predict_frame(frame), args.repeat)
+    )
+    print(f"speedup(mean): x{before['mean'] / after['mean']:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+# bench_result_types.py
+お皿と料理の紐づけ結果について、従来のlist[OsaraShohinResultBox](dictのリスト・associatedフラグ)と、
+OsaraShohinBoxes(列ごとの配列・インデックスでの紐づけ)のメモリ使用量とJSON化の時間を比較する。
+モデルは使わず、ランダムな検出結果で計測する。
+
+## 使い方
+```sh
+python -m benchmarks.bench_result_types --counts 10 100 1000
+```
+"""
+
+import argparse
+import json
+import tracemalloc
+
+import numpy as np
+
+from benchmarks.common import measure, summarize
+from modules.inference import associate_osara_shohin
+from modules.Types import OsaraShohinBoxes, OsaraShohinResultBox
+from Yolov9Wrapper.Yolov9Wrapper import Yolov9Detections
+
+
+def random_detections(n: int, names: dict[int, str], seed: int) -> Yolov9Detections:
+    """ランダムな検出結果を作る"""
+    rng = np.random.default_rng(seed)
+    xy = rng.random((n, 2), dtype=np.float32) * 0.9
+    wh = rng.random((n, 2), dtype=np.float32) * 0.1
+    return Yolov9Detections(
+        np.concatenate([xy, xy + wh], axis=1),
+        rng.random(n, dtype=np.float32),
+        rng.integers(0, len(names), n),
+        names,
+    )
+
+
+def legacy_association(osara_boxes: list[dict], shohin_boxes: list[dict]) -> list[OsaraShohinResultBox]:
+    """従来の(dictにassociatedフラグを立てる)紐づけと、返却用の形式への変換"""
+    result_boxes: list[OsaraShohinResultBox] = []
+    for osara in osara_boxes:
+        ox = osara["xyxy"]
+        osara_center = ((ox[0] + ox[2]) / 2, (ox[1] + ox[3]) / 2)
+        candidate = None
+        max_confidence = -float("inf")
+        for shohin in shohin_boxes:
+            if "associated" in shohin:
+                continue
+            sx = shohin["xyxy"]
+            distance = np.sqrt(
+                (osara_center[0] - (sx[0] + sx[2]) / 2) ** 2
+                + (osara_center[1] - (sx[1] + sx[3]) / 2) ** 2
+            )
+            if distance < 0.3 and shohin["confidence"] > max_confidence:
+                max_confidence = shohin["confidence"]
+                candidate = shohin
+        if candidate is not None:
+            candidate["associated"] = True
+            box = candidate
+        else:
+            box = osara
+        result_boxes.append(
+            {
+                "label": candidate["label"] if candidate is not None else None,
+                "osara_type": osara["label"],
+                "confidence": box["confidence"],
+                "xyxy": box["xyxy"],
+                "menu_object": None,
+            }
+        )
+    for box in shohin_boxes:
+        box.pop("associated", None)
+    return result_boxes
+
+
+def peak_memory(fn) -> float:
+    """fnの実行中に確保されたメモリのピーク(KiB)を返す"""
+    tracemalloc.start()
+    result = fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return peak / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--counts", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    names = {i: f"class{i}" for i in range(80)}
+    for n in args.counts:
+        osara = random_detections(n, {0: "DON", 1: "CURRY", 2: "RICE"}, seed=0)
+        shohin = random_detections(n, names, seed=1)
+        osara_list, shohin_list = osara.to_list(), shohin.to_list()
+
+        def legacy():
+            return legacy_association(osara_list, shohin_list)
+
+        def array_backed():
+            return OsaraShohinBoxes.from_association(
+                osara, shohin, associate_osara_shohin(osara, shohin)
+            )
+
+        legacy_boxes, boxes = legacy(), array_backed()
+        assert legacy_boxes == boxes.to_json(), "results differ"
+
+        print(f"--- n={n}")
+        print(f"legacy memory: {peak_memory(legacy):.1f}KiB")
+        print(f"array memory: {peak_memory(array_backed):.1f}KiB")
+        summarize(f"legacy associate n={n}", measure(legacy, args.repeat))
+        summarize(f"array associate n={n}", measure(array_backed, args.repeat))
+        summarize(
+            f"legacy json n={n}", measure(lambda: json.dumps(legacy_boxes), args.repeat)
+        )
+        summarize(
+            f"array json n={n}", measure(lambda: json.dumps(boxes.to_json()), args.repeat)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+# bench_scheduler.py
+InferenceSchedulerのmax_batch_size・max_wait_msを変えながら、同時に複数端末から推論した場合の
+スループットと遅延を計測する。max_batch_size=1が、従来の1枚ずつの推論に相当する。
+
+## 使い方
+```sh
+python -m benchmarks.bench_scheduler --osara ./weights/osara.pt --shohin ./weights/shohin.pt --clients 4
+```
+"""
+
+import argparse
+import threading
+import time
+
+import numpy as np
+
+from benchmarks.common import load_frame
+from modules.InferenceScheduler import InferenceScheduler
+from Yolov9Wrapper.Yolov9Wrapper import Yolov9
+
+
+def run_clients(
+    scheduler: InferenceScheduler, frame: np.ndarray, clients: int, requests: int
+) -> tuple[float, list[float]]:
+    """clients個のスレッドから、それぞれrequests回推論する
+
+    Returns:
+        tuple[float, list[float]]: スループット(枚/秒)、各リクエストの遅延(ms)
+    """
+    latencies: list[float] = []
+    lock = threading.Lock()
+
+    def client():
+        for _ in range(requests):
+            t0 = time.perf_counter()
+            scheduler.detect(frame)
+            with lock:
+                latencies.append((time.perf_counter() - t0) * 1e3)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    t0 = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - t0
+    return clients * requests / elapsed, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--osara", required=True, help="お皿モデルのパス")
+    parser.add_argument("--shohin", required=True, help="商品モデルのパス")
+    parser.add_argument("--image", default=None, help="画像のパス。なければランダム画像")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--clients", type=int, default=4, help="同時に推論する端末の数")
+    parser.add_argument("--requests", type=int, default=10, help="1端末あたりのリクエスト数")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--waits", type=float, nargs="+", default=[0, 5, 15, 30])
+    args = parser.parse_args()
+
+    model_osara = Yolov9(args.osara, device=args.device)
+    model_shohin = Yolov9(args.shohin, device=args.device)
+    frame = load_frame(args.image)
+
+    print("max_batch_size, max_wait_ms, throughput(frames/s), p50(ms), p95(ms)")
+    for max_batch_size in args.batch_sizes:
+        for max_wait_ms in args.waits:
+            scheduler = InferenceScheduler(
+                model_osara,
+                model_shohin,
+                max_batch_size=max_batch_size,
+                max_wait_ms=max_wait_ms,
+            )
+            scheduler.detect(frame)  # warmup
+            throughput, latencies = run_clients(
+                scheduler, frame, args.clients, args.requests
+            )
+            scheduler.close()
+            print(
+                f"{max_batch_size}, {max_wait_ms}, {throughput:.2f}, "
+                f"{np.percentile(latencies, 50):.1f}, {np.percentile(latencies, 95):.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+# bench_startup.py
+サーバーの起動にかかる時間を、importの時間・モデルの読み込み時間・最初の推論の時間に分けて計測する。
+fast_start(fuse済みのモデルをキャッシュから読み込む)の有無で比べる。
+
+importのキャッシュが効かないように、1回ごとに新しいPythonのプロセスで計測する。
+fast_start=Trueの1回目はfuse済みのモデルを保存するので、計測の前に1回捨てる。
+
+## 使い方
+```sh
+python -m benchmarks.bench_startup --osara ./weights/osara.pt --shohin ./weights/shohin.pt --repeat 3
+```
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+
+def child(args: argparse.Namespace):
+    """新しいプロセスで起動の各段階を計測し、結果をJSONで出力する"""
+    t0 = time.perf_counter()
+    from Yolov9Wrapper.Yolov9Wrapper import Yolov9
+    from modules.inference import detect_osara_shohin
+
+    t_import = time.perf_counter() - t0
+
+    from benchmarks.common import load_frame
+
+    t0 = time.perf_counter()
+    model_osara = Yolov9(args.osara, device=args.device, fast_start=args.fast_start)
+    model_shohin = Yolov9(args.shohin, device=args.device, fast_start=args.fast_start)
+    t_load = time.perf_counter() - t0
+
+    frame = load_frame(args.image)
+    t0 = time.perf_counter()
+    detect_osara_shohin(frame, model_osara, model_shohin)
+    t_first = time.perf_counter() - t0
+
+    print(
+        json.dumps(
+            {
+                "import": t_import * 1e3,
+                "load": t_load * 1e3,
+                "first_request": t_first * 1e3,
+                "training_modules_loaded": sorted(
+                    name
+                    for name in (
+                        "pandas", "matplotlib", "seaborn",
+                        "utils.plots", "utils.dataloaders", "yolov9.utils.plots", "yolov9.utils.dataloaders",
+                    )
+                    if name in sys.modules
+                ),
+            }
+        )
+    )
+
+
+def run_child(args: argparse.Namespace, fast_start: bool) -> dict:
+    command = [
+        sys.executable, "-m", "benchmarks.bench_startup", "--child",
+        "--osara", args.osara, "--shohin", args.shohin, "--device", args.device,
+    ]
+    if args.image:
+        command += ["--image", args.image]
+    if fast_start:
+        command.append("--fast-start")
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    # モデルの読み込みなどのログが混ざるので、最後の行だけを読む
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--osara", required=True, help="お皿モデルのパス")
+    parser.add_argument("--shohin", required=True, help="商品モデルのパス")
+    parser.add_argument("--image", default=None, help="画像のパス。なければランダム画像")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--repeat", type=int, default=3, help="起動を繰り返す回数")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--fast-start", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args)
+        return
+
+    # fuse済みのモデルを作っておく(1回目の保存時間は計測に含めない)
+    run_child(args, fast_start=True)
+
+    print("fast_start, import(ms), load(ms), first_request(ms), total(ms)")
+    for fast_start in (False, True):
+        runs = [run_child(args, fast_start) for _ in range(args.repeat)]
+        stages = {
+            stage: float(np.median([run[stage] for run in runs]))
+            for stage in ("import", "load", "first_request")
+        }
+        print(
+            f"{fast_start}, {stages['import']:.0f}, {stages['load']:.0f}, "
+            f"{stages['first_request']:.0f}, {sum(stages.values()):.0f}"
+        )
+        print(f"  training modules loaded: {runs[-1]['training_modules_loaded']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+# bench_upload.py
+/start_inferenceへの画像の送り方ごとに、リクエストのサイズと、サーバー側で画像を取り出すまでのCPU時間を比較する。
+- json: 従来のbase64 JSON(`canvas.toDataURL`)
+- multipart: multipart/form-data
+- binary: リクエストボディがそのままJPEG(`canvas.toBlob`)
+
+## 使い方
+```sh
+python -m benchmarks.bench_upload --image ./Logging/20241018/xxx.jpg
+```
+"""
+
+import argparse
+import base64
+import io
+import json
+import time
+
+import cv2
+import numpy as np
+from flask import Flask, request
+from werkzeug.test import EnvironBuilder
+
+from benchmarks.common import load_frame
+from modules.upload import request_to_ndarray
+
+
+def cpu_times(fn, repeat: int = 50, warmup: int = 2) -> list[float]:
+    """関数を繰り返し実行して、1回ごとのCPU時間(ms)を返す"""
+    for _ in range(warmup):
+        fn()
+    times: list[float] = []
+    for _ in range(repeat):
+        t0 = time.process_time()
+        fn()
+        times.append((time.process_time() - t0) * 1e3)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--image", default=None, help="画像のパス。なければランダム画像")
+    parser.add_argument("--quality", type=int, default=92, help="JPEGの品質(ブラウザのtoDataURLの既定値は0.92)")
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    frame = load_frame(args.image)
+    _, buffer = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, args.quality])
+    jpeg = buffer.tobytes()
+
+    app = Flask(__name__)
+    json_body = json.dumps(
+        {"image": "data:image/jpeg;base64," + base64.b64encode(jpeg).decode()}
+    ).encode()
+    builders = {
+        "json": EnvironBuilder(
+            path="/start_inference", method="POST", data=json_body, content_type="application/json"
+        ),
+        "multipart": EnvironBuilder(
+            path="/start_inference",
+            method="POST",
+            data={"image": (io.BytesIO(jpeg), "image.jpg", "image/jpeg")},
+        ),
+        "binary": EnvironBuilder(
+            path="/start_inference", method="POST", data=jpeg, content_type="image/jpeg"
+        ),
+    }
+
+    print("format, request size(bytes), cpu mean(ms), cpu p50(ms)")
+    for name, builder in builders.items():
+        # リクエストは事前に作っておき、サーバー側の処理(パース・デコード)だけを計測する
+        environ = builder.get_environ()
+        body = environ["wsgi.input"].read()
+
+        def decode():
+            with app.request_context({**environ, "wsgi.input": io.BytesIO(body)}):
+                frame_decoded = request_to_ndarray(request)
+            assert frame_decoded is not None
+
+        times = cpu_times(decode, args.repeat)
+        print(f"{name}, {len(body)}, {np.mean(times):.2f}, {np.percentile(times, 50):.2f}")
+
+if __name__ == "__main__":
+    main()
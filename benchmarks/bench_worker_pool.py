@@ -0,0 +1,62 @@
+"""
+# bench_worker_pool.py
+InferenceWorkerPoolのワーカープロセス数を変えながら、同時に複数端末から推論した場合の
+スループットと遅延を計測する。ワーカー数に対して、スループットがほぼ線形に伸びるかを確かめる。
+
+## 使い方
+```sh
+python -m benchmarks.bench_worker_pool --osara ./weights/osara.pt --shohin ./weights/shohin.pt --workers 1 2 4
+```
+"""
+
+import argparse
+import os
+
+import numpy as np
+
+from benchmarks.bench_scheduler import run_clients
+from benchmarks.common import load_frame
+from modules.InferenceWorkerPool import InferenceWorkerPool
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--osara", required=True, help="お皿モデルのパス")
+    parser.add_argument("--shohin", required=True, help="商品モデルのパス")
+    parser.add_argument("--image", default=None, help="画像のパス。なければランダム画像")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="ワーカープロセス数")
+    parser.add_argument("--clients", type=int, default=8, help="同時に推論する端末の数")
+    parser.add_argument("--requests", type=int, default=10, help="1端末あたりのリクエスト数")
+    parser.add_argument("--max-batch-size", type=int, default=4)
+    args = parser.parse_args()
+
+    frame = load_frame(args.image)
+    cpu_count = os.cpu_count() or 1
+
+    print("workers, torch_threads, throughput(frames/s), speedup, p50(ms), p95(ms)")
+    base_throughput = None
+    for workers in args.workers:
+        torch_threads = max(1, cpu_count // workers)
+        pool = InferenceWorkerPool(
+            {"weights": args.osara, "device": args.device},
+            {"weights": args.shohin, "device": args.device},
+            workers=workers,
+            max_frame_shape=frame.shape,
+            max_batch_size=args.max_batch_size,
+            torch_threads=torch_threads,
+        )
+        for _ in range(workers):
+            pool.detect(frame)  # warmup
+        throughput, latencies = run_clients(pool, frame, args.clients, args.requests)
+        pool.close()
+
+        base_throughput = base_throughput or throughput
+        print(
+            f"{workers}, {torch_threads}, {throughput:.2f}, {throughput / base_throughput:.2f}x, "
+            f"{np.percentile(latencies, 50):.1f}, {np.percentile(latencies, 95):.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+# common.py
+ベンチマーク用の共通関数。
+
+## 使い方
+各ベンチマークはリポジトリのルートで、`python -m benchmarks.<ファイル名>` の形で実行する。
+(Yolov9Wrapperが `./yolov9` をsys.pathに追加するため、カレントディレクトリはルートにしておく)
+"""
+
+import time
+from typing import Callable
+
+import numpy as np
+
+
+def measure(fn: Callable[[], object], repeat: int = 20, warmup: int = 2) -> list[float]:
+    """関数を繰り返し実行して、1回ごとの処理時間(ms)を返す
+
+    Args:
+        fn (Callable[[], object]): 計測する関数
+        repeat (int, optional): 計測する回数. Defaults to 20.
+        warmup (int, optional): 計測前に捨てる実行回数. Defaults to 2.
+
+    Returns:
+        list[float]: 1回ごとの処理時間(ms)
+    """
+    for _ in range(warmup):
+        fn()
+    times: list[float] = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - t0) * 1e3)
+    return times
+
+
+def summarize(name: str, times: list[float]) -> dict[str, float]:
+    """処理時間の統計(mean, p50, p95)を表示して返す
+
+    Args:
+        name (str): 表示名
+        times (list[float]): 処理時間(ms)のリスト
+
+    Returns:
+        dict[str, float]: 統計値
+    """
+    stats = {
+        "mean": float(np.mean(times)),
+        "p50": float(np.percentile(times, 50)),
+        "p95": float(np.percentile(times, 95)),
+    }
+    print(
+        f"\033[36m[{name}] mean: {stats['mean']:.2f}ms, p50: {stats['p50']:.2f}ms, p95: {stats['p95']:.2f}ms (n={len(times)})\033[0m"
+    )
+    return stats
+
+
+def load_frame(image_path: str | None, shape=(480, 640, 3)) -> np.ndarray:
+    """ベンチマーク用の画像を読み込む。パスがない場合はランダムな画像を作る
+
+    Args:
+        image_path (str | None): 画像のパス
+        shape (tuple, optional): ランダム画像のサイズ. Defaults to (480, 640, 3).
+
+    Returns:
+        np.ndarray: 画像(BGR)
+    """
+    if image_path:
+        import cv2
+
+        frame = cv2.imread(image_path)
+        assert frame is not None, f"Image Not Found {image_path}"
+        return frame
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 256, size=shape, dtype=np.uint8)
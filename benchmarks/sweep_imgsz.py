@@ -0,0 +1,95 @@
+"""
+# sweep_imgsz.py
+ログ(LabelMe形式)に保存された実際のトレー画像を使って、入力サイズ(imgsz)ごとの速度と精度(mAP)を比較する。
+速度と精度のどちらでも他の設定に負けていない設定(パレート最適)に `*` を付けて表示する。
+
+## 使い方
+```sh
+# お皿モデルを、320・480x640・640で比較する
+python -m benchmarks.sweep_imgsz --weights ./weights/osara.pt --imgsz 320 480x640 640
+
+# 正方形のletterbox(パディングあり)と比較する
+python -m benchmarks.sweep_imgsz --weights ./weights/osara.pt --imgsz 320 640 --no-rect
+```
+
+結果を見て、app_vf1.pyのMODEL_OSARA_IMGSZ・MODEL_SHOHIN_IMGSZを決める。
+"""
+
+import argparse
+
+import cv2
+import numpy as np
+
+from benchmarks.common import measure
+from Yolov9Wrapper.Evaluation import evaluate_map, load_labelme_samples
+from Yolov9Wrapper.Yolov9Wrapper import Yolov9
+
+
+def parse_imgsz(value: str) -> tuple[int, int]:
+    """"640"や"480x640"を、(height, width)にする"""
+    if "x" in value:
+        height, width = value.split("x")
+        return int(height), int(width)
+    return int(value), int(value)
+
+
+def pareto_front(points: list[tuple[float, float]]) -> list[bool]:
+    """(遅延, mAP)のリストについて、各点がパレート最適か(遅延が小さく、mAPが大きい点に負けていないか)を返す"""
+    return [
+        not any(
+            other_latency <= latency
+            and other_map >= map_
+            and (other_latency, other_map) != (latency, map_)
+            for other_latency, other_map in points
+        )
+        for latency, map_ in points
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--weights", required=True, help=".ptの重みファイルのパス")
+    parser.add_argument("--imgsz", nargs="+", default=["320", "480x640", "640"], help="320や480x640")
+    parser.add_argument("--logging-dir", default="Logging", help="ログの保存先")
+    parser.add_argument("--limit", type=int, default=200, help="評価に使う枚数")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--backend", default="pt")
+    parser.add_argument("--no-rect", action="store_true", help="正方形のletterboxにする")
+    parser.add_argument("--repeat", type=int, default=5, help="1枚あたりの計測回数")
+    args = parser.parse_args()
+
+    samples = load_labelme_samples(args.logging_dir, limit=args.limit)
+    if not samples:
+        raise SystemExit(f"no labeled images in {args.logging_dir}")
+    frames = [cv2.imread(sample["image_path"]) for sample in samples[:10]]
+    print(f"{len(samples)} images ({len(frames)} for latency)")
+
+    rows: list[tuple[str, float, float, float]] = []
+    for value in args.imgsz:
+        model = Yolov9(
+            args.weights,
+            device=args.device,
+            imgsz=parse_imgsz(value),
+            rect=not args.no_rect,
+            backend=args.backend,
+        )
+        latencies = [
+            t
+            for frame in frames
+            for t in measure(lambda: model.predict_frame(frame), args.repeat, warmup=1)
+        ]
+        metrics = evaluate_map(model, samples)
+        rows.append(
+            (value, float(np.percentile(latencies, 50)), metrics["map50"], metrics["map50_95"])
+        )
+
+    front = pareto_front([(latency, map50_95) for _, latency, _, map50_95 in rows])
+    print("imgsz, p50(ms), mAP50, mAP50-95, pareto")
+    for (value, latency, map50, map50_95), optimal in zip(rows, front):
+        print(
+            f"{value}, {latency:.1f}, {map50:.4f}, {map50_95:.4f}, {'*' if optimal else ''}"
+        )
+
+
+if __name__ == "__main__":
+    main()
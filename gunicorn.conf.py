@@ -0,0 +1,105 @@
+"""
+# gunicorn.conf.py
+本番用に、app_vf1をgunicornで動かすための設定。
+
+## 使い方
+```sh
+# ワーカーは1つ(WEB_CONCURRENCYで変更できる)。同時の会計は、スレッドとINFERENCE_SCHEDULERでさばく
+gunicorn app_vf1:app
+
+# ワーカーを2つ以上にする場合は、Socket.IOのemitをワーカー間で中継するためにredisを使う
+SOCKETIO_MESSAGE_QUEUE=redis://localhost:6379/0 WEB_CONCURRENCY=4 gunicorn app_vf1:app
+```
+
+## 仕組み
+- preload_app: マスターでapp_vf1を読み込み(モデルの読み込み・warmupも)、forkでワーカーに共有する
+    - 重みはコピーオンライトで共有されるので、ワーカー数だけメモリを使うことはない
+    - fork前にgc.freeze()して、GCが共有しているオブジェクトに触れて(参照カウント以外で)ページがコピーされるのを防ぐ
+- post_fork: ワーカーごとにコア数/ワーカー数を推論に割り当て(お皿と商品のforwardで半分ずつ)、バックグラウンドのスレッドを起動する
+    - スレッドはforkで引き継がれないので、ワーカーで起動する
+- app_vf1.INFERENCE_WORKER_PROCESSESを1以上にすると、推論は推論プロセスで行う
+    - Webのプロセスはモデルを読み込まず、コアは推論プロセスに回す
+    - ワーカーごとに推論プロセスを起動することになるので、WEB_CONCURRENCYが2以上でもワーカーは1つにする(on_starting)
+- worker_exit: 受け付けた会計を処理してから、バックグラウンドのスレッドを止める
+- ヘルスチェックは /healthz (動いているか)、/readyz (会計を受け付けられるか)
+
+## ワーカーを2つ以上にする場合の注意
+次の状態はワーカー(プロセス)ごとに持っていて、ワーカー間で共有しない。
+- 非同期の会計のジョブ(/inference_jobs/<id>)
+    - 結果はSocket.IO(redis経由)で届くが、ポーリングが別のワーカーに届くと404になる
+      (端末は404を「まだ」として待ち続ける)。確実にポーリングしたい場合は、ロードバランサでスティッキーセッションにする
+- 撮り直し用のキャッシュ(FRAME_CACHE)。別のワーカーに届いた撮り直しは、推論し直す
+- 最後の会計の検出画像(/debug/detected_image)と、/inference_queueの数
+- /metricsの値。全ての値についているworker_pidのラベルで、どのワーカーの値かを区別する
+    (Prometheusでは、sum without (worker_pid)などでワーカーをまとめる)
+"""
+
+import gc
+import multiprocessing
+import os
+
+from incomings.variables import EnvVariables
+
+ENVVAL = EnvVariables()
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:7500")
+# ジョブ・キャッシュ・メトリクスはワーカーごとに持つので、既定は1つ(上の「注意」を参照)
+workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+# Flask-SocketIO(threading)のwebsocketは、スレッドのワーカーで動かす
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 16))
+preload_app = True
+# モデルの読み込み・バックエンドの選択に時間がかかるので、長めにしておく
+timeout = 120
+graceful_timeout = 30
+keepalive = 5
+
+certfile = ENVVAL.SSL_CRT
+keyfile = ENVVAL.SSL_KEY
+
+
+def _torch_threads_per_worker(n_workers: int) -> int:
+    """ワーカーごとのtorchのスレッド数。コアをワーカーで分け合う"""
+    return max(1, multiprocessing.cpu_count() // n_workers)
+
+
+def on_starting(server):
+    import app_vf1
+
+    # 推論プロセスはワーカーごとに起動するので、2つ以上のワーカーではコア・メモリが足りなくなる
+    if app_vf1.INFERENCE_WORKER_PROCESSES > 0 and server.num_workers > 1:
+        server.log.warning(
+            f"INFERENCE_WORKER_PROCESSES={app_vf1.INFERENCE_WORKER_PROCESSES} is set, "
+            f"using 1 worker instead of {server.num_workers}"
+        )
+        server.num_workers = 1
+
+
+def when_ready(server):
+    # マスターでの読み込みが終わり、これからfork
+    server.log.info(
+        f"models are loaded in master (pid={os.getpid()}), forking {server.num_workers} workers"
+    )
+
+
+def pre_fork(server, worker):
+    # 読み込み済みのオブジェクトをGCの対象から外し、コピーオンライトの共有を保つ
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import torch
+
+    import app_vf1
+
+    # torchのスレッド数は、お皿と商品のforwardで分け合うように、start_background_workersの中で決める
+    app_vf1.start_background_workers(torch_threads=_torch_threads_per_worker(server.num_workers))
+    server.log.info(
+        f"worker {worker.pid} is ready (torch threads={torch.get_num_threads()})"
+    )
+
+
+def worker_exit(server, worker):
+    import app_vf1
+
+    app_vf1.stop_background_workers()
@@ -0,0 +1,101 @@
+"""
+# VoiceAssets.py
+音声ファイル(jph/voices/*.wav)を起動時にまとめて読み込み、URLで配信するためのモジュール。
+
+## 仕組み
+- 起動時に全ての音声を読み込み、中身のハッシュ(sha256の先頭16文字)をIDにする
+    - 中身が変わればIDも変わるので、ブラウザにずっとキャッシュさせてよい(Cache-Control: immutable)
+    - IDはそのままETagにも使う
+- 会計のレスポンスには、音声のIDとURLだけを入れる(base64で音声を丸ごと入れない)
+- 古い端末向けに、base64も返せるようにしておく(エンコード結果もキャッシュする)
+
+## 使用例
+```python
+voice_assets = VoiceAssetRegistry("jph/voices")
+asset = voice_assets.find_by_path("jph/voices/01_いらっしゃいませなのだ.wav")
+asset.url  # "/voices/xxxxxxxxxxxxxxxx.wav"
+```
+"""
+
+import base64
+import hashlib
+import os
+
+
+class VoiceAsset:
+    """読み込んだ音声ファイル1つ分"""
+
+    __slots__ = ("id", "path", "data", "mimetype", "_base64")
+
+    def __init__(self, path: str, data: bytes, mimetype: str = "audio/wav"):
+        self.id = hashlib.sha256(data).hexdigest()[:16]
+        self.path = path
+        self.data = data
+        self.mimetype = mimetype
+        self._base64: str | None = None
+
+    def __repr__(self):
+        return f"VoiceAsset(id={self.id}, path={self.path}, size={len(self.data)})"
+
+    @property
+    def url(self) -> str:
+        """音声を配信するURL"""
+        return f"/voices/{self.id}.wav"
+
+    @property
+    def etag(self) -> str:
+        """中身のハッシュから作るETag(強いETag)"""
+        return f'"{self.id}"'
+
+    @property
+    def base64(self) -> str:
+        """古い端末向けの、base64でエンコードした音声。1回だけエンコードする"""
+        if self._base64 is None:
+            self._base64 = base64.b64encode(self.data).decode("utf-8")
+        return self._base64
+
+
+class VoiceAssetRegistry:
+    def __init__(self, voice_dir: str = "jph/voices"):
+        """音声ファイルを読み込んで、ID・パスから取り出せるようにする
+
+        Args:
+            voice_dir (str, optional): 音声ファイルのディレクトリ. Defaults to "jph/voices".
+        """
+        self.voice_dir = voice_dir
+        self._by_id: dict[str, VoiceAsset] = {}
+        self._by_path: dict[str, VoiceAsset] = {}
+        self.load()
+
+    def __repr__(self):
+        return f"VoiceAssetRegistry(voice_dir={self.voice_dir}, assets={len(self._by_id)})"
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def load(self):
+        """voice_dirの.wavを全て読み込む"""
+        by_id: dict[str, VoiceAsset] = {}
+        by_path: dict[str, VoiceAsset] = {}
+        for file_name in sorted(os.listdir(self.voice_dir)):
+            if not file_name.lower().endswith(".wav"):
+                continue
+            path = os.path.join(self.voice_dir, file_name)
+            with open(path, "rb") as f:
+                asset = VoiceAsset(path, f.read())
+            by_id[asset.id] = asset
+            by_path[os.path.normpath(path)] = asset
+        self._by_id, self._by_path = by_id, by_path
+        print(f"\033[36m[VoiceAssetRegistry] loaded {len(by_id)} voices\033[0m")
+
+    def get(self, voice_id: str) -> VoiceAsset | None:
+        """IDから音声を取り出す。ない場合はNone"""
+        return self._by_id.get(voice_id)
+
+    def find_by_path(self, voice_path: str) -> VoiceAsset | None:
+        """ファイルのパス(VoiceData["voice_path"])から音声を取り出す。ない場合はNone"""
+        return self._by_path.get(os.path.normpath(voice_path))
+
+    def assets(self) -> list[VoiceAsset]:
+        """全ての音声のリストを返す"""
+        return list(self._by_id.values())
@@ -0,0 +1,165 @@
+"""
+# FrameCache.py
+同じトレーを何度も撮り直したときに、推論をやり直さずに前の結果を返すためのキャッシュ。
+
+## 仕組み
+- 画像を縮小してdHash(隣り合う画素の明るさの大小)を計算し、キーにする
+    - hash_size=16の場合、(17, 16)に縮小して256bitのハッシュにする。1080pでも1ms程度
+- 端末(kiosk)ごとに、直近entries_per_kiosk件の(ハッシュ, 時刻, 結果)を持つ
+- 同じ端末から、ttl_seconds以内に、ハミング距離がmax_distance以下の画像が来たら、前の結果を返す
+- 端末の数がmax_kiosksを超えたら、いちばん長く使われていない端末の分から捨てる(LRU)
+- ヒット・ミスの数は、frame_cache_lookups_total(/metrics)に記録する
+
+## 使用例
+```python
+frame_cache = FrameResultCache(ttl_seconds=5.0, max_distance=8)
+
+result = frame_cache.get(kiosk_id, frame)
+if result is None:
+    result = inference_osara_shohin(frame, MODEL_OSARA, MODEL_SHOHIN)
+    frame_cache.put(kiosk_id, frame, result)
+```
+
+## 開発メモ
+- max_distanceを大きくしすぎると、料理を1つ入れ替えただけのトレーでも同じ結果になる。
+  ログ画像で、撮り直しと入れ替えの距離を見て決める
+- 結果はコピーせずにそのまま返す(find_menu_by_OsaraShohinResultで書き換えても、同じ値になる)
+"""
+
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Hashable
+
+import cv2
+import numpy as np
+
+from modules.Metrics import METRICS
+
+FRAME_CACHE_LOOKUPS = METRICS.counter(
+    "frame_cache_lookups_total",
+    "Frame result cache lookups by result (hit/miss).",
+    labelnames=("result",),
+)
+
+
+def dhash(frame: np.ndarray, hash_size: int = 16) -> int:
+    """画像のdHash(差分ハッシュ)を計算する
+
+    Args:
+        frame (np.ndarray): 画像(BGRまたはグレースケール)
+        hash_size (int, optional): ハッシュの一辺。hash_size**2 bitのハッシュになる. Defaults to 16.
+
+    Returns:
+        int: hash_size**2 bitのハッシュ
+    """
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hamming_distance(a: int, b: int) -> int:
+    """2つのハッシュのハミング距離(異なるbitの数)"""
+    return (a ^ b).bit_count()
+
+
+class _CacheEntry:
+    __slots__ = ("hash", "created_at", "result")
+
+    def __init__(self, hash: int, created_at: float, result: Any):
+        self.hash = hash
+        self.created_at = created_at
+        self.result = result
+
+
+class FrameResultCache:
+    def __init__(
+        self,
+        ttl_seconds: float = 5.0,
+        max_distance: int = 8,
+        hash_size: int = 16,
+        entries_per_kiosk: int = 2,
+        max_kiosks: int = 64,
+    ):
+        """端末ごとに、ほぼ同じ画像の推論結果を短い時間だけ覚えておくキャッシュ
+
+        Args:
+            ttl_seconds (float, optional): 結果を使い回す時間(秒). Defaults to 5.0.
+            max_distance (int, optional): 同じ画像とみなすハミング距離の上限(0-hash_size**2). Defaults to 8.
+            hash_size (int, optional): dHashの一辺. Defaults to 16.
+            entries_per_kiosk (int, optional): 端末ごとに覚えておく結果の数. Defaults to 2.
+            max_kiosks (int, optional): 覚えておく端末の数. Defaults to 64.
+        """
+        self.ttl_seconds = ttl_seconds
+        self.max_distance = max_distance
+        self.hash_size = hash_size
+        self.entries_per_kiosk = entries_per_kiosk
+        self.max_kiosks = max_kiosks
+
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Hashable, deque[_CacheEntry]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"FrameResultCache(ttl_seconds={self.ttl_seconds}, max_distance={self.max_distance}, kiosks={len(self._entries)}, hits={self.hits}, misses={self.misses})"
+
+    def get(self, kiosk: Hashable, frame: np.ndarray) -> Any | None:
+        """同じ端末の、ほぼ同じ画像の結果があれば返す。なければNone
+
+        Args:
+            kiosk (Hashable): 端末のID(UUIDなど)
+            frame (np.ndarray): 画像
+
+        Returns:
+            Any | None: キャッシュした結果
+        """
+        frame_hash = dhash(frame, self.hash_size)
+        now = time.monotonic()
+        with self._lock:
+            entries = self._entries.get(kiosk)
+            result = None
+            if entries is not None:
+                self._entries.move_to_end(kiosk)
+                # 新しいものから探す
+                for entry in reversed(entries):
+                    if now - entry.created_at > self.ttl_seconds:
+                        break
+                    if hamming_distance(entry.hash, frame_hash) <= self.max_distance:
+                        result = entry.result
+                        break
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        FRAME_CACHE_LOOKUPS.inc(result="miss" if result is None else "hit")
+        return result
+
+    def put(self, kiosk: Hashable, frame: np.ndarray, result: Any):
+        """画像の結果を覚えておく
+
+        Args:
+            kiosk (Hashable): 端末のID(UUIDなど)
+            frame (np.ndarray): 画像
+            result (Any): 推論結果
+        """
+        entry = _CacheEntry(dhash(frame, self.hash_size), time.monotonic(), result)
+        with self._lock:
+            entries = self._entries.get(kiosk)
+            if entries is None:
+                entries = self._entries[kiosk] = deque(maxlen=self.entries_per_kiosk)
+            self._entries.move_to_end(kiosk)
+            entries.append(entry)
+            while len(self._entries) > self.max_kiosks:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """キャッシュを全て捨てる"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """ヒット・ミスの数と、覚えている端末の数を返す"""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "kiosks": len(self._entries)}
@@ -0,0 +1,165 @@
+"""
+# InferenceScheduler.py
+複数の端末(キオスク)から同時に来た推論リクエストを、まとめてバッチ推論するモジュール。
+
+## 仕組み
+- 各リクエストは、submit()で画像をキューに入れ、Futureで結果を待つ
+- スケジューラのスレッドは、最初の1枚が来てから最大max_wait_ms待ち、最大max_batch_size枚を集める
+- 集めた画像を、お皿・商品モデルそれぞれ1回のforwardで推論し(detect_osara_shohin_batch)、結果を各リクエストに返す
+
+## 使用例
+```python
+scheduler = InferenceScheduler(MODEL_OSARA, MODEL_SHOHIN, max_batch_size=4, max_wait_ms=15)
+
+# リクエストごとに(別スレッドから)呼ぶ
+result_osara, result_shohin = scheduler.detect(frame)
+
+# 終了時
+scheduler.close()
+```
+
+## 開発メモ
+- max_batch_size=1にすると、従来どおり1枚ずつ推論するのと同じになる
+- 同時に来るリクエストが少ないときは、最大max_wait_msだけ遅延が増える
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Tuple
+
+import numpy as np
+
+from Yolov9Wrapper.Yolov9Wrapper import Yolov9, Yolov9Result
+from modules.inference import detect_osara_shohin_batch
+from modules.Metrics import observe_stages
+
+
+class _InferenceRequest:
+    """キューに入れる推論リクエスト"""
+
+    __slots__ = ("frame", "future")
+
+    def __init__(self, frame: np.ndarray):
+        self.frame = frame
+        self.future: Future = Future()
+
+
+class InferenceScheduler:
+    def __init__(
+        self,
+        MODEL_OSARA: Yolov9,
+        MODEL_SHOHIN: Yolov9,
+        max_batch_size: int = 4,
+        max_wait_ms: float = 15.0,
+    ):
+        """推論リクエストをまとめてバッチ推論するスケジューラ
+
+        Args:
+            MODEL_OSARA (Yolov9): お皿認識用のYOLOv9モデル
+            MODEL_SHOHIN (Yolov9): 商品(料理)認識用のYOLOv9モデル
+            max_batch_size (int, optional): 1回のforwardにまとめる最大枚数. Defaults to 4.
+            max_wait_ms (float, optional): 最初の1枚が来てから、バッチを待つ最大時間(ms). Defaults to 15.0.
+        """
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be >= 1")
+        self.MODEL_OSARA = MODEL_OSARA
+        self.MODEL_SHOHIN = MODEL_SHOHIN
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1e3
+
+        self._queue: queue.Queue[_InferenceRequest | None] = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._run, name="inference_scheduler", daemon=True
+        )
+        self._thread.start()
+
+    def __repr__(self):
+        return f"InferenceScheduler(max_batch_size={self.max_batch_size}, max_wait_ms={self.max_wait * 1e3})"
+
+    def submit(self, frame: np.ndarray) -> Future:
+        """画像をキューに入れる
+
+        Args:
+            frame (np.ndarray): 推論する画像
+
+        Returns:
+            Future: (お皿モデルの結果, 商品モデルの結果)を返すFuture
+        """
+        if self._closed:
+            raise RuntimeError("InferenceScheduler is closed")
+        request = _InferenceRequest(frame)
+        self._queue.put(request)
+        return request.future
+
+    def detect(self, frame: np.ndarray) -> Tuple[Yolov9Result, Yolov9Result]:
+        """画像をキューに入れ、推論が終わるまで待つ。detect_osara_shohinと同じ値を返す
+
+        Args:
+            frame (np.ndarray): 推論する画像
+
+        Returns:
+            Tuple[Yolov9Result, Yolov9Result]: お皿モデルの結果、商品モデルの結果
+        """
+        return self.submit(frame).result()
+
+    def qsize(self) -> int:
+        """推論待ちのリクエスト数を返す"""
+        return self._queue.qsize()
+
+    def close(self):
+        """スケジューラを止める。キューに残っているリクエストは推論してから止まる"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def _collect(self) -> list[_InferenceRequest]:
+        """キューからバッチを集める。止める場合は空のリストを返す"""
+        first = self._queue.get()
+        if first is None:
+            return []
+
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                # 止める合図は、集めたバッチを処理してから受け取れるように戻しておく
+                self._queue.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if not batch:
+                break
+
+            # ---まとめて推論し、各リクエストに結果を返す
+            timings: dict[str, float] = {}
+            try:
+                results = detect_osara_shohin_batch(
+                    [request.frame for request in batch],
+                    self.MODEL_OSARA,
+                    self.MODEL_SHOHIN,
+                    timings,
+                )
+            except Exception as e:
+                print(f"\033[31m[InferenceScheduler] Error: {e}\033[0m")
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            observe_stages(timings)  # 段階ごとの処理時間は、バッチ単位で記録する
+            for request, result in zip(batch, results):
+                request.future.set_result(result)
@@ -0,0 +1,419 @@
+"""
+# InferenceWorkerPool.py
+お皿・商品モデルの推論を、Webのプロセスとは別のワーカープロセスで行うモジュール。
+InferenceSchedulerと同じように、`detect(frame)`で使える(inference_osara_shohinのschedulerに渡せる)。
+
+## 仕組み
+- 各ワーカープロセスが、自分のYolov9(お皿・商品)を持つ
+- 画像は、multiprocessing.shared_memoryのスロット(リングバッファ)に書き込み、
+  ワーカーにはスロット番号と形だけを送る(画像をpickleしない)
+- ワーカーは、キューに溜まっているリクエストをmax_batch_size枚までまとめて推論する(detect_osara_shohin_batch)
+- 結果は、bboxの座標・確信度・クラスの配列だけを返し、Webのプロセス側でYolov9Resultに組み立てる
+- 段階ごとの処理時間も返し、Webのプロセス側のMetrics(/metrics)に記録する
+- スロットが全て使われているときは、空くまで待つ(バックプレッシャー)。timeout秒でTimeoutError
+- リクエストは、推論中のリクエストがいちばん少ないワーカーのキューに振り分ける
+- ワーカーが落ちた(OOMなど)ら、そのワーカーのリクエストを失敗にしてスロットを返し、ワーカーを起動し直す
+
+## 使用例
+```python
+pool = InferenceWorkerPool(
+    {"weights": "./weights/osara.pt", "device": "cpu"},
+    {"weights": "./weights/shohin.pt", "device": "cpu"},
+    workers=2,
+)
+result_osara, result_shohin = pool.detect(frame)
+pool.close()
+```
+
+## 開発メモ
+- ワーカーはspawnで起動する(torchのスレッドを持ったプロセスをforkしないように)
+- torch_threadsで、ワーカーごとのtorchのスレッド数を指定する。コア数/ワーカー数くらいにする
+- スロットより大きい画像(max_frame_shape)は、ValueErrorになる
+- spawnのワーカーは、起動したスクリプトを`__mp_main__`として読み込み直す。
+  `python app_vf1.py`で起動するとワーカーでもapp_vf1のモデル読み込みが走るので、gunicorn(app_vf1:app)で起動する
+"""
+
+import multiprocessing as mp
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import Future
+from itertools import count
+from multiprocessing import shared_memory
+from typing import Any, Tuple
+
+import numpy as np
+
+from modules.Metrics import observe_stages
+from Yolov9Wrapper.Yolov9Wrapper import Yolov9Detections, Yolov9Result
+
+# ワーカーから返す、1モデル分の検出結果(xyxy, conf, cls)
+CompactDetections = Tuple[np.ndarray, np.ndarray, np.ndarray]
+
+
+def _compact(detections: Yolov9Detections) -> CompactDetections:
+    return detections.xyxy, detections.conf, detections.cls
+
+
+def _worker_main(
+    worker_id: int,
+    shm_name: str,
+    slot_bytes: int,
+    task_queue: "mp.Queue",
+    result_queue: "mp.Queue",
+    osara_kwargs: dict[str, Any],
+    shohin_kwargs: dict[str, Any],
+    max_batch_size: int,
+    torch_threads: int | None,
+):
+    """ワーカープロセスの本体"""
+    from modules.inference import configure_parallel_inference, detect_osara_shohin_batch
+    from Yolov9Wrapper.Yolov9Wrapper import Yolov9
+
+    # ワーカーの中では、1つのスレッドがまとめて推論する。お皿と商品のforwardでコアを分け合う
+    configure_parallel_inference(concurrency=1, threads=torch_threads)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        model_osara = Yolov9(**osara_kwargs)
+        model_shohin = Yolov9(**shohin_kwargs)
+    except Exception as e:
+        result_queue.put(("error", worker_id, f"{e}\n{traceback.format_exc()}"))
+        shm.close()
+        return
+    result_queue.put(("ready", worker_id, (model_osara.names, model_shohin.names)))
+
+    stopping = False
+    while not stopping:
+        # ---溜まっているリクエストを、max_batch_size枚までまとめる
+        tasks = [task_queue.get()]
+        while len(tasks) < max_batch_size:
+            try:
+                tasks.append(task_queue.get_nowait())
+            except queue.Empty:
+                break
+        if None in tasks:
+            # 止める合図。先に受け取ったリクエストは処理してから止まる
+            stopping = True
+            tasks = [task for task in tasks if task is not None]
+        if not tasks:
+            break
+
+        # ---スロットの画像を、コピーせずにそのまま推論する
+        frames = [
+            np.ndarray(shape, dtype=np.uint8, buffer=shm.buf, offset=slot * slot_bytes)
+            for _, slot, shape in tasks
+        ]
+        timings: dict[str, float] = {}
+        try:
+            results = detect_osara_shohin_batch(frames, model_osara, model_shohin, timings)
+        except Exception as e:
+            for request_id, slot, _ in tasks:
+                result_queue.put(("result", request_id, (slot, None, str(e))))
+            continue
+        finally:
+            del frames  # 共有メモリへの参照を残さない
+        # 段階ごとの処理時間は、Webのプロセス側のMetricsに記録する
+        result_queue.put(("timings", worker_id, timings))
+        for (request_id, slot, _), (result_osara, result_shohin) in zip(tasks, results):
+            result_queue.put(
+                (
+                    "result",
+                    request_id,
+                    (slot, (_compact(result_osara["boxes"]), _compact(result_shohin["boxes"])), None),
+                )
+            )
+        del results, result_osara, result_shohin  # 結果のimageも共有メモリを参照しているので、残さない
+
+    shm.close()
+
+
+class _PoolRequest:
+    """結果を待っているリクエスト"""
+
+    __slots__ = ("frame", "future", "slot", "worker_id")
+
+    def __init__(self, frame: np.ndarray, slot: int, worker_id: int):
+        self.frame = frame
+        self.future: Future = Future()
+        self.slot = slot
+        self.worker_id = worker_id
+
+
+class InferenceWorkerPool:
+    def __init__(
+        self,
+        osara_kwargs: dict[str, Any],
+        shohin_kwargs: dict[str, Any],
+        workers: int = 2,
+        slots: int | None = None,
+        max_frame_shape: Tuple[int, int, int] = (1080, 1920, 3),
+        max_batch_size: int = 4,
+        torch_threads: int | None = None,
+        timeout: float | None = 60.0,
+        liveness_interval: float = 1.0,
+    ):
+        """推論用のワーカープロセスを起動する。全てのワーカーがモデルを読み込むまで待つ
+
+        Args:
+            osara_kwargs (dict[str, Any]): お皿モデルのYolov9に渡す引数(weights, device, imgsz, backendなど)
+            shohin_kwargs (dict[str, Any]): 商品モデルのYolov9に渡す引数
+            workers (int, optional): ワーカープロセスの数. Defaults to 2.
+            slots (int | None, optional): 共有メモリのスロット数(同時に推論待ちにできる画像の数). Defaults to None(workers * max_batch_size * 2).
+            max_frame_shape (Tuple[int, int, int], optional): 1スロットに入る画像の最大サイズ(height, width, channels). Defaults to (1080, 1920, 3).
+            max_batch_size (int, optional): ワーカーが1回にまとめて推論する最大枚数. Defaults to 4.
+            torch_threads (int | None, optional): ワーカーごとに推論に使うコアの数(お皿と商品のforwardで分け合う). Defaults to None(CPUのコア数).
+            timeout (float | None, optional): detectで結果を待つ時間・submitで空きスロットを待つ時間(秒)。
+                超えたらTimeoutError。Noneの場合は待ち続ける. Defaults to 60.0.
+            liveness_interval (float, optional): ワーカーが生きているかを確かめる間隔(秒). Defaults to 1.0.
+        """
+        if workers < 1:
+            raise ValueError("workers must be >= 1")
+        slots = slots or workers * max_batch_size * 2
+        self.workers = workers
+        self.slots = slots
+        self.slot_bytes = int(np.prod(max_frame_shape))
+        self.timeout = timeout
+        self.liveness_interval = liveness_interval
+
+        # ---共有メモリのスロットを用意する
+        self._shm = shared_memory.SharedMemory(create=True, size=slots * self.slot_bytes)
+        self._free_slots: queue.Queue[int] = queue.Queue()
+        for slot in range(slots):
+            self._free_slots.put(slot)
+
+        # ---ワーカーを起動する(リクエストは、ワーカーごとのキューに振り分ける)
+        self._ctx = mp.get_context("spawn")
+        self._worker_args = (osara_kwargs, shohin_kwargs, max_batch_size, torch_threads)
+        self._result_queue = self._ctx.Queue()
+        self._task_queues: list["mp.Queue | None"] = [None] * workers
+        self._processes: list["mp.Process | None"] = [None] * workers
+        self._ready = [False] * workers
+        for i in range(workers):
+            self._start_worker(i)
+
+        # ---全てのワーカーがモデルを読み込むまで待つ
+        self.names_osara: dict[int, str] = {}
+        self.names_shohin: dict[int, str] = {}
+        # "error"を送る前に落ちた(segfault・OOM killなど)ワーカーも、exitcodeで見つける
+        while not all(self._ready):
+            try:
+                kind, worker_id, payload = self._result_queue.get(timeout=liveness_interval)
+            except queue.Empty:
+                dead = [
+                    (i, process.exitcode)
+                    for i, process in enumerate(self._processes)
+                    if not self._ready[i] and not process.is_alive()
+                ]
+                if dead:
+                    self.close()
+                    raise RuntimeError(f"inference workers exited while loading models (worker, exitcode): {dead}")
+                continue
+            if kind == "error":
+                self.close()
+                raise RuntimeError(f"inference worker {worker_id} failed to start: {payload}")
+            if kind != "ready":
+                continue
+            self._ready[worker_id] = True
+            self.names_osara, self.names_shohin = payload
+
+        self._requests: dict[int, _PoolRequest] = {}
+        self._request_ids = count()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._receiver = threading.Thread(
+            target=self._receive, name="inference_worker_pool", daemon=True
+        )
+        self._receiver.start()
+
+    def __repr__(self):
+        return f"InferenceWorkerPool(workers={self.workers}, slots={self.slots}, slot_bytes={self.slot_bytes})"
+
+    def _start_worker(self, worker_id: int):
+        """worker_id番目のワーカーを(起動し直す場合も)起動する"""
+        self._task_queues[worker_id] = self._ctx.Queue()
+        process = self._ctx.Process(
+            target=_worker_main,
+            args=(
+                worker_id,
+                self._shm.name,
+                self.slot_bytes,
+                self._task_queues[worker_id],
+                self._result_queue,
+                *self._worker_args,
+            ),
+            name=f"inference_worker_{worker_id}",
+            daemon=True,
+        )
+        self._ready[worker_id] = False
+        self._processes[worker_id] = process
+        process.start()
+
+    def submit(self, frame: np.ndarray) -> Future:
+        """画像を共有メモリのスロットに書き込み、ワーカーに推論を依頼する
+
+        Args:
+            frame (np.ndarray): 推論する画像(BGR, uint8)
+
+        Returns:
+            Future: (お皿モデルの結果, 商品モデルの結果)を返すFuture
+        """
+        if self._closed:
+            raise RuntimeError("InferenceWorkerPool is closed")
+        if frame.dtype != np.uint8 or frame.nbytes > self.slot_bytes:
+            raise ValueError(
+                f"frame must be uint8 and <= {self.slot_bytes} bytes: {frame.shape} {frame.dtype}"
+            )
+
+        # ---空いているスロットに画像を書き込む(空くまで待つ)
+        try:
+            slot = self._free_slots.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError(f"no free slot in {self.timeout}s (all {self.slots} slots are in use)")
+        slot_view = np.ndarray(
+            frame.shape, dtype=np.uint8, buffer=self._shm.buf, offset=slot * self.slot_bytes
+        )
+        slot_view[...] = frame
+        del slot_view
+
+        # ---推論中のリクエストがいちばん少ないワーカーに振り分ける(読み込み中のワーカーは後回し)
+        with self._lock:
+            candidates = [i for i, process in enumerate(self._processes) if process is not None]
+            if not candidates:
+                self._free_slots.put(slot)
+                raise RuntimeError("no inference worker is running")
+            in_flight = [0] * self.workers
+            for request in self._requests.values():
+                in_flight[request.worker_id] += 1
+            worker_id = min(candidates, key=lambda i: (not self._ready[i], in_flight[i]))
+            request_id = next(self._request_ids)
+            request = _PoolRequest(frame, slot, worker_id)
+            self._requests[request_id] = request
+            self._task_queues[worker_id].put((request_id, slot, frame.shape))
+        return request.future
+
+    def detect(self, frame: np.ndarray, timeout: float | None = ...) -> Tuple[Yolov9Result, Yolov9Result]:
+        """画像を推論し、終わるまで待つ。detect_osara_shohinと同じ値を返す
+
+        Args:
+            frame (np.ndarray): 推論する画像
+            timeout (float | None, optional): 結果を待つ時間(秒)。超えたらTimeoutError. Defaults to self.timeout.
+
+        Returns:
+            Tuple[Yolov9Result, Yolov9Result]: お皿モデルの結果、商品モデルの結果
+        """
+        timeout = self.timeout if timeout is ... else timeout
+        return self.submit(frame).result(timeout=timeout)
+
+    def qsize(self) -> int:
+        """推論待ちのリクエスト数を返す"""
+        with self._lock:
+            return len(self._requests)
+
+    def close(self):
+        """ワーカーを止め、共有メモリを解放する。受け付けたリクエストは推論してから止まる"""
+        if getattr(self, "_closed", False):
+            return
+        self._closed = True
+        for task_queue, process in zip(self._task_queues, self._processes):
+            if process is not None:
+                task_queue.put(None)
+        for process in self._processes:
+            if process is None:
+                continue
+            process.join(timeout=30)
+            if process.is_alive():
+                process.terminate()
+        self._result_queue.put(("stop", None, None))
+        if hasattr(self, "_receiver"):
+            self._receiver.join()
+        self._shm.close()
+        self._shm.unlink()
+
+    def _to_result(self, frame: np.ndarray, compact: CompactDetections, names: dict[int, str]) -> Yolov9Result:
+        xyxy, conf, cls = compact
+        return {
+            "image": frame,
+            "path": None,
+            "boxes": Yolov9Detections(xyxy, conf, cls, names),
+            "annotator": None,
+        }
+
+    def _check_workers(self):
+        """落ちたワーカー(OOMなど)を見つけたら、そのワーカーのリクエストを失敗にしてスロットを返し、起動し直す。
+        モデルを読み込む前に落ちた(起動し直しに失敗した)ワーカーは、これ以上起動し直さない"""
+        for worker_id, process in enumerate(self._processes):
+            if process is None or process.is_alive() or self._closed:
+                continue
+            with self._lock:
+                lost = {
+                    request_id: request
+                    for request_id, request in self._requests.items()
+                    if request.worker_id == worker_id
+                }
+                for request_id in lost:
+                    del self._requests[request_id]
+            # "ready"の前に落ちたワーカーは、読み込みで失敗している。"error"より先にここに来ても、起動し直さない
+            gave_up = not self._ready[worker_id]
+            print(
+                f"\033[31m[InferenceWorkerPool] worker {worker_id} died (exitcode={process.exitcode}), "
+                f"failing {len(lost)} requests and {'giving up' if gave_up else 'restarting'}\033[0m"
+            )
+            # 落ちたワーカーはもうスロットを読まないので、スロットを返してよい
+            for request in lost.values():
+                self._free_slots.put(request.slot)
+                request.future.set_exception(
+                    RuntimeError(f"inference worker {worker_id} died (exitcode={process.exitcode})")
+                )
+            if gave_up:
+                with self._lock:
+                    self._processes[worker_id] = None
+            else:
+                self._start_worker(worker_id)
+
+    def _receive(self):
+        last_check = time.monotonic()
+        while True:
+            # ---一定時間ごとに、ワーカーが生きているかを確かめる
+            if time.monotonic() - last_check >= self.liveness_interval:
+                self._check_workers()
+                last_check = time.monotonic()
+            try:
+                kind, request_id, payload = self._result_queue.get(timeout=self.liveness_interval)
+            except queue.Empty:
+                continue
+            if kind == "stop":
+                break
+            if kind == "timings":
+                observe_stages(payload)
+                continue
+            if kind == "ready":
+                # 起動し直したワーカーの読み込みが終わった
+                self._ready[request_id] = True
+                continue
+            if kind == "error":
+                # 起動し直したワーカーが、モデルを読み込めなかった。
+                # ワーカーはこのあと終わり、_check_workersで(readyではないので)起動し直さずに外す
+                print(f"\033[31m[InferenceWorkerPool] worker {request_id} failed to restart: {payload}\033[0m")
+                continue
+            if kind != "result":
+                continue
+
+            slot, compact, error = payload
+            with self._lock:
+                request = self._requests.pop(request_id, None)
+            if request is None:
+                # 落ちたワーカーの結果。スロットは_check_workersで返している
+                continue
+            self._free_slots.put(slot)
+            if error is not None:
+                print(f"\033[31m[InferenceWorkerPool] Error: {error}\033[0m")
+                request.future.set_exception(RuntimeError(error))
+                continue
+            compact_osara, compact_shohin = compact
+            request.future.set_result(
+                (
+                    self._to_result(request.frame, compact_osara, self.names_osara),
+                    self._to_result(request.frame, compact_shohin, self.names_shohin),
+                )
+            )
@@ -0,0 +1,184 @@
+"""
+# JobQueue.py
+会計の推論を、HTTPのワーカーから切り離して非同期に処理するためのモジュール。
+
+## 仕組み
+- submit()でジョブをキューに入れ、すぐにジョブID(Job.id)を返す
+- ワーカースレッドがキューからジョブを取り出し、handlerで処理する
+- 処理が終わったら、on_doneが呼ばれる(Socket.IOで端末のroomに結果を送るなど)
+- キューが満杯(max_queue_size)のときは、JobQueueFullを投げる(HTTPでは503を返す)
+- 結果は、get()で後から取り出せる(ポーリング用)。古いものからkeep_results件を超えた分は捨てる
+
+## 使用例
+```python
+job_queue = JobQueue(checkout_frame, max_queue_size=8, on_done=emit_result)
+
+try:
+    job = job_queue.submit(frame, room=uuid)
+except JobQueueFull:
+    ...  # 503を返す
+
+job_queue.get(job.id).status  # "queued", "running", "done", "error"
+```
+"""
+
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Callable, Literal
+
+JobStatus = Literal["queued", "running", "done", "error"]
+
+
+class JobQueueFull(Exception):
+    """キューが満杯で、ジョブを受け付けられない"""
+
+
+class Job:
+    """キューに入れるジョブ"""
+
+    __slots__ = (
+        "id",
+        "payload",
+        "room",
+        "status",
+        "result",
+        "error",
+        "created_at",
+        "finished_at",
+    )
+
+    def __init__(self, payload: Any, room: str | None = None):
+        self.id = uuid.uuid4().hex
+        self.payload = payload
+        self.room = room
+        self.status: JobStatus = "queued"
+        self.result: Any = None
+        self.error: str | None = None
+        self.created_at = time.time()
+        self.finished_at: float | None = None
+
+    def __repr__(self):
+        return f"Job(id={self.id}, room={self.room}, status={self.status})"
+
+    def to_dict(self) -> dict:
+        """ポーリング用のレスポンスにする(payloadは含めない)"""
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class JobQueue:
+    def __init__(
+        self,
+        handler: Callable[[Any], Any],
+        max_queue_size: int = 8,
+        workers: int = 1,
+        on_done: Callable[[Job], None] | None = None,
+        keep_results: int = 256,
+    ):
+        """上限付きのキューと、ワーカースレッドでジョブを処理するクラス
+
+        Args:
+            handler (Callable[[Any], Any]): ジョブのpayloadを受け取り、結果を返す関数
+            max_queue_size (int, optional): 処理待ちのジョブの上限。超えるとsubmitがJobQueueFullを投げる. Defaults to 8.
+            workers (int, optional): ワーカースレッドの数. Defaults to 1.
+            on_done (Callable[[Job], None] | None, optional): ジョブが終わったとき(成功・失敗とも)に呼ぶ関数. Defaults to None.
+            keep_results (int, optional): get()で取り出せるように残しておくジョブの数. Defaults to 256.
+        """
+        if max_queue_size < 1:
+            raise ValueError("max_queue_size must be >= 1")
+        self.handler = handler
+        self.max_queue_size = max_queue_size
+        self.on_done = on_done
+        self.keep_results = keep_results
+
+        self._queue: queue.Queue[Job | None] = queue.Queue(maxsize=max_queue_size)
+        self._jobs: OrderedDict[str, Job] = OrderedDict()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._threads = [
+            threading.Thread(target=self._run, name=f"job_queue_{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def __repr__(self):
+        return f"JobQueue(qsize={self.qsize()}, max_queue_size={self.max_queue_size}, workers={len(self._threads)})"
+
+    def submit(self, payload: Any, room: str | None = None) -> Job:
+        """ジョブをキューに入れる。処理は待たない
+
+        Args:
+            payload (Any): handlerに渡すデータ
+            room (str | None, optional): 結果を送るSocket.IOのroom(端末のUUID). Defaults to None.
+
+        Raises:
+            JobQueueFull: キューが満杯の場合
+
+        Returns:
+            Job: 入れたジョブ
+        """
+        if self._closed:
+            raise RuntimeError("JobQueue is closed")
+        job = Job(payload, room)
+        # ワーカーが先に処理を終えてもget()で見つかるように、キューに入れる前に登録しておく
+        with self._lock:
+            self._jobs[job.id] = job
+            while len(self._jobs) > self.keep_results:
+                self._jobs.popitem(last=False)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                self._jobs.pop(job.id, None)
+            raise JobQueueFull(f"queue is full ({self.max_queue_size})")
+        return job
+
+    def get(self, job_id: str) -> Job | None:
+        """ジョブIDからジョブを取り出す。ない(古くて捨てた)場合はNone"""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def qsize(self) -> int:
+        """処理待ちのジョブの数を返す"""
+        return self._queue.qsize()
+
+    def close(self):
+        """ワーカーを止める。キューに残っているジョブは処理してから止まる"""
+        if self._closed:
+            return
+        self._closed = True
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+
+            job.status = "running"
+            try:
+                job.result = self.handler(job.payload)
+                job.status = "done"
+            except Exception as e:
+                print(f"\033[31m[JobQueue] Error: {e}\033[0m")
+                job.error = str(e)
+                job.status = "error"
+            job.payload = None  # 画像はもう使わないので、すぐに解放する
+            job.finished_at = time.time()
+
+            if self.on_done is not None:
+                try:
+                    self.on_done(job)
+                except Exception as e:
+                    print(f"\033[31m[JobQueue] on_done Error: {e}\033[0m")
@@ -0,0 +1,254 @@
+"""
+# MenuSearch.py
+メニューの部分一致検索(/search_menu)を、メニュー数に関係なく速く返すための検索インデックス。
+ラベル付けの画面では1文字入力するたびに検索されるので、全件の部分文字列の比較をやめる。
+
+## 仕組み
+- 検索する文字列は、normalizeで正規化してから比べる
+    - NFKC(全角英数字・半角カナを揃える) → カタカナをひらがなに → 小文字 → 空白を除く
+    - 「ｶﾚｰ」「カレー」「かれー」、「KARE」「ｋａｒｅ」「kare」が同じになる
+- 結果は、完全一致 → 前方一致 → 単語の前方一致 → 部分一致、の順に並べ、同じ順位なら短い名前を先にする
+- インデックスのIDのリストは、全て短い名前の順に並べておき、順位の高いものから順に見て、limit件集まったら止める
+  (一致する件数が多くても、検索時間はlimitでほぼ決まる)
+    - 完全一致・前方一致: 名前全体のトライ木
+    - 単語の前方一致: 2つ目以降の単語の先頭からのトライ木
+    - 部分一致(2文字以上のクエリ): 文字のbigram(2文字ずつ)の転置インデックスのうち、
+      いちばん件数が少ないbigramのリストを見て、部分文字列で確かめる
+- 1文字のクエリと、前方一致(prefix=True)の検索では、部分一致は探さない(1文字の部分一致は、ほぼ全件になるため)
+
+## 使用例
+```python
+index = MenuSearchIndex(menu.values())
+index.search("かれー", fields=("display_name", "romaji"), limit=20)  # list[MenuObject]
+```
+
+## 開発メモ
+- インデックスは読み込み時に作り、検索中は書き換えない(ロックなしで複数スレッドから使える)
+- ひらがなとローマ字の変換(「かれー」で「KARE」を探すなど)はしない。display_nameとromajiをそれぞれ探す
+"""
+
+import heapq
+import re
+import unicodedata
+from typing import Iterable, Iterator, Tuple
+
+from modules.Types import MenuObject
+
+# 部分一致で検索するキー
+SEARCH_FIELDS: Tuple[str, ...] = ("display_name", "romaji")
+
+# 名前を単語に分ける区切り(単語の前方一致用)
+_WORD_SEPARATOR = re.compile(r"[\s・/()（）]+")
+_WHITESPACE = re.compile(r"\s+")
+
+# カタカナ(ァ-ヶ)をひらがなに変換する表
+_KATAKANA_TO_HIRAGANA = {code: code - 0x60 for code in range(ord("ァ"), ord("ヶ") + 1)}
+
+# 順位(小さいほど上)
+RANK_EXACT = 0
+RANK_PREFIX = 1
+RANK_WORD_PREFIX = 2
+RANK_SUBSTRING = 3
+
+
+def normalize(text: str) -> str:
+    """検索用に文字列を正規化する(NFKC → カタカナをひらがなに → 小文字 → 空白を除く)
+
+    Args:
+        text (str): 文字列
+
+    Returns:
+        str: 正規化した文字列
+    """
+    text = unicodedata.normalize("NFKC", text or "")
+    return _WHITESPACE.sub("", text.translate(_KATAKANA_TO_HIRAGANA).lower())
+
+
+def bigrams(text: str) -> set[str]:
+    """正規化した文字列の、2文字ずつの組(bigram)の集合"""
+    return {text[i : i + 2] for i in range(len(text) - 1)}
+
+
+class _TrieNode:
+    __slots__ = ("children", "ids")
+
+    def __init__(self):
+        self.children: dict[str, _TrieNode] = {}
+        self.ids: list[int] = []  # このノードを通る(この接頭辞から始まる)メニューのID。短い名前の順
+
+
+class MenuSearchIndex:
+    def __init__(self, menu_objects: Iterable[MenuObject], fields: Tuple[str, ...] = SEARCH_FIELDS):
+        """メニューの部分一致検索用のインデックス
+
+        Args:
+            menu_objects (Iterable[MenuObject]): 検索対象のメニュー
+            fields (Tuple[str, ...], optional): 検索するキー. Defaults to SEARCH_FIELDS.
+        """
+        self.fields = tuple(fields)
+        self.menu_objects: list[MenuObject] = list(menu_objects)
+        # キー -> メニューIDごとの、正規化した値
+        self.normalized: dict[str, list[str]] = {field: [] for field in self.fields}
+        # キー -> 正規化した値の単語ごとの先頭位置(単語の前方一致の判定用)
+        self.word_starts: dict[str, list[tuple[int, ...]]] = {field: [] for field in self.fields}
+        # キー -> bigram -> メニューIDのリスト(短い名前の順)
+        self.bigram_index: dict[str, dict[str, list[int]]] = {field: {} for field in self.fields}
+        # キー -> 名前全体の前方一致のトライ木の根
+        self.tries: dict[str, _TrieNode] = {field: _TrieNode() for field in self.fields}
+        # キー -> 2つ目以降の単語の前方一致のトライ木の根
+        self.word_tries: dict[str, _TrieNode] = {field: _TrieNode() for field in self.fields}
+
+        for field in self.fields:
+            for menu_object in self.menu_objects:
+                self._normalize(field, str(menu_object.get(field) or ""))
+            # 短い名前(同じ長さならメニューIDが小さい)順に追加し、インデックスのIDのリストをその順に並べる
+            # 検索では、リストの先頭から見て、limit件集まったら止められる
+            order = sorted(range(len(self.menu_objects)), key=lambda i: (len(self.normalized[field][i]), i))
+            for menu_id in order:
+                self._add(field, menu_id)
+
+    def __repr__(self):
+        return f"MenuSearchIndex(menus={len(self.menu_objects)}, fields={self.fields})"
+
+    def __len__(self):
+        return len(self.menu_objects)
+
+    def _normalize(self, field: str, value: str):
+        """1つのメニューの、1つのキーの値を正規化して、単語の先頭位置と一緒に記録する"""
+        words = [normalize(word) for word in _WORD_SEPARATOR.split(value)]
+        words = [word for word in words if word]
+        starts: list[int] = []
+        position = 0
+        for word in words:
+            starts.append(position)
+            position += len(word)
+        self.normalized[field].append("".join(words))
+        self.word_starts[field].append(tuple(starts))
+
+    def _add(self, field: str, menu_id: int):
+        """1つのメニューの、1つのキーの値をインデックスに追加する"""
+        text = self.normalized[field][menu_id]
+        postings = self.bigram_index[field]
+        for gram in bigrams(text):
+            postings.setdefault(gram, []).append(menu_id)
+
+        # 名前全体はtriesに、2つ目以降の単語の先頭からはword_triesに入れる
+        for start in self.word_starts[field][menu_id]:
+            node = self.tries[field] if start == 0 else self.word_tries[field]
+            for char in text[start:]:
+                node = node.children.setdefault(char, _TrieNode())
+                if not node.ids or node.ids[-1] != menu_id:
+                    node.ids.append(menu_id)
+
+    @staticmethod
+    def _find_node(root: _TrieNode, query: str) -> _TrieNode | None:
+        node = root
+        for char in query:
+            node = node.children.get(char)
+            if node is None:
+                return None
+        return node
+
+    def _rank(self, field: str, menu_id: int, query: str) -> int | None:
+        """メニューのキーの値が、クエリにどの順位で一致するか。一致しなければNone"""
+        text = self.normalized[field][menu_id]
+        position = text.find(query)
+        if position < 0:
+            return None
+        if text == query:
+            return RANK_EXACT
+        if position == 0:
+            return RANK_PREFIX
+        starts = self.word_starts[field][menu_id]
+        if position in starts or any(text.startswith(query, start) for start in starts):
+            return RANK_WORD_PREFIX
+        return RANK_SUBSTRING
+
+    def _search_field(
+        self, field: str, query: str, limit: int | None, prefix: bool
+    ) -> Iterator[tuple[int, int, int]]:
+        """1つのキーで一致したメニューの(順位, 名前の長さ, メニューID)を、上位から順に返す。
+        順位ごとのインデックスを順に見て、limit件返したら止める
+
+        - 完全一致・前方一致: triesのノードのID(短い順なので、完全一致が先に来る)
+        - 単語の前方一致: word_triesのノードのID(名前全体でも前方一致するものは、もう返しているので除く)
+        - 部分一致: クエリのbigramのうち、いちばん件数が少ないもののID(上の順位のものは除く)
+        """
+        texts = self.normalized[field]
+        remaining = limit if limit is not None else len(self.menu_objects)
+        if remaining <= 0:
+            return
+
+        # ---完全一致・前方一致
+        node = self._find_node(self.tries[field], query)
+        for menu_id in node.ids if node is not None else ():
+            rank = RANK_EXACT if len(texts[menu_id]) == len(query) else RANK_PREFIX
+            yield rank, len(texts[menu_id]), menu_id
+            remaining -= 1
+            if remaining == 0:
+                return
+
+        # ---単語の前方一致
+        node = self._find_node(self.word_tries[field], query)
+        for menu_id in node.ids if node is not None else ():
+            if texts[menu_id].startswith(query):
+                continue
+            yield RANK_WORD_PREFIX, len(texts[menu_id]), menu_id
+            remaining -= 1
+            if remaining == 0:
+                return
+
+        # ---部分一致(1文字の部分一致は候補が多すぎて、ほぼ全件になるので探さない)
+        if prefix or len(query) == 1:
+            return
+        postings = self.bigram_index[field]
+        smallest: list[int] | None = None
+        for gram in bigrams(query):
+            ids = postings.get(gram)
+            if not ids:
+                return
+            if smallest is None or len(ids) < len(smallest):
+                smallest = ids
+        for menu_id in smallest:
+            if self._rank(field, menu_id, query) != RANK_SUBSTRING:
+                continue
+            yield RANK_SUBSTRING, len(texts[menu_id]), menu_id
+            remaining -= 1
+            if remaining == 0:
+                return
+
+    def search(
+        self,
+        query: str,
+        fields: Tuple[str, ...] | None = None,
+        limit: int | None = 20,
+        prefix: bool = False,
+    ) -> list[MenuObject]:
+        """メニューを部分一致で検索し、一致の順位の高い順に返す
+
+        Args:
+            query (str): 検索する文字列(正規化してから比べる)
+            fields (Tuple[str, ...] | None, optional): 検索するキー。Noneの場合は全てのキー. Defaults to None.
+            limit (int | None, optional): 返す最大件数。Noneの場合は全件. Defaults to 20.
+            prefix (bool, optional): Trueの場合、名前または単語の前方一致だけを返す. Defaults to False.
+
+        Returns:
+            list[MenuObject]: 検索結果のメニューオブジェクトのリスト
+        """
+        query = normalize(query)
+        if not query:
+            return []
+        fields = self.fields if fields is None else tuple(field for field in fields if field in self.tries)
+
+        # メニューID -> (順位, 名前の長さ, メニューID)。複数のキーで一致したら、いちばん上の順位にする
+        # キーごとの上位limit件をまとめれば、全体の上位limit件が必ず含まれる
+        best: dict[int, tuple[int, int, int]] = {}
+        for field in fields:
+            for key in self._search_field(field, query, limit, prefix):
+                menu_id = key[2]
+                if menu_id not in best or key < best[menu_id]:
+                    best[menu_id] = key
+
+        keys = best.values()
+        ordered = sorted(keys) if limit is None else heapq.nsmallest(limit, keys)
+        return [self.menu_objects[menu_id] for _, _, menu_id in ordered]
@@ -0,0 +1,259 @@
+"""
+# Metrics.py
+会計の処理時間(段階ごと)やリクエスト数を記録し、Prometheusのテキスト形式で出力するモジュール。
+/metricsでPrometheusから収集し、histogram_quantileでp95・p99の悪化を見る。
+
+## 仕組み
+- Histogram: 処理時間などの分布。バケットごとの件数・合計・件数を持つ
+- Counter: 増えるだけの値(リクエスト数など)
+- Gauge: 出力するときに関数を呼んで値を取る(キューの長さなど)
+- ラベルごとに値を分けて持つ(例: stage="decode")
+- 外部のライブラリは使わない(prometheus_clientが入っていない端末でも動くように)
+
+## 使用例
+```python
+from modules.Metrics import METRICS, STAGE_SECONDS
+
+with STAGE_SECONDS.time(stage="decode"):
+    frame = request_to_ndarray(request)
+
+METRICS.render()  # Prometheusのテキスト形式
+```
+
+## 開発メモ
+- 値はプロセスごとに持つ。gunicornでワーカーを複数にした場合は、ワーカーごとの値になる
+    - /metricsでは、全ての値にworker_pidのラベルをつける(render(const_labels=...))。
+      どのワーカーの値かを区別でき、ワーカーが入れ替わってもカウンタのリセットとして扱われる
+- 時間の単位は秒(Prometheusの慣習)
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+# 1ms〜10sまで。会計の各段階(数ms)から、リクエスト全体(数百ms)まで見られるように
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.075,
+    0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames: tuple[str, ...], labelvalues: tuple[str, ...], *extra: str) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labelvalues)]
+    pairs.extend(label for label in extra if label)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """ラベルごとに値を持つメトリクスの共通部分"""
+
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(name={self.name}, labelnames={self.labelnames})"
+
+    def _labelvalues(self, labels: dict[str, str]) -> tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: labels must be {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _header(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type_name}",
+        ]
+
+    def collect(self, const_labels: str = "") -> list[str]:
+        """Prometheusのテキスト形式の行を返す
+
+        Args:
+            const_labels (str, optional): 全ての値につけるラベル(例: 'worker_pid="123"'). Defaults to "".
+        """
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, value: float = 1, **labels: str):
+        """値を増やす"""
+        if value < 0:
+            raise ValueError("Counter can only be incremented")
+        key = self._labelvalues(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def collect(self, const_labels: str = "") -> list[str]:
+        with self._lock:
+            values = dict(self._values)
+        lines = self._header()
+        for key, value in values.items():
+            lines.append(
+                f"{self.name}{_format_labels(self.labelnames, key, const_labels)} {_format_value(value)}"
+            )
+        return lines
+
+
+class Gauge(_Metric):
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, fn: Callable[[], float]):
+        """出力するときにfnを呼んで値を取るGauge
+
+        Args:
+            name (str): メトリクス名
+            documentation (str): 説明
+            fn (Callable[[], float]): 値を返す関数。例外を投げた場合は出力しない
+        """
+        super().__init__(name, documentation)
+        self.fn = fn
+
+    def collect(self, const_labels: str = "") -> list[str]:
+        try:
+            value = self.fn()
+        except Exception:
+            return []
+        return self._header() + [f"{self.name}{_format_labels((), (), const_labels)} {_format_value(value)}"]
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # ラベル -> [各バケットの件数(累積ではない), 合計, 件数]
+        self._values: dict[tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels: str):
+        """値を1つ記録する"""
+        key = self._labelvalues(labels)
+        index = next(i for i, bound in enumerate(self.buckets) if value <= bound)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """withで囲んだ部分の処理時間(秒)を記録する"""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def collect(self, const_labels: str = "") -> list[str]:
+        with self._lock:
+            values = {key: (list(counts), total, n) for key, (counts, total, n) in self._values.items()}
+        lines = self._header()
+        for key, (counts, total, n) in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(self.labelnames, key, const_labels, le)} {cumulative}"
+                )
+            labels = _format_labels(self.labelnames, key, const_labels)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {n}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        """メトリクスをまとめて、Prometheusのテキスト形式で出力するクラス"""
+        self._metrics: dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"MetricsRegistry(metrics={list(self._metrics)})"
+
+    def register(self, metric: _Metric) -> _Metric:
+        """メトリクスを登録する。同じ名前がある場合は置き換える"""
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, fn: Callable[[], float]) -> Gauge:
+        return self.register(Gauge(name, documentation, fn))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self, const_labels: dict[str, str] | None = None) -> str:
+        """全てのメトリクスを、Prometheusのテキスト形式(text/plain; version=0.0.4)にする
+
+        Args:
+            const_labels (dict[str, str] | None, optional): 全ての値につけるラベル(例: {"worker_pid": "123"}). Defaults to None.
+
+        Returns:
+            str: Prometheusのテキスト形式
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        const = ",".join(f'{name}="{_escape(str(value))}"' for name, value in (const_labels or {}).items())
+        lines: list[str] = []
+        for metric in metrics:
+            lines.extend(metric.collect(const))
+        return "\n".join(lines) + "\n"
+
+
+# ---会計のパイプラインで共通して使うメトリクス
+METRICS = MetricsRegistry()
+
+STAGE_SECONDS = METRICS.histogram(
+    "checkout_stage_seconds",
+    "Latency of each checkout pipeline stage in seconds.",
+    labelnames=("stage",),
+)
+
+
+def observe_stages(timings: dict[str, float]):
+    """段階ごとの処理時間(秒)をまとめてSTAGE_SECONDSに記録する
+
+    Args:
+        timings (dict[str, float]): 段階名 -> 処理時間(秒)。detect_osara_shohin_batchのtimingsなど
+    """
+    for stage, seconds in timings.items():
+        STAGE_SECONDS.observe(seconds, stage=stage)
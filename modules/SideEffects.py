@@ -0,0 +1,139 @@
+"""
+# SideEffects.py
+会計の結果に付随する副作用(デバッグ用の検出画像の保存・サーバー側での音声の再生)を、
+リクエストのスレッドから切り離してバックグラウンドで行うモジュール。
+
+## 仕組み
+- リクエストのスレッドは、snapshot()・play_audio()でキューに入れるだけ(待たない)
+- ワーカースレッドが、検出画像の描画・保存や音声の再生を行う
+- キューが満杯のときは、副作用は捨てる(会計のレスポンスを遅らせない)
+- 検出画像は、snapshot_rateの割合で間引き、`detected_image_00.jpg`〜の決まった枚数のファイルを順番に上書きする
+    - SDカードのRaspberry Piでも、書き込み回数・容量が増え続けないように
+- 音声は、simpleaudioで再生する。読み込んだwavはキャッシュし、前の音声が鳴っていたら止めてから再生する
+
+## 使用例
+```python
+side_effects = SideEffectWorker(render=render_fn, snapshot_rate=0.1, snapshot_ring_size=20)
+
+side_effects.snapshot(frame, boxes)  # 10%の確率で、描画して保存する
+side_effects.play_audio("jph/voices/01_いらっしゃいませなのだ.wav")
+```
+"""
+
+import os
+import queue
+import random
+import threading
+from typing import Any, Callable
+
+import cv2
+import numpy as np
+
+
+class SideEffectWorker:
+    def __init__(
+        self,
+        render: Callable[[np.ndarray, Any], np.ndarray] | None = None,
+        snapshot_dir: str = "output",
+        snapshot_rate: float = 0.0,
+        snapshot_ring_size: int = 10,
+        play_audio: bool = True,
+        max_queue_size: int = 32,
+    ):
+        """副作用をバックグラウンドで処理するクラス
+
+        Args:
+            render (Callable[[np.ndarray, Any], np.ndarray] | None, optional): 元画像と結果から、検出画像を描画する関数. Defaults to None(元画像をそのまま保存).
+            snapshot_dir (str, optional): 検出画像の保存先. Defaults to "output".
+            snapshot_rate (float, optional): 検出画像を保存する割合(0-1)。0で保存しない. Defaults to 0.0.
+            snapshot_ring_size (int, optional): 検出画像のファイル数。古いものから上書きする. Defaults to 10.
+            play_audio (bool, optional): Falseの場合、音声を再生しない. Defaults to True.
+            max_queue_size (int, optional): 処理待ちの副作用の上限。超えた分は捨てる. Defaults to 32.
+        """
+        self.render = render
+        self.snapshot_dir = snapshot_dir
+        self.snapshot_rate = snapshot_rate
+        self.snapshot_ring_size = max(1, snapshot_ring_size)
+        self.play_audio_enabled = play_audio
+
+        self._snapshot_index = 0
+        self._wave_objects: dict[str, Any] = {}  # wavのパス -> simpleaudio.WaveObject
+        self._play_object = None  # 再生中のsimpleaudio.PlayObject
+        self._queue: queue.Queue[tuple[Callable, tuple] | None] = queue.Queue(
+            maxsize=max_queue_size
+        )
+        self._thread = threading.Thread(
+            target=self._run, name="side_effects", daemon=True
+        )
+        self._thread.start()
+
+    def __repr__(self):
+        return f"SideEffectWorker(snapshot_rate={self.snapshot_rate}, snapshot_ring_size={self.snapshot_ring_size}, play_audio={self.play_audio_enabled})"
+
+    def snapshot(self, frame: np.ndarray, boxes: Any):
+        """snapshot_rateの割合で、検出画像の描画・保存をキューに入れる
+
+        Args:
+            frame (np.ndarray): 元画像
+            boxes (Any): renderに渡す結果
+        """
+        if self.snapshot_rate <= 0 or random.random() >= self.snapshot_rate:
+            return
+        self._put(self._write_snapshot, (frame, boxes))
+
+    def play_audio(self, audio_path: str):
+        """音声の再生をキューに入れる
+
+        Args:
+            audio_path (str): wavファイルのパス
+        """
+        if not self.play_audio_enabled:
+            return
+        self._put(self._play, (audio_path,))
+
+    def qsize(self) -> int:
+        """処理待ちの副作用の数を返す"""
+        return self._queue.qsize()
+
+    def close(self):
+        """ワーカーを止める。キューに残っている副作用は処理してから止まる"""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _put(self, fn: Callable, args: tuple):
+        try:
+            self._queue.put_nowait((fn, args))
+        except queue.Full:
+            print(f"\033[33m[SideEffectWorker] queue is full, dropped {fn.__name__}\033[0m")
+
+    def _write_snapshot(self, frame: np.ndarray, boxes: Any):
+        image = self.render(frame, boxes) if self.render is not None else frame
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        path = os.path.join(
+            self.snapshot_dir, f"detected_image_{self._snapshot_index:02d}.jpg"
+        )
+        cv2.imwrite(path, image)
+        self._snapshot_index = (self._snapshot_index + 1) % self.snapshot_ring_size
+
+    def _play(self, audio_path: str):
+        import simpleaudio
+
+        wave_object = self._wave_objects.get(audio_path)
+        if wave_object is None:
+            wave_object = simpleaudio.WaveObject.from_wave_file(audio_path)
+            self._wave_objects[audio_path] = wave_object
+        # 前の音声が鳴っていたら止める(重ねて再生しない)
+        if self._play_object is not None and self._play_object.is_playing():
+            self._play_object.stop()
+        self._play_object = wave_object.play()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            fn, args = item
+            try:
+                fn(*args)
+            except Exception as e:
+                print(f"\033[31m[SideEffectWorker] {fn.__name__} Error: {e}\033[0m")
@@ -2,10 +2,10 @@
 # Types.py
 各種データクラスを定義するモジュール。
 
-MenuObject, OsaraShohinResultBox, OsaraShohinResultの3つのデータクラスを定義する。
+MenuObject, OsaraShohinResultBox, OsaraShohinBoxes, OsaraShohinResultのデータクラスを定義する。
 """
 
-from typing import Literal, Tuple, TypedDict
+from typing import Iterator, Literal, Tuple, TypedDict
 import numpy as np
 
 
@@ -100,6 +100,127 @@ class OsaraShohinResultBox(TypedDict):
         return f"OsaraShohinResultBox(label={self.label}, osara_type={self.osara_type}, confidence={self.confidence}, bbox={self.xyxy})"
 
 
+class OsaraShohinBoxes:
+    """OsaraShohinResultのboxesを、列ごとの配列で保持するクラス。
+
+    - list[OsaraShohinResultBox]と同じように、len・インデックス・forで各bboxのdictを取り出せる
+        - 取り出したdictはコピーなので、書き込んでも反映されない。menu_objectはset_menu_objectで設定する
+    - スライスすると、配列のビュー(コピーなし)を持つOsaraShohinBoxesを返す
+    - インデックスの配列・boolの配列で取り出すと、その行だけを持つOsaraShohinBoxes(コピー)を返す(トレーごとに分けるときなど)
+    - to_jsonで、従来と同じ形式(list[OsaraShohinResultBox])のJSON用データに変換する
+
+    Example:
+    ```py
+    boxes.labels  # (n,) object。ラベル。お皿だけの場合はNone
+    boxes.osara_types  # (n,) object。お皿の種類
+    boxes.confidence  # (n,) float32。確信度
+    boxes.xyxy  # (n, 4) float32。bboxの座標(0-1)
+    boxes.menu_objects  # (n,) object。メニューオブジェクト
+    ```
+    """
+
+    __slots__ = ("labels", "osara_types", "confidence", "xyxy", "menu_objects")
+
+    def __init__(
+        self,
+        labels: np.ndarray,
+        osara_types: np.ndarray,
+        confidence: np.ndarray,
+        xyxy: np.ndarray,
+        menu_objects: np.ndarray | None = None,
+    ):
+        self.labels = labels
+        self.osara_types = osara_types
+        self.confidence = confidence
+        self.xyxy = xyxy
+        self.menu_objects = (
+            menu_objects
+            if menu_objects is not None
+            else np.full(len(labels), None, dtype=object)
+        )
+
+    @classmethod
+    def from_association(
+        cls, osara, shohin, shohin_indices: np.ndarray
+    ) -> "OsaraShohinBoxes":
+        """お皿と料理の紐づけ結果から作成する
+
+        Args:
+            osara (Yolov9Detections): お皿モデルの検出結果
+            shohin (Yolov9Detections): 商品モデルの検出結果
+            shohin_indices (np.ndarray): 各お皿に紐づいた料理のインデックス。紐づかなかったお皿は-1
+
+        Returns:
+            OsaraShohinBoxes: お皿の順番で並んだ結果。
+                料理が紐づいたお皿は料理のラベル・確信度・座標を、紐づかなかったお皿はお皿の確信度・座標を持つ
+        """
+        associated = shohin_indices >= 0
+        shohin_indices = shohin_indices[associated]
+
+        labels = np.full(len(osara), None, dtype=object)
+        labels[associated] = np.array(shohin.labels, dtype=object)[shohin_indices]
+
+        confidence = osara.conf.copy()
+        confidence[associated] = shohin.conf[shohin_indices]
+
+        xyxy = osara.xyxy.copy()
+        xyxy[associated] = shohin.xyxy[shohin_indices]
+
+        return cls(labels, np.array(osara.labels, dtype=object), confidence, xyxy)
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def __getitem__(
+        self, index: int | slice | np.ndarray
+    ) -> "OsaraShohinResultBox | OsaraShohinBoxes":
+        if isinstance(index, (slice, np.ndarray)):
+            return OsaraShohinBoxes(
+                self.labels[index],
+                self.osara_types[index],
+                self.confidence[index],
+                self.xyxy[index],
+                self.menu_objects[index],
+            )
+        return {
+            "label": self.labels[index],
+            "osara_type": self.osara_types[index],
+            "confidence": float(self.confidence[index]),
+            "xyxy": self.xyxy[index].tolist(),
+            "menu_object": self.menu_objects[index],
+        }
+
+    def __iter__(self) -> Iterator["OsaraShohinResultBox"]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self):
+        return f"OsaraShohinBoxes(labels={self.labels.tolist()}, osara_types={self.osara_types.tolist()})"
+
+    def set_menu_object(self, index: int, menu_object: MenuObject):
+        """index番目のbboxに、メニューオブジェクトを紐づける"""
+        self.menu_objects[index] = menu_object
+
+    def to_json(self) -> list["OsaraShohinResultBox"]:
+        """従来のlist[OsaraShohinResultBox]と同じ形式の、JSONにできるデータに変換する"""
+        return [
+            {
+                "label": label,
+                "osara_type": osara_type,
+                "confidence": confidence,
+                "xyxy": xyxy,
+                "menu_object": menu_object,
+            }
+            for label, osara_type, confidence, xyxy, menu_object in zip(
+                self.labels.tolist(),
+                self.osara_types.tolist(),
+                self.confidence.tolist(),
+                self.xyxy.tolist(),
+                self.menu_objects.tolist(),
+            )
+        ]
+
+
 class OsaraShohinResult(TypedDict):
     """お皿と商品(料理)のペアを意識して推論→補正した結果を格納するデータクラス。
 
@@ -132,7 +253,7 @@ class OsaraShohinResult(TypedDict):
 
     image: np.ndarray  # bboxの画像
     path: str  # 画像のパス
-    boxes: list[OsaraShohinResultBox]  # bboxのリスト
+    boxes: OsaraShohinBoxes  # bboxのリスト(JSONにするときはto_json())
 
     def __repr__(self):
         return f"OsaraShohinResult(image={self.image}, path={self.path}, boxes={self.boxes})"
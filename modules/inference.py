@@ -4,36 +4,543 @@
 inference_osara_shohin関数とか
 """
 
-from typing import TypedDict
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Iterable, Literal, Tuple
 import numpy as np
+import torch
+from scipy.optimize import linear_sum_assignment
 
-from Yolov9Wrapper.Yolov9Wrapper import Yolov9, Yolov9ResultBox
-from modules.Types import OsaraShohinResult, OsaraShohinResultBox
+from Yolov9Wrapper.Yolov9Wrapper import (
+    Yolov9,
+    Yolov9Annotator,
+    Yolov9Detections,
+    Yolov9Result,
+)
+from modules.Metrics import STAGE_SECONDS, observe_stages
+from modules.Types import OsaraShohinBoxes, OsaraShohinResult, OsaraShohinResultBox
+
+if TYPE_CHECKING:
+    from modules.InferenceScheduler import InferenceScheduler
+    from modules.InferenceWorkerPool import InferenceWorkerPool
+
+logger = logging.getLogger(__name__)
+
+# 商品モデルをお皿モデルと並行して動かすためのスレッド。
+# torchの推論中はGILが外れるので、スレッドで並行に動かせる。
+# スレッド数と、1回のforwardのtorchのスレッド数は、configure_parallel_inferenceで決める
+_SHOHIN_WORKERS = 1  # 同時にdetect_osara_shohin_batchを呼ぶ数(スケジューラでまとめる場合は1)
+_FORWARD_THREADS: int | None = None  # 1回のforwardのtorchのスレッド数。Noneの場合は変更しない
+
+
+def _set_torch_threads(threads: int | None):
+    if threads:
+        torch.set_num_threads(threads)
+
+
+def _new_shohin_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(
+        max_workers=_SHOHIN_WORKERS,
+        thread_name_prefix="shohin",
+        initializer=_set_torch_threads,
+        initargs=(_FORWARD_THREADS,),
+    )
+
+
+_SHOHIN_EXECUTOR = _new_shohin_executor()
+
+
+def configure_parallel_inference(concurrency: int = 1, threads: int | None = None):
+    """お皿モデルと商品モデルを並行して推論するときの、スレッドの数を決める
+
+    - 商品モデルのスレッドは、concurrency個にする(同時に推論する全ての会計で、2つのモデルを並行に動かせるように)
+    - 1回のforwardのtorchのスレッド数は、threads // (2 * concurrency)にする
+        - 2つのモデルが並行して動くので、それぞれがthreadsを全部使うと、コアの取り合いになる(Raspberry Piなど)
+
+    Args:
+        concurrency (int, optional): 同時にdetect_osara_shohin_batchを呼ぶ数。
+            InferenceSchedulerでまとめる場合は1、スケジューラなしで会計のスレッドから直接呼ぶ場合はスレッド数. Defaults to 1.
+        threads (int | None, optional): このプロセスで推論に使うコアの数。Noneの場合はCPUのコア数. Defaults to None.
+    """
+    global _SHOHIN_WORKERS, _FORWARD_THREADS, _SHOHIN_EXECUTOR
+    concurrency = max(1, concurrency)
+    threads = threads or os.cpu_count() or 1
+    _SHOHIN_WORKERS = concurrency
+    _FORWARD_THREADS = max(1, threads // (2 * concurrency))
+    _set_torch_threads(_FORWARD_THREADS)
+
+    old_executor, _SHOHIN_EXECUTOR = _SHOHIN_EXECUTOR, _new_shohin_executor()
+    old_executor.shutdown(wait=False)
+
+
+def _reset_shohin_executor():
+    # スレッドはforkで引き継がれないので、fork後(gunicornのワーカー)は作り直す
+    global _SHOHIN_EXECUTOR
+    _SHOHIN_EXECUTOR = _new_shohin_executor()
+
+
+if hasattr(os, "register_at_fork"):  # Windowsにはforkがない
+    os.register_at_fork(after_in_child=_reset_shohin_executor)
+
+
+# ---しきい値を設定する
+# お皿と料理の中心座標の距離が、この値未満の場合に紐づける
+OSARA_SHOHIN_DISTANCE_THRESHOLD = 0.3
+# metric="containment"の場合、料理のbboxのうちお皿のbboxに入っている割合が、この値を超える場合に紐づける
+OSARA_SHOHIN_MIN_CONTAINMENT = 0.5
+# しきい値を超えた組み合わせのコスト。どの組み合わせのコスト(0-√2)よりも十分大きくする
+_GATED_COST = 1e6
+
+# ---複数トレー(inference_osara_shohin_trays)の設定
+# お皿の中心座標の距離が、この値以下のお皿を同じトレーとみなす(0-1の座標)。
+# 広角カメラの画像で、同じトレーのお皿同士の距離より大きく、隣のトレーとの隙間より小さくする
+TRAY_LINK_DISTANCE = 0.25
+
+# ---カスケード推論(detect_osara_shohin_cascade)の設定
+# お皿の切り抜きを、商品モデルに入力するサイズ(height, width)。
+# PyTorch以外のバックエンドは入力サイズ固定でエクスポートするので、その場合はモデルのimgszを使う(cascade_crop_size)
+CASCADE_CROP_SIZE = (320, 320)
+# お皿の切り抜きに付ける余白(お皿の幅・高さに対する割合)。料理がお皿からはみ出していても切れないように
+CASCADE_CROP_PADDING = 0.1
 
 
 # ----------
 # ---推論・補正
 # ----------
-class Osara_Shohin_Pair(TypedDict):
-    """お皿と商品(料理)のペアを表すデータクラス。
-    どのお皿にどの商品が乗っているか？
+def association_cost_matrix(
+    osara_xyxy: np.ndarray,
+    shohin_xyxy: np.ndarray,
+    metric: Literal["center", "containment"] = "center",
+) -> np.ndarray:
+    """お皿と料理の全ての組み合わせのコストを、まとめて計算する
+
+    Args:
+        osara_xyxy (np.ndarray): (お皿の数, 4)。お皿のbboxの座標(0-1)
+        shohin_xyxy (np.ndarray): (料理の数, 4)。料理のbboxの座標(0-1)
+        metric (Literal["center", "containment"], optional): コストの種類. Defaults to "center".
+            - center: 中心座標の距離
+            - containment: 1 - 料理のbboxのうちお皿のbboxに入っている割合
+
+    Returns:
+        np.ndarray: (お皿の数, 料理の数)のコスト。小さいほど紐づきやすい
     """
+    osara_xyxy = np.asarray(osara_xyxy, dtype=np.float32)
+    shohin_xyxy = np.asarray(shohin_xyxy, dtype=np.float32)
+    if metric == "center":
+        osara_centers = (osara_xyxy[:, :2] + osara_xyxy[:, 2:]) / 2
+        shohin_centers = (shohin_xyxy[:, :2] + shohin_xyxy[:, 2:]) / 2
+        return np.linalg.norm(
+            osara_centers[:, None, :] - shohin_centers[None, :, :], axis=2
+        )
+    if metric == "containment":
+        top_left = np.maximum(osara_xyxy[:, None, :2], shohin_xyxy[None, :, :2])
+        bottom_right = np.minimum(osara_xyxy[:, None, 2:], shohin_xyxy[None, :, 2:])
+        inter = np.clip(bottom_right - top_left, 0, None).prod(axis=2)
+        shohin_area = (shohin_xyxy[:, 2:] - shohin_xyxy[:, :2]).prod(axis=1)
+        return 1.0 - inter / np.maximum(shohin_area[None, :], 1e-9)
+    raise ValueError(f"unknown metric: {metric}")
 
-    osara: Yolov9ResultBox
-    shohin: Yolov9ResultBox
-    osara_area: float
 
+def assign_osara_shohin(
+    osara_xyxy: np.ndarray,
+    shohin_xyxy: np.ndarray,
+    distance_threshold: float = OSARA_SHOHIN_DISTANCE_THRESHOLD,
+    metric: Literal["center", "containment"] = "center",
+) -> Tuple[np.ndarray, np.ndarray]:
+    """お皿と料理を、コストの合計が最小になるように1対1で紐づける(linear_sum_assignment)
 
-def inference_osara_shohin(
+    しきい値を超える組み合わせは紐づけない。
+    center: 中心座標の距離がdistance_threshold未満、containment: お皿に入っている割合がOSARA_SHOHIN_MIN_CONTAINMENTを超える
+
+    Args:
+        osara_xyxy (np.ndarray): (お皿の数, 4)。お皿のbboxの座標(0-1)
+        shohin_xyxy (np.ndarray): (料理の数, 4)。料理のbboxの座標(0-1)
+        distance_threshold (float, optional): 紐づける距離のしきい値(0-1の座標). Defaults to OSARA_SHOHIN_DISTANCE_THRESHOLD.
+        metric (Literal["center", "containment"], optional): コストの種類(association_cost_matrix). Defaults to "center".
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: 紐づいた(お皿のインデックス, 料理のインデックス)。お皿のインデックス順
+    """
+    if len(osara_xyxy) == 0 or len(shohin_xyxy) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty.copy()
+
+    cost = association_cost_matrix(osara_xyxy, shohin_xyxy, metric)
+    max_cost = (
+        distance_threshold if metric == "center" else 1.0 - OSARA_SHOHIN_MIN_CONTAINMENT
+    )
+    allowed = cost < max_cost
+    # しきい値を超える組み合わせは、大きなコストにして選ばれないようにする
+    osara_indices, shohin_indices = linear_sum_assignment(
+        np.where(allowed, cost, _GATED_COST)
+    )
+    keep = allowed[osara_indices, shohin_indices]
+    return osara_indices[keep].astype(np.int64), shohin_indices[keep].astype(np.int64)
+
+
+def associate_osara_shohin(
+    osara_boxes: Yolov9Detections,
+    shohin_boxes: Yolov9Detections,
+    distance_threshold: float = OSARA_SHOHIN_DISTANCE_THRESHOLD,
+) -> np.ndarray:
+    """各お皿に、乗っている料理を紐づける(assign_osara_shohin)。
+    OsaraShohinBoxes.from_associationに渡す、お皿ごとの料理のインデックスを返す
+
+    Args:
+        osara_boxes (Yolov9Detections): お皿モデルの検出結果
+        shohin_boxes (Yolov9Detections): 商品モデルの検出結果
+        distance_threshold (float, optional): 紐づける距離のしきい値(0-1の座標). Defaults to OSARA_SHOHIN_DISTANCE_THRESHOLD.
+
+    Returns:
+        np.ndarray: (お皿の数,)。各お皿に紐づいた料理のインデックス。紐づかなかったお皿は-1
+    """
+    shohin_indices = np.full(len(osara_boxes), -1, dtype=np.int64)
+    osara_pairs, shohin_pairs = assign_osara_shohin(
+        osara_boxes.xyxy, shohin_boxes.xyxy, distance_threshold
+    )
+    shohin_indices[osara_pairs] = shohin_pairs
+    return shohin_indices
+
+
+def cluster_plates(
+    osara_xyxy: np.ndarray, link_distance: float = TRAY_LINK_DISTANCE
+) -> np.ndarray:
+    """お皿を、トレーごとのグループに分ける。
+    中心座標の距離がlink_distance以下のお皿をつないでいき、つながったものを1つのトレーとする(single-linkage)
+
+    - 中心座標を一辺link_distanceのグリッドに振り分け、隣り合う9マスのお皿とだけ距離を比べる
+    - トレーの番号は、左から順(お皿の中心のxの平均が小さい順)
+
+    Args:
+        osara_xyxy (np.ndarray): (お皿の数, 4)。お皿のbboxの座標(0-1)
+        link_distance (float, optional): 同じトレーとみなす距離. Defaults to TRAY_LINK_DISTANCE.
+
+    Returns:
+        np.ndarray: (お皿の数,)。各お皿のトレーの番号(0から)
+    """
+    n = len(osara_xyxy)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    osara_xyxy = np.asarray(osara_xyxy, dtype=np.float32)
+    centers = (osara_xyxy[:, :2] + osara_xyxy[:, 2:]) / 2
+
+    # ---グリッドに振り分ける
+    grid: dict[tuple[int, int], list[int]] = {}
+    for i, cell in enumerate(np.floor(centers / link_distance).astype(np.int64).tolist()):
+        grid.setdefault(tuple(cell), []).append(i)
+
+    # ---近くのお皿をつなぐ(union-find)
+    parent = np.arange(n)
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for (cx, cy), members in grid.items():
+        neighbors = np.array(
+            [
+                j
+                for dx in (-1, 0, 1)
+                for dy in (-1, 0, 1)
+                for j in grid.get((cx + dx, cy + dy), ())
+            ]
+        )
+        members = np.array(members)
+        distances = np.linalg.norm(
+            centers[members][:, None, :] - centers[neighbors][None, :, :], axis=2
+        )
+        for a, b in zip(*np.nonzero(distances <= link_distance)):
+            root_a, root_b = find(int(members[a])), find(int(neighbors[b]))
+            if root_a != root_b:
+                parent[root_b] = root_a
+
+    # ---左から順に、トレーの番号を振る
+    roots = np.array([find(i) for i in range(n)])
+    unique_roots, inverse = np.unique(roots, return_inverse=True)
+    mean_x = np.bincount(inverse, weights=centers[:, 0]) / np.bincount(inverse)
+    rank = np.empty(len(unique_roots), dtype=np.int64)
+    rank[np.argsort(mean_x, kind="stable")] = np.arange(len(unique_roots))
+    return rank[inverse]
+
+
+def associate_osara_shohin_by_tray(
+    osara_boxes: Yolov9Detections,
+    shohin_boxes: Yolov9Detections,
+    tray_labels: np.ndarray,
+    distance_threshold: float = OSARA_SHOHIN_DISTANCE_THRESHOLD,
+) -> np.ndarray:
+    """トレーごとに、お皿と料理を紐づける。
+    料理はいちばん近いお皿のトレーに入れ、トレーの中だけでassign_osara_shohinする(隣のトレーのお皿には紐づかない)
+
+    Args:
+        osara_boxes (Yolov9Detections): お皿モデルの検出結果
+        shohin_boxes (Yolov9Detections): 商品モデルの検出結果
+        tray_labels (np.ndarray): (お皿の数,)。cluster_platesの結果
+        distance_threshold (float, optional): 紐づける距離のしきい値(0-1の座標). Defaults to OSARA_SHOHIN_DISTANCE_THRESHOLD.
+
+    Returns:
+        np.ndarray: (お皿の数,)。各お皿に紐づいた料理のインデックス。紐づかなかったお皿は-1
+    """
+    shohin_indices = np.full(len(osara_boxes), -1, dtype=np.int64)
+    if len(osara_boxes) == 0 or len(shohin_boxes) == 0:
+        return shohin_indices
+
+    # ---料理を、いちばん近いお皿のトレーに振り分ける
+    cost = association_cost_matrix(osara_boxes.xyxy, shohin_boxes.xyxy)
+    shohin_trays = tray_labels[cost.argmin(axis=0)]
+
+    # ---トレーごとに紐づける
+    for tray in np.unique(tray_labels):
+        plates = np.flatnonzero(tray_labels == tray)
+        dishes = np.flatnonzero(shohin_trays == tray)
+        osara_pairs, shohin_pairs = assign_osara_shohin(
+            osara_boxes.xyxy[plates], shohin_boxes.xyxy[dishes], distance_threshold
+        )
+        shohin_indices[plates[osara_pairs]] = dishes[shohin_pairs]
+    return shohin_indices
+
+
+def detect_osara_shohin_batch(
+    frames: list[np.ndarray],
+    MODEL_OSARA: Yolov9,
+    MODEL_SHOHIN: Yolov9,
+    timings: dict[str, float] | None = None,
+) -> list[Tuple[Yolov9Result, Yolov9Result]]:
+    """複数の画像を、お皿モデルと商品モデルでまとめて推論する
+
+    - 2つのモデルの前処理条件(input_signature)が同じなら、letterbox・正規化を1回だけ行い、tensorを共有する
+    - 前処理後のサイズが同じ画像は1つのバッチにまとめ、1回のforwardで推論する
+    - 商品モデルは別スレッドで、お皿モデルと並行して推論する
+        - スレッドの数・torchのスレッド数は、configure_parallel_inferenceで呼び出し側の同時実行数に合わせる
+
+    Args:
+        frames (list[np.ndarray]): 推論する画像のリスト
+        MODEL_OSARA (Yolov9): お皿認識用のYOLOv9モデル
+        MODEL_SHOHIN (Yolov9): 商品(料理)認識用のYOLOv9モデル
+        timings (dict[str, float] | None, optional): 指定した場合、段階ごとの処理時間(秒)を足し込む。
+            preprocess, inference_osara, nms_osara, inference_shohin, nms_shohin. Defaults to None.
+
+    Returns:
+        list[Tuple[Yolov9Result, Yolov9Result]]: 各画像の(お皿モデルの結果, 商品モデルの結果)。framesと同じ順番
+    """
+    timings = {} if timings is None else timings
+    t0 = time.perf_counter()
+    shared = MODEL_OSARA.input_signature() == MODEL_SHOHIN.input_signature()
+
+    # ---前処理する(共有できる場合は1回だけ)
+    # 前処理後のサイズごとに、画像のインデックスをまとめる
+    groups: dict[tuple, list[int]] = {}
+    ims_osara = [MODEL_OSARA.preprocess(frame) for frame in frames]
+    ims_shohin = (
+        ims_osara if shared else [MODEL_SHOHIN.preprocess(frame) for frame in frames]
+    )
+    for i, (im_osara, im_shohin) in enumerate(zip(ims_osara, ims_shohin)):
+        groups.setdefault((im_osara.shape, im_shohin.shape), []).append(i)
+    timings["preprocess"] = timings.get("preprocess", 0.0) + time.perf_counter() - t0
+
+    results: list[Tuple[Yolov9Result, Yolov9Result]] = [None] * len(frames)
+    for indices in groups.values():
+        im0s = [frames[i] for i in indices]
+        im_osara = MODEL_OSARA.to_tensor(np.stack([ims_osara[i] for i in indices]))
+        im_shohin = (
+            im_osara
+            if shared
+            else MODEL_SHOHIN.to_tensor(np.stack([ims_shohin[i] for i in indices]))
+        )
+
+        # ---2つのモデルを並行して推論する
+        future_shohin = _SHOHIN_EXECUTOR.submit(
+            MODEL_SHOHIN.predict_tensor, im_shohin, im0s
+        )
+        results_osara, t_osara = MODEL_OSARA.predict_tensor(im_osara, im0s)
+        results_shohin, t_shohin = future_shohin.result()
+        # predict_tensorの処理時間は(前処理, 推論, NMS)のms
+        for name, t in (("osara", t_osara), ("shohin", t_shohin)):
+            timings[f"inference_{name}"] = timings.get(f"inference_{name}", 0.0) + t[1] / 1e3
+            timings[f"nms_{name}"] = timings.get(f"nms_{name}", 0.0) + t[2] / 1e3
+
+        # ---元の順番に戻す
+        for i, result_osara, result_shohin in zip(
+            indices, results_osara, results_shohin
+        ):
+            results[i] = (result_osara, result_shohin)
+
+    return results
+
+
+def detect_osara_shohin(
     frame: np.ndarray, MODEL_OSARA: Yolov9, MODEL_SHOHIN: Yolov9
-) -> OsaraShohinResult:
-    """お皿と商品(料理)のペアを意識して推論→補正し、質の良い結果を返す
+) -> Tuple[Yolov9Result, Yolov9Result]:
+    """1枚の画像を、お皿モデルと商品モデルで同時に推論する。
+    前処理の共有・並行推論については、detect_osara_shohin_batchを参照
 
     Args:
         frame (np.ndarray): 推論する画像
         MODEL_OSARA (Yolov9): お皿認識用のYOLOv9モデル
         MODEL_SHOHIN (Yolov9): 商品(料理)認識用のYOLOv9モデル
 
+    Returns:
+        Tuple[Yolov9Result, Yolov9Result]: お皿モデルの結果、商品モデルの結果
+    """
+    timings: dict[str, float] = {}
+    result = detect_osara_shohin_batch([frame], MODEL_OSARA, MODEL_SHOHIN, timings)[0]
+    observe_stages(timings)
+    return result
+
+
+def crop_plates(
+    frame: np.ndarray, xyxy: np.ndarray, padding: float = CASCADE_CROP_PADDING
+) -> Tuple[list[np.ndarray], np.ndarray]:
+    """お皿のbboxに余白を付けて、画像から切り抜く
+
+    Args:
+        frame (np.ndarray): 元画像
+        xyxy (np.ndarray): (n, 4)。お皿のbboxの座標(0-1)
+        padding (float, optional): 余白(お皿の幅・高さに対する割合). Defaults to CASCADE_CROP_PADDING.
+
+    Returns:
+        Tuple[list[np.ndarray], np.ndarray]: 切り抜いた画像(元画像のビュー)のリストと、(n, 4)の切り抜き範囲(ピクセル)
+    """
+    height, width = frame.shape[:2]
+    wh = xyxy[:, 2:] - xyxy[:, :2]
+    padded = np.concatenate(
+        [xyxy[:, :2] - wh * padding, xyxy[:, 2:] + wh * padding], axis=1
+    ).clip(0, 1)
+    regions = (padded * [width, height, width, height]).round().astype(np.int64)
+    # 小さすぎるbboxでも、1ピクセルは切り抜けるようにする
+    regions[:, :2] = np.minimum(regions[:, :2], [width - 1, height - 1])
+    regions[:, 2:] = np.maximum(regions[:, 2:], regions[:, :2] + 1)
+    crops = [frame[y0:y1, x0:x1] for x0, y0, x1, y1 in regions]
+    return crops, regions
+
+
+def cascade_crop_size(
+    MODEL_SHOHIN: Yolov9, crop_size: Tuple[int, int] = CASCADE_CROP_SIZE
+) -> Tuple[int, int]:
+    """商品モデルに入力する、お皿の切り抜きのサイズを決める
+
+    PyTorch以外のバックエンド(ONNX・OpenVINO・OpenCV DNN)は入力サイズ固定(imgsz)でエクスポートしているので、
+    crop_sizeを入力すると、エラーになるか、意図しない大きさに変換される。その場合はモデルのimgszを使う。
+
+    Args:
+        MODEL_SHOHIN (Yolov9): 商品(料理)認識用のYOLOv9モデル
+        crop_size (Tuple[int, int], optional): 希望する入力サイズ(height, width). Defaults to CASCADE_CROP_SIZE.
+
+    Returns:
+        Tuple[int, int]: 切り抜きの入力サイズ(height, width)
+    """
+    if MODEL_SHOHIN.backend != "pt":
+        return tuple(MODEL_SHOHIN.input_signature()[0])
+    return tuple(crop_size)
+
+
+def detect_osara_shohin_cascade(
+    frame: np.ndarray,
+    MODEL_OSARA: Yolov9,
+    MODEL_SHOHIN: Yolov9,
+    crop_size: Tuple[int, int] | None = None,
+    padding: float = CASCADE_CROP_PADDING,
+) -> Tuple[Yolov9Result, Yolov9Result, np.ndarray]:
+    """お皿モデルでお皿を見つけてから、お皿の切り抜きだけを商品モデルで推論する
+
+    - お皿の切り抜きはcrop_sizeにletterboxして、1回のforwardでまとめて推論する
+    - 切り抜きの中の検出結果は、元画像の座標(0-1)に戻す
+    - お皿がない場合は、商品モデルを動かさない
+    - 切り抜きの余白には隣のお皿の料理も写るので、中心が切り抜いたお皿の中にある料理だけを残す
+    - 残した料理は、まとめてassociate_osara_shohinで紐づける(1つの料理は、多くても1つのお皿にだけ紐づく)
+    - お皿の結果を待ってから商品モデルを動かすので、InferenceSchedulerで他の端末の画像とまとめない
+      (会計のスレッドで、1枚ずつ推論する)
+
+    Args:
+        frame (np.ndarray): 推論する画像
+        MODEL_OSARA (Yolov9): お皿認識用のYOLOv9モデル
+        MODEL_SHOHIN (Yolov9): 商品(料理)認識用のYOLOv9モデル
+        crop_size (Tuple[int, int] | None, optional): 切り抜きの入力サイズ(height, width)。
+            Noneの場合はcascade_crop_size(MODEL_SHOHIN)。入力サイズ固定のバックエンドでは、モデルのimgszにする. Defaults to None.
+        padding (float, optional): 切り抜きの余白. Defaults to CASCADE_CROP_PADDING.
+
+    Returns:
+        Tuple[Yolov9Result, Yolov9Result, np.ndarray]: お皿モデルの結果、商品モデルの結果(元画像の座標)、
+            各お皿に紐づいた料理のインデックス(紐づかなかったお皿は-1)
+    """
+    result_osara, _ = MODEL_OSARA.predict_frame(frame)
+    osara_boxes: Yolov9Detections = result_osara["boxes"]
+    result_shohin: Yolov9Result = {
+        "image": frame,
+        "path": None,
+        "boxes": Yolov9Detections.empty(MODEL_SHOHIN.names),
+        "annotator": None,
+    }
+    shohin_indices = np.full(len(osara_boxes), -1, dtype=np.int64)
+    if len(osara_boxes) == 0:
+        return result_osara, result_shohin, shohin_indices
+
+    # ---お皿の切り抜きを、まとめて推論する
+    crop_size = cascade_crop_size(MODEL_SHOHIN) if crop_size is None else tuple(crop_size)
+    crops, regions = crop_plates(frame, osara_boxes.xyxy, padding)
+    im = MODEL_SHOHIN.to_tensor(
+        np.stack([MODEL_SHOHIN.preprocess(crop, crop_size) for crop in crops])
+    )
+    crop_results, _ = MODEL_SHOHIN.predict_tensor(im, crops)
+
+    # ---切り抜きの座標から、元画像の座標に戻す
+    height, width = frame.shape[:2]
+    xyxy_list: list[np.ndarray] = []
+    conf_list: list[np.ndarray] = []
+    cls_list: list[np.ndarray] = []
+    for plate_xyxy, crop_result, (x0, y0, x1, y1) in zip(osara_boxes.xyxy, crop_results, regions):
+        detections: Yolov9Detections = crop_result["boxes"]
+        if len(detections) == 0:
+            continue
+        xyxy = detections.xyxy * [x1 - x0, y1 - y0, x1 - x0, y1 - y0] + [x0, y0, x0, y0]
+        xyxy = xyxy / [width, height, width, height]
+        # 隣のお皿の料理(中心がこのお皿の外にあるもの)は、このお皿の切り抜きからは使わない
+        centers = (xyxy[:, :2] + xyxy[:, 2:]) / 2
+        inside = np.all((centers >= plate_xyxy[:2]) & (centers <= plate_xyxy[2:]), axis=1)
+        xyxy_list.append(xyxy[inside])
+        conf_list.append(detections.conf[inside])
+        cls_list.append(detections.cls[inside])
+
+    if xyxy_list:
+        result_shohin["boxes"] = Yolov9Detections(
+            np.concatenate(xyxy_list).astype(np.float32),
+            np.concatenate(conf_list),
+            np.concatenate(cls_list),
+            MODEL_SHOHIN.names,
+        )
+        # 通常の推論と同じコスト・しきい値で、1対1に紐づける
+        shohin_indices = associate_osara_shohin(
+            osara_boxes, result_shohin["boxes"], OSARA_SHOHIN_DISTANCE_THRESHOLD
+        )
+    return result_osara, result_shohin, shohin_indices
+
+
+def inference_osara_shohin(
+    frame: np.ndarray,
+    MODEL_OSARA: Yolov9,
+    MODEL_SHOHIN: Yolov9,
+    scheduler: "InferenceScheduler | InferenceWorkerPool | None" = None,
+    annotate: bool = False,
+    cascade: bool = False,
+) -> OsaraShohinResult:
+    """お皿と商品(料理)のペアを意識して推論→補正し、質の良い結果を返す
+
+    Args:
+        frame (np.ndarray): 推論する画像
+        MODEL_OSARA (Yolov9 | None): お皿認識用のYOLOv9モデル
+        MODEL_SHOHIN (Yolov9 | None): 商品(料理)認識用のYOLOv9モデル
+        scheduler (InferenceScheduler | InferenceWorkerPool | None): 指定した場合、他のリクエストとまとめてバッチ推論する。
+            InferenceWorkerPoolの場合は、別のワーカープロセスで推論する。
+            schedulerを指定し、annotate・cascadeを使わない場合は、モデルはNoneでもよい
+        annotate (bool): Trueの場合、imageに描画した画像を入れる。Falseの場合は元画像をそのまま入れる
+        cascade (bool): Trueの場合、お皿の切り抜きだけを商品モデルで推論する(detect_osara_shohin_cascade)。
+            お皿の結果を待ってから商品モデルを動かすので、schedulerは使わない
+            (同時に来た端末の画像をまとめないので、端末が多い場合はスループットが下がる)
+
     Returns:
         OsaraShohinResult: お皿と商品(料理)のペアを意識して推論→補正した結果
     """
@@ -41,182 +548,164 @@ def inference_osara_shohin(
     # ---推論する
     # ----------
     # Yolov9Wrapperを使うようにした
-    _result_osara, _ = MODEL_OSARA.predict_image(frame)
-    _result_shohin, _ = MODEL_SHOHIN.predict_image(frame)
-    result_osara = _result_osara[0]  # 1枚だけの推論なので、[0]を指定する
-    result_shohin = _result_shohin[0]
+    # 処理時間はSTAGE_SECONDS(/metrics)に記録する。detectはスケジューラの待ち時間も含む
+    if cascade:
+        # お皿ごとに切り抜いて商品モデルで推論するので、紐づけも同時に済む
+        with STAGE_SECONDS.time(stage="cascade"):
+            result_osara, result_shohin, shohin_indices = detect_osara_shohin_cascade(
+                frame, MODEL_OSARA, MODEL_SHOHIN
+            )
+    else:
+        # 前処理を共有し、2つのモデルを並行して推論する
+        with STAGE_SECONDS.time(stage="detect"):
+            if scheduler is not None:
+                result_osara, result_shohin = scheduler.detect(frame)
+            else:
+                result_osara, result_shohin = detect_osara_shohin(
+                    frame, MODEL_OSARA, MODEL_SHOHIN
+                )
+
+        # ----------
+        # ---お皿と料理を紐付ける(associate_dis_with_foodに対応する部分)
+        # ----------
+        # お皿に乗っている料理はなにか？を、インデックスで紐付ける
+        # 距離の合計が最小になるように1対1で紐づける。料理がない場合、皿だけを返す
+        with STAGE_SECONDS.time(stage="association"):
+            shohin_indices = associate_osara_shohin(
+                result_osara["boxes"], result_shohin["boxes"], OSARA_SHOHIN_DISTANCE_THRESHOLD
+            )
+    # 紐づけの結果は、DEBUGのときだけ出力する(会計ごとにprintしない)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "osara -> shohin: %s (osara=%d, shohin=%d)",
+            shohin_indices.tolist(),
+            len(result_osara["boxes"]),
+            len(result_shohin["boxes"]),
+        )
 
     # ----------
-    # ---お皿と料理を紐付ける(associate_dis_with_foodに対応する部分)
+    # ---お皿と料理の組み合わせを、返却用の形式にする(process_associated_detectionsに対応する部分)
     # ----------
-    # お皿に乗っている料理はなにか？を紐付ける
-    # 料理がない場合、皿だけを返す
-
-    # お皿と料理の組み合わせを格納するリスト
-    osara_shohin_pairs: list[Osara_Shohin_Pair] = []
-    # ---しきい値を設定する
-    # お皿と料理の中心座標の距離が、この値以下の場合に紐づける
-    OSARA_SHOHIN_DISTANCE_THRESHOLD = 0.3
-    for osara in result_osara["boxes"]:  # 各お皿に対して
-        print(f"\33[36m[inference_osara_shohin] result_osara:\n{osara}\33[0m")
-        # ---既に紐づけられたものはスキップ
-        if "associated" in osara:
-            continue
+    result_boxes = OsaraShohinBoxes.from_association(
+        result_osara["boxes"], result_shohin["boxes"], shohin_indices
+    )
 
-        # ---お皿の座標を取得する
-        osara_top_left = (osara["xyxy"][0], osara["xyxy"][1])
-        osara_bottom_right = (osara["xyxy"][2], osara["xyxy"][3])
+    # ---描画は、必要なときだけ行う(会計APIでは描画しない)
+    result_image = (
+        render_osara_shohin_result(frame, result_boxes, MODEL_SHOHIN.names)
+        if annotate
+        else frame
+    )
 
-        # ---お皿の中心座標・面積を計算する
-        osara_center = (
-            (osara_top_left[0] + osara_bottom_right[0]) / 2,
-            (osara_top_left[1] + osara_bottom_right[1]) / 2,
-        )
-        osara_area = (osara_bottom_right[0] - osara_top_left[0]) * (
-            osara_bottom_right[1] - osara_top_left[1]
-        )
+    # ---Yolov9Resultを返す
+    new_shohin_result: OsaraShohinResult = {
+        "image": result_image,
+        "path": None,
+        "boxes": result_boxes,
+    }
+    return new_shohin_result
 
-        # ---指定距離内で最も信頼度が高い料理を探す
-        # (料理, 皿)。料理とお皿の組み合わせの、紐づけ候補
-        candidate_pair: tuple[Yolov9ResultBox, Yolov9ResultBox] = None
-        max_confidence = -float("inf")
-        # min_distance=float('inf')
-        for shohin in result_shohin["boxes"]:  # 各料理に対して
-            print(f"\33[36m[inference_osara_shohin] result_shohin:\n{shohin}\33[0m")
-            # ---既に紐づけられたものはスキップ
-            if "associated" in shohin:
-                continue
-
-            # ---料理の座標を取得する、中心座標・面積を計算する
-            shohin_top_left = (shohin["xyxy"][0], shohin["xyxy"][1])
-            shohin_bottom_right = (shohin["xyxy"][2], shohin["xyxy"][3])
-            shohin_center = (
-                (shohin_top_left[0] + shohin_bottom_right[0]) / 2,
-                (shohin_top_left[1] + shohin_bottom_right[1]) / 2,
-            )
-            shohin_area = (shohin_bottom_right[0] - shohin_top_left[0]) * (
-                shohin_bottom_right[1] - shohin_top_left[1]
-            )
 
-            # ---お皿と料理の距離を計算する
-            distance = np.sqrt(
-                (osara_center[0] - shohin_center[0]) ** 2
-                + (osara_center[1] - shohin_center[1]) ** 2
-            )
-            print(
-                f"\33[36m[inference_osara_shohin]\ndistance: {distance}\nconfidence: {shohin['confidence']}\nmax_confidence: {max_confidence}\33[0m"
-            )
+def inference_osara_shohin_trays(
+    frame: np.ndarray,
+    MODEL_OSARA: Yolov9,
+    MODEL_SHOHIN: Yolov9,
+    scheduler: "InferenceScheduler | InferenceWorkerPool | None" = None,
+    link_distance: float = TRAY_LINK_DISTANCE,
+) -> list[OsaraShohinResult]:
+    """1枚の画像に写った複数のトレー(広角カメラ・コンベア)を、トレーごとの結果に分けて返す。
+    推論は画像全体で1回だけ行い、お皿をトレーごとにまとめて(cluster_plates)、トレーの中で料理を紐づける
 
-            # ---紐づけの判定
-            # 距離がしきい値以下かつ最小、信頼度が最大の場合
-            if (
-                distance < OSARA_SHOHIN_DISTANCE_THRESHOLD
-                and shohin["confidence"] > max_confidence
-            ):
-                # ---値の更新
-                max_confidence = shohin["confidence"]  # 最も大きい信頼度の更新
-                candidate_pair = (shohin, osara)  # お皿と料理の組み合わせを更新
-
-        # ---紐づけ候補が見つかった場合、紐づける
-        if candidate_pair is not None:
-            shohin, osara = candidate_pair
-            osara_shohin_pairs.append(
-                {
-                    "osara": osara,
-                    "shohin": shohin,
-                    "area": osara_area,
-                }
-            )
+    Args:
+        frame (np.ndarray): 推論する画像
+        MODEL_OSARA (Yolov9 | None): お皿認識用のYOLOv9モデル
+        MODEL_SHOHIN (Yolov9 | None): 商品(料理)認識用のYOLOv9モデル
+        scheduler (InferenceScheduler | InferenceWorkerPool | None): inference_osara_shohinと同じ。
+            指定した場合は、モデルはNoneでもよい
+        link_distance (float, optional): 同じトレーとみなすお皿の距離. Defaults to TRAY_LINK_DISTANCE.
 
-            # ---紐づけられた料理にフラグを立てる
-            shohin["associated"] = True
-            osara["associated"] = True
+    Returns:
+        list[OsaraShohinResult]: トレーごとの結果。左のトレーから順。お皿がない場合は空のトレーを1つ返す
+    """
+    # ---推論する(画像全体で1回)
+    with STAGE_SECONDS.time(stage="detect"):
+        if scheduler is not None:
+            result_osara, result_shohin = scheduler.detect(frame)
         else:
-            # ---紐づけられなかった場合、お皿のみを返す
-            osara_shohin_pairs.append(
-                {
-                    "osara": osara,
-                    "shohin": None,
-                    "area": osara_area,
-                }
+            result_osara, result_shohin = detect_osara_shohin(
+                frame, MODEL_OSARA, MODEL_SHOHIN
             )
 
-    # ---associatedフラグを削除する
-    for box in result_osara["boxes"]:
-        if "associated" in box:
-            del box["associated"]
-    for box in result_shohin["boxes"]:
-        if "associated" in box:
-            del box["associated"]
+    # ---お皿をトレーごとにまとめ、トレーの中で料理を紐づける
+    with STAGE_SECONDS.time(stage="association"):
+        tray_labels = cluster_plates(result_osara["boxes"].xyxy, link_distance)
+        shohin_indices = associate_osara_shohin_by_tray(
+            result_osara["boxes"],
+            result_shohin["boxes"],
+            tray_labels,
+            OSARA_SHOHIN_DISTANCE_THRESHOLD,
+        )
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "trays: %s, osara -> shohin: %s",
+            tray_labels.tolist(),
+            shohin_indices.tolist(),
+        )
+
+    # ---トレーごとの結果に分ける
+    result_boxes = OsaraShohinBoxes.from_association(
+        result_osara["boxes"], result_shohin["boxes"], shohin_indices
+    )
+    n_trays = int(tray_labels.max()) + 1 if len(tray_labels) else 1
+    return [
+        {
+            "image": frame,
+            "path": None,
+            "boxes": result_boxes[np.flatnonzero(tray_labels == tray)],
+        }
+        for tray in range(n_trays)
+    ]
 
-    # ----------
-    # ---お皿と料理が紐づいたもののみを描画する(process_associated_detectionsに対応する部分)
-    # ----------
-    annotator = result_shohin["annotator"]
-    # 画像の幅・高さを取得する
-    height, width, _ = result_shohin["image"].shape
 
-    result_boxes: list[OsaraShohinResultBox] = []
-    print(
-        f"\33[31m[inference_osara_shohin] osara_shohin_pairs:\n{osara_shohin_pairs}\33[0m"
+def render_osara_shohin_result(
+    frame: np.ndarray,
+    boxes: Iterable[OsaraShohinResultBox],
+    names: dict[int, str],
+    line_thickness: int = 3,
+) -> np.ndarray:
+    """inference_osara_shohinの結果を、元画像に描画する。
+    料理が紐づいたものはラベルの色で、料理が紐づいていないお皿は黒で描画する
+
+    Args:
+        frame (np.ndarray): 元画像
+        boxes (Iterable[OsaraShohinResultBox]): inference_osara_shohinの結果のbbox(OsaraShohinBoxesなど)
+        names (dict[int, str]): 商品(料理)モデルのクラス名(MODEL_SHOHIN.namesなど)。ラベルの色を決めるのに使う
+        line_thickness (int, optional): bboxの線の太さ. Defaults to 3.
+
+    Returns:
+        np.ndarray: 描画した画像(元画像は変更しない)
+    """
+    annotator = Yolov9Annotator(
+        frame.copy(), line_width=line_thickness, names=names
     )
-    for pair in osara_shohin_pairs:
-        if pair["shohin"] is not None:  # お皿と料理が紐づいている場合
-            # ---描画用の各種パラメータを取得する
-            shohin: Yolov9ResultBox = pair["shohin"]
-            box = [
-                int(shohin["xyxy"][0] * width),
-                int(shohin["xyxy"][1] * height),
-                int(shohin["xyxy"][2] * width),
-                int(shohin["xyxy"][3] * height),
-            ]
-            label = f'{shohin["label"]} {shohin["confidence"]:.2f}' # 14395 0.96
-            color = annotator.get_color(shohin["label"])
-
-            # ---描画する
-            annotator.box_label(box, label, color)
-
-            # ---[返却用]result_boxesに追加する
-            new_box: OsaraShohinResultBox = {
-                "label": shohin["label"],
-                "osara_type": pair["osara"]["label"],
-                "confidence": shohin["confidence"],
-                "xyxy": shohin["xyxy"],
-                "menu_object": None,
-            }
-            result_boxes.append(new_box)
+    # 画像の幅・高さを取得する
+    height, width, _ = frame.shape
 
+    for result_box in boxes:
+        box = [
+            int(result_box["xyxy"][0] * width),
+            int(result_box["xyxy"][1] * height),
+            int(result_box["xyxy"][2] * width),
+            int(result_box["xyxy"][3] * height),
+        ]
+        if result_box["label"] is not None:  # お皿と料理が紐づいている場合
+            label = f'{result_box["label"]} {result_box["confidence"]:.2f}'  # 14395 0.96
+            color = annotator.get_color(result_box["label"])
         else:  # お皿と料理が紐づいていない場合
-            osara: Yolov9ResultBox = pair["osara"]
-            box = [
-                int(osara["xyxy"][0] * width),
-                int(osara["xyxy"][1] * height),
-                int(osara["xyxy"][2] * width),
-                int(osara["xyxy"][3] * height),
-            ]
-            label = f'{osara["label"]} {osara["confidence"]:.2f}'
-            color = annotator.get_color(osara["label"])
+            label = f'{result_box["osara_type"]} {result_box["confidence"]:.2f}'
             color = (0, 0, 0)  # まっくろ
 
-            # ---描画する
-            annotator.box_label(box, label, color)
-
-            # ---[返却用]result_boxesに追加する
-            new_box: OsaraShohinResultBox = {
-                "label": None,
-                "osara_type": osara["label"],
-                "confidence": osara["confidence"],
-                "xyxy": osara["xyxy"],
-                "menu_object": None,
-            }
-            result_boxes.append(new_box)
+        # ---描画する
+        annotator.box_label(box, label, color)
 
-    result_image = annotator.result()
-
-    # ---Yolov9Resultを返す
-    new_shohin_result: OsaraShohinResult = {
-        "image": result_image,
-        "path": None,
-        "boxes": result_boxes,
-    }
-    return new_shohin_result
+    return annotator.result()
@@ -5,20 +5,162 @@ Menuクラス、MenuObjectクラスとか
 """
 
 import csv
-from typing import Literal, Tuple
+import json
+import logging
+import os
+from typing import Iterable, Literal, NamedTuple, Tuple
 
-from modules.Types import MenuObject, OsaraShohinResult
+import numpy as np
+
+from modules.MenuSearch import SEARCH_FIELDS, MenuSearchIndex
+from modules.Types import MenuObject, Nutrition, OsaraShohinResult
+
+logger = logging.getLogger(__name__)
+
+# 栄養素の並び順(nutrition_matrixの列の順番)
+NUTRITION_KEYS: Tuple[str, ...] = (
+    "energy",
+    "protein",
+    "fat",
+    "carbohydrates",
+    "fiber",
+    "vegetables",
+)
+
+# 完全一致の検索用に、辞書のインデックスを作るキー(load_menuで作る)
+INDEXED_KEYS: Tuple[str, ...] = ("menu_code", "jan_code", "yolo_name")
+
+# サイズの閾値の設定ファイル。メニューのCSVと同じ場所に「<CSVのファイル名>.sizes.json」がなければ、これを使う
+DEFAULT_SIZE_THRESHOLDS_PATH = os.path.join(os.path.dirname(__file__), "size_thresholds.json")
+
+# 一食分の栄養素の目安。栄養素の割合(nutrition_ratio)の分母
+ONE_MEAL_NUTRITION: Nutrition = {
+    "energy": 750,
+    "protein": 20,
+    "fat": 22,
+    "carbohydrates": 80,
+    "fiber": 8,
+    "vegetables": 100,
+}
+
+
+def _to_float(value) -> float:
+    """CSVの栄養素の値を数値にする。空文字・None・数値でないものは0にする"""
+    try:
+        return float(value) if value not in (None, "") else 0.0
+    except ValueError:
+        return 0.0
+
+
+def nutrition_to_vector(nutrition: dict | None) -> np.ndarray:
+    """栄養素の辞書を、NUTRITION_KEYSの順のfloat32配列にする"""
+    nutrition = nutrition or {}
+    return np.array(
+        [_to_float(nutrition.get(key)) for key in NUTRITION_KEYS], dtype=np.float32
+    )
+
+
+def unknown_menu_object() -> MenuObject:
+    """メニューに見つからなかった料理用の、空のメニューオブジェクト"""
+    return {
+        "menu_code": None,
+        "display_name": "unknown",
+        "romaji": None,
+        "yolo_name": None,
+        "jan_code": None,
+        "price": 0,
+        "nutrition": {
+            "energy": None,
+            "protein": None,
+            "fat": None,
+            "carbohydrates": None,
+            "fiber": None,
+            "vegetables": None,
+        }
+    }
+
+
+def load_size_thresholds(path: str) -> dict:
+    """サイズの閾値の設定ファイル(JSON)を読み込む
+
+    Args:
+        path (str): 設定ファイルのパス(size_thresholds.jsonを参照)
+
+    Returns:
+        dict: {"key": ラベルと比べるキー, "sizes": サイズ名のリスト, "osara_types": お皿の種類 -> 閾値, "labels": ラベル -> お皿の種類 -> 閾値}
+    """
+    with open(path, mode="r", encoding="utf-8") as f:
+        config = json.load(f)
+    sizes = list(config.get("sizes", ["小", "中", "大"]))
+    osara_types = {k: list(v) for k, v in config.get("osara_types", {}).items()}
+    labels = {
+        label: {k: list(v) for k, v in thresholds.items()}
+        for label, thresholds in config.get("labels", {}).items()
+    }
+    for thresholds in [*osara_types.values(), *(t for l in labels.values() for t in l.values())]:
+        if len(thresholds) != len(sizes) - 1 or sorted(thresholds) != thresholds:
+            raise ValueError(f"閾値は昇順で、サイズの数-1個にしてください: {path}, {thresholds}")
+    return {
+        "key": config.get("key", "menu_code"),
+        "sizes": sizes,
+        "osara_types": osara_types,
+        "labels": labels,
+    }
+
+
+class SizeResolution(NamedTuple):
+    """あるラベル・お皿の種類の料理を、面積からメニューに決めるための表(Menu.resolution_table)
+
+    - index = np.searchsorted(bounds, area, side="right") で、menu_objects[index]が決まる
+    - boundsは、classify_by_sizeと同じ境界(area < t0 → 小、t0 <= area <= t1 → 中、t1 < area → 大)に
+      なるように、2つ目以降の閾値をnp.nextafterで少しだけ大きくしてある
+    - サイズ違いがない場合は、boundsが空で、menu_objectsは1つだけ
+    """
+
+    bounds: np.ndarray  # (サイズ数-1,) float64
+    menu_objects: np.ndarray  # (サイズ数,) object。そのサイズのメニューがない場合はNone
+
+
+def vector_to_nutrition(vector: np.ndarray) -> Nutrition:
+    """NUTRITION_KEYSの順の配列を、栄養素の辞書にする。
+    float32の誤差(12.300000190734863など)がレスポンスに出ないように、小数点以下4桁に丸める"""
+    return dict(zip(NUTRITION_KEYS, np.round(np.asarray(vector, dtype=float), 4).tolist()))
 
 
 class Menu:
-    def __init__(self):
+    def __init__(self, one_meal_nutrition: Nutrition = ONE_MEAL_NUTRITION):
+        """
+        Args:
+            one_meal_nutrition (Nutrition, optional): 一食分の栄養素の目安. Defaults to ONE_MEAL_NUTRITION.
+        """
         self.menu: dict[str, MenuObject] = {}  # メニュー情報を保持する辞書
+        # ---栄養素の計算用。load_menuで作る
+        self.menu_index: dict[str, int] = {}  # メニューコード -> nutrition_matrixの行
+        self.nutrition_matrix = np.zeros((0, len(NUTRITION_KEYS)), dtype=np.float32)  # (メニュー数, 栄養素数)
+        self.one_meal_nutrition = nutrition_to_vector(one_meal_nutrition)
+        # ---検索用。load_menuで作る
+        self.kv_index: dict[str, dict[str, list[MenuObject]]] = {key: {} for key in INDEXED_KEYS}  # キー -> 値 -> メニュー(サイズ違いなどで複数)
+        self.price_values = np.zeros(0, dtype=np.int64)  # 価格の昇順
+        self.price_menu_objects: list[MenuObject] = []  # price_valuesと同じ順のメニュー
+        self.search_index = MenuSearchIndex(())  # display_name・romajiの部分一致検索用
+        # ---検出結果のラベルからメニューを決める用。load_menuで作る
+        self.size_thresholds: dict = {"key": "menu_code", "sizes": [], "osara_types": {}, "labels": {}}
+        self.resolution_table: dict[tuple[str, str | None], SizeResolution] = {}  # (ラベル, お皿の種類) -> SizeResolution
 
     def load_menu(
-        self, csv_file_path: str, csv_encoding: str = "utf-8"
+        self,
+        csv_file_path: str,
+        csv_encoding: str = "utf-8",
+        size_thresholds_path: str | None = None,
     ) -> dict[str, MenuObject]:
         """ CSVファイルからメニューを読み込み、self.menuに格納する
 
+        Args:
+            csv_file_path (str): メニューのCSVファイルのパス
+            csv_encoding (str, optional): CSVの文字コード. Defaults to "utf-8".
+            size_thresholds_path (str | None, optional): サイズの閾値の設定ファイル。
+                Noneの場合は「<CSVのファイル名>.sizes.json」、なければDEFAULT_SIZE_THRESHOLDS_PATH. Defaults to None.
+
         Returns:
             menu: メニュー情報を保持する辞書。以下のような形式(MenuObject)で保持される。
             {
@@ -105,6 +247,119 @@ class Menu:
 
         self.menu = menu
 
+        # ---栄養素を数値の行列にしておく(会計のたびに文字列から変換しないように)
+        self.menu_index = {menu_code: i for i, menu_code in enumerate(menu)}
+        self.nutrition_matrix = np.stack(
+            [nutrition_to_vector(menu_object["nutrition"]) for menu_object in menu.values()]
+        ) if menu else np.zeros((0, len(NUTRITION_KEYS)), dtype=np.float32)
+
+        if size_thresholds_path is None:
+            sidecar_path = os.path.splitext(csv_file_path)[0] + ".sizes.json"
+            size_thresholds_path = sidecar_path if os.path.exists(sidecar_path) else DEFAULT_SIZE_THRESHOLDS_PATH
+        self.size_thresholds = load_size_thresholds(size_thresholds_path)
+
+        self.build_indexes()
+
+    def build_indexes(self):
+        """self.menuから、検索用のインデックスを作り直す。self.menuを書き換えたら呼ぶ
+
+        - kv_index: INDEXED_KEYSの値 -> メニューのリスト(完全一致の検索をO(1)にする)
+        - price_values, price_menu_objects: 価格の昇順に並べたもの(価格の範囲検索を二分探索にする)
+        - search_index: display_name・romajiの部分一致検索用のインデックス(MenuSearchIndex)
+        """
+        kv_index: dict[str, dict[str, list[MenuObject]]] = {key: {} for key in INDEXED_KEYS}
+        for menu_object in self.menu.values():
+            for key in INDEXED_KEYS:
+                value = menu_object[key]
+                if value is None or value == "":
+                    continue
+                kv_index[key].setdefault(str(value), []).append(menu_object)
+        self.kv_index = kv_index
+
+        menu_objects = list(self.menu.values())
+        prices = np.array([menu_object["price"] for menu_object in menu_objects], dtype=np.int64)
+        order = np.argsort(prices, kind="stable")
+        self.price_values = prices[order]
+        self.price_menu_objects = [menu_objects[i] for i in order]
+
+        self.search_index = MenuSearchIndex(menu_objects)
+
+        self.build_resolution_table()
+
+    def build_resolution_table(self):
+        """ラベル(・お皿の種類)からメニューを決めるための表(self.resolution_table)を作る
+
+        - 候補(size_thresholds["key"]がラベルと一致するメニュー)が1つ: (ラベル, None) -> そのメニュー
+        - 候補が複数(小・中・大があるようなやつ): お皿の種類ごとに、閾値とサイズごとのメニューを持つ
+            - サイズのメニューは、display_nameがサイズ名から始まる最初の候補
+            - 閾値がないお皿の種類の場合は、(ラベル, None) -> 最初の候補
+        - 候補がないラベルは表に入れない(unknownになる)
+        """
+        sizes: list[str] = self.size_thresholds["sizes"]
+        label_index = self.kv_index.get(self.size_thresholds["key"])
+        if label_index is None:
+            # インデックスがないキーの場合は、その場で作る
+            label_index = {}
+            for menu_object in self.menu.values():
+                label_index.setdefault(str(menu_object[self.size_thresholds["key"]]), []).append(menu_object)
+
+        table: dict[tuple[str, str | None], SizeResolution] = {}
+        no_bounds = np.zeros(0, dtype=np.float64)
+        for label, candidates in label_index.items():
+            table[(label, None)] = SizeResolution(no_bounds, np.array([candidates[0]], dtype=object))
+            if len(candidates) == 1:
+                continue
+            thresholds_by_type = {
+                **self.size_thresholds["osara_types"],
+                **self.size_thresholds["labels"].get(label, {}),
+            }
+            for osara_type, thresholds in thresholds_by_type.items():
+                bounds = np.array(thresholds, dtype=np.float64)
+                bounds[1:] = np.nextafter(bounds[1:], np.inf)
+                menu_objects = np.full(len(sizes), None, dtype=object)
+                for i, size in enumerate(sizes):
+                    menu_objects[i] = next(
+                        (c for c in candidates if c["display_name"].startswith(size)), None
+                    )
+                table[(label, osara_type)] = SizeResolution(bounds, menu_objects)
+        self.resolution_table = table
+
+    def resolve_menu_objects(
+        self, labels: np.ndarray, osara_types: np.ndarray, areas: np.ndarray
+    ) -> np.ndarray:
+        """検出した料理のラベル・お皿の種類・面積から、メニューをまとめて決める
+
+        同じ(ラベル, お皿の種類)の料理をまとめて、np.searchsortedでサイズを決める。
+
+        Args:
+            labels (np.ndarray): (n,) object。ラベル。Noneは料理が紐づかなかったお皿
+            osara_types (np.ndarray): (n,) object。お皿の種類
+            areas (np.ndarray): (n,) 料理のbboxの面積(0-1)
+
+        Returns:
+            np.ndarray: (n,) object。メニューオブジェクト
+                ラベルがNone、またはそのサイズのメニューがない場合はNone。候補がないラベルはunknown
+        """
+        areas = np.asarray(areas, dtype=np.float64)
+        menu_objects = np.full(len(labels), None, dtype=object)
+
+        # (ラベル, お皿の種類)ごとにまとめる
+        groups: dict[tuple, list[int]] = {}
+        for i, (label, osara_type) in enumerate(zip(labels, osara_types)):
+            if label is not None:
+                groups.setdefault((str(label), osara_type), []).append(i)
+
+        for (label, osara_type), indices in groups.items():
+            resolution = self.resolution_table.get((label, osara_type)) or self.resolution_table.get((label, None))
+            if resolution is None:
+                # ---候補がない場合(boxごとに別のunknownにする)
+                for i in indices:
+                    menu_objects[i] = unknown_menu_object()
+                continue
+            sizes = np.searchsorted(resolution.bounds, areas[indices], side="right")
+            menu_objects[indices] = resolution.menu_objects[sizes]
+        return menu_objects
+
     def find_menu_by_OsaraShohinResult(
         self, target: OsaraShohinResult
     ) -> OsaraShohinResult:
@@ -115,73 +370,23 @@ class Menu:
         Returns:
             OsaraShohinResult: 検索結果を紐づけたOsaraShohinResult
         """
-        results: list[MenuObject] = []
-        for box in target["boxes"]:  # 各商品(bbox)に対して
-            # ---ラベル名で検索する
-            label = box["label"]
-            if label is None:
-                continue
-            candidate_menu_objects: list[MenuObject] = self.find_menu_by_kv(
-                # "yolo_name", label
-                "menu_code", label
+        boxes = target["boxes"]
+        # ---ラベル・お皿の種類・面積から、全てのbboxのメニューをまとめて決める
+        xyxy = np.asarray(boxes.xyxy, dtype=np.float64).reshape(-1, 4)
+        areas = (xyxy[:, 2] - xyxy[:, 0]) * (xyxy[:, 3] - xyxy[:, 1])
+        menu_objects = self.resolve_menu_objects(boxes.labels, boxes.osara_types, areas)
+        for i, menu_object in enumerate(menu_objects):
+            if menu_object is not None:
+                # OsaraShohinResultBoxに、メニューオブジェクトを紐づける
+                boxes.set_menu_object(i, menu_object)
+        # 決めたメニューは、DEBUGのときだけ出力する(会計ごとにprintしない)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "labels: %s, osara_types: %s, menus: %s",
+                boxes.labels.tolist(),
+                boxes.osara_types.tolist(),
+                [m["display_name"] if m is not None else None for m in menu_objects],
             )
-            print(
-                f"\33[32m[find_menu_by_OsaraShohinResult] label: {label}, candidate counts: {len(candidate_menu_objects)}\33[0m"
-            )
-
-            if len(candidate_menu_objects) > 1:
-                # ---検索した結果、候補が複数あった場合、面積で絞り込む(小・中・大があるようなやつ)
-                # ---面積を計算する
-                xyxy = box["xyxy"]
-                area = (xyxy[2] - xyxy[0]) * (xyxy[3] - xyxy[1])
-                # ---面積で比較する
-                osara_type = box["osara_type"]
-                size: Literal["小", "中", "大"] = None
-                if osara_type == "DON":
-                    size = self.classify_by_size(area, (0.02441, 0.03906))
-                elif osara_type == "CURRY":
-                    size = self.classify_by_size(area, (0.1953, 0.2441))
-                elif osara_type == "RICE":
-                    size = self.classify_by_size(area, (0.01953, 0.02441))
-                else:
-                    size = ""
-                print(
-                    f"\33[32m[find_menu_by_OsaraShohinResult] osara_type: {osara_type}, size: {size}\33[0m"
-                )
-
-                # ---商品名とサイズを組み合わせて検索する
-                for candidate_menu_object in candidate_menu_objects:
-                    if candidate_menu_object["display_name"].startswith(size):
-                        # OsaraShohinResultBoxに、メニューオブジェクトを紐づける
-                        box["menu_object"] = candidate_menu_object
-                        results.append(candidate_menu_object)
-                        break
-            elif len(candidate_menu_objects) == 1:
-                # ---候補が1つだけの場合、それにする
-                box["menu_object"] = candidate_menu_objects[0]
-                results.append(candidate_menu_objects[0])
-            else:
-                # ---候補がない場合
-                new_menu_object: MenuObject = {
-                    "menu_code": None,
-                    "display_name": "unknown",
-                    "romaji": None,
-                    "yolo_name": None,
-                    "jan_code": None,
-                    "price": 0,
-                    "nutrition": {
-                        "energy": None,
-                        "protein": None,
-                        "fat": None,
-                        "carbohydrates": None,
-                        "fiber": None,
-                        "vegetables": None,
-                    }
-                }
-                box["menu_object"] = new_menu_object
-                results.append(new_menu_object)
-
-            # find_menu_object=self.menu.get(label,None) # homemade_curryがサイズ分複数あるので、これは無理
 
         # ---渡されたOsaraShohinResultに、メニューオブジェクトを紐づけた、新規OsaraShohinResultを作成して返す
         new_osresult: OsaraShohinResult = {
@@ -192,6 +397,61 @@ class Menu:
 
         return new_osresult
 
+    def nutrition_totals(self, menu_objects: Iterable[MenuObject]) -> np.ndarray:
+        """メニューの栄養素の合計を計算する
+
+        Args:
+            menu_objects (Iterable[MenuObject]): トレーに乗っているメニュー
+
+        Returns:
+            np.ndarray: NUTRITION_KEYSの順の、栄養素の合計(float32)
+        """
+        indices: list[int] = []
+        totals = np.zeros(len(NUTRITION_KEYS), dtype=np.float32)
+        for menu_object in menu_objects:
+            index = self.menu_index.get(menu_object["menu_code"])
+            if index is not None:
+                indices.append(index)
+            else:
+                # メニューにないもの(unknownなど)は、その場で変換する
+                totals += nutrition_to_vector(menu_object.get("nutrition"))
+        return totals + self.nutrition_matrix[indices].sum(axis=0)
+
+    def nutrition_ratio(self, totals: np.ndarray) -> np.ndarray:
+        """栄養素の合計から、一食分の栄養素に占める割合を計算する
+
+        Args:
+            totals (np.ndarray): (..., 栄養素数)の栄養素の合計
+
+        Returns:
+            np.ndarray: totalsと同じ形の割合
+        """
+        return totals / self.one_meal_nutrition
+
+    def score_trays(
+        self, trays: list[list[str]]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """複数のトレーの栄養素の合計と割合を、まとめて計算する(分析・おすすめ用)
+
+        Args:
+            trays (list[list[str]]): トレーごとの、メニューコードのリスト。メニューにないコードは無視する
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: (トレー数, 栄養素数)の合計と割合
+        """
+        tray_ids: list[int] = []
+        indices: list[int] = []
+        for tray_id, menu_codes in enumerate(trays):
+            for menu_code in menu_codes:
+                index = self.menu_index.get(menu_code)
+                if index is not None:
+                    tray_ids.append(tray_id)
+                    indices.append(index)
+
+        totals = np.zeros((len(trays), len(NUTRITION_KEYS)), dtype=np.float32)
+        np.add.at(totals, tray_ids, self.nutrition_matrix[indices])
+        return totals, self.nutrition_ratio(totals)
+
     def classify_by_size(
         self, area: float, thresholds: Tuple[float, float]
     ) -> Literal["小", "中", "大"]:
@@ -222,19 +482,69 @@ class Menu:
         Args:
             key (Literal["menu_code", "display_name", "romaji", "yolo_name", "jan_code", "price"]): 検索するキー
             value (str): 検索する値
+            search_type (Literal["exact", "partial"], optional): 完全一致か部分一致か. Defaults to "exact".
+                完全一致の場合、menu_code・jan_code・yolo_nameはインデックス、priceは価格のインデックスから引く
+                部分一致の場合、display_name・romajiは検索インデックスから引く(全角・半角、ひらがな・カタカナ、大文字・小文字を区別しない)
 
         Returns:
             list[MenuObject]: 検索結果のメニューオブジェクトのリスト
         """
         if search_type == "exact":
+            if key in self.kv_index:
+                # インデックスから引く(呼び出し側で書き換えられないように、リストはコピーして返す)
+                return list(self.kv_index[key].get(str(value), ()))
+            if key == "price":
+                try:
+                    price = int(value)
+                except (TypeError, ValueError):
+                    return []
+                return self.find_menu_by_price_range(price, price)
             return [
                 menu_object
                 for menu_object in self.menu.values()
                 if menu_object[key] == str(value)
             ]
         elif search_type == "partial":
+            if key in SEARCH_FIELDS:
+                return self.search_menu(value, fields=(key,), limit=None)
             return [
                 menu_object
                 for menu_object in self.menu.values()
                 if str(value) in menu_object[key]
             ]
+
+    def find_menu_by_price_range(
+        self, min_price: int | None = None, max_price: int | None = None
+    ) -> list[MenuObject]:
+        """価格がmin_price以上、max_price以下のメニューを、価格の安い順に返す
+
+        Args:
+            min_price (int | None, optional): 価格の下限(含む)。Noneの場合は下限なし. Defaults to None.
+            max_price (int | None, optional): 価格の上限(含む)。Noneの場合は上限なし. Defaults to None.
+
+        Returns:
+            list[MenuObject]: 検索結果のメニューオブジェクトのリスト
+        """
+        start = 0 if min_price is None else int(np.searchsorted(self.price_values, min_price, side="left"))
+        stop = len(self.price_values) if max_price is None else int(np.searchsorted(self.price_values, max_price, side="right"))
+        return self.price_menu_objects[start:stop]
+
+    def search_menu(
+        self,
+        query: str,
+        fields: Tuple[str, ...] | None = None,
+        limit: int | None = 20,
+        prefix: bool = False,
+    ) -> list[MenuObject]:
+        """display_name・romajiを部分一致で検索し、一致の順位の高い順に返す(MenuSearchIndex.search)
+
+        Args:
+            query (str): 検索する文字列
+            fields (Tuple[str, ...] | None, optional): 検索するキー。Noneの場合はdisplay_nameとromaji. Defaults to None.
+            limit (int | None, optional): 返す最大件数。Noneの場合は全件. Defaults to 20.
+            prefix (bool, optional): Trueの場合、名前または単語の前方一致だけを返す. Defaults to False.
+
+        Returns:
+            list[MenuObject]: 検索結果のメニューオブジェクトのリスト
+        """
+        return self.search_index.search(query, fields=fields, limit=limit, prefix=prefix)
@@ -0,0 +1,83 @@
+"""
+# upload.py
+端末から送られてきた画像を、cv2で使えるNumPy配列に変換するモジュール。
+
+## 対応している送り方
+- multipart/form-data: `image` フィールドにJPEGファイル
+- application/octet-stream, image/jpeg, image/png: リクエストボディがそのまま画像
+- application/json: `{"image": "data:image/jpeg;base64,..."}` (従来の端末用)
+
+バイナリで送られた場合は、base64のデコードや文字列の分割をせず、
+リクエストのバッファからnp.frombufferで直接デコードする。
+"""
+
+import base64
+import binascii
+
+import cv2
+import numpy as np
+from flask import Request
+
+# リクエストボディがそのまま画像として送られてくるContent-Type
+BINARY_MIMETYPES = ("application/octet-stream", "image/jpeg", "image/png")
+
+
+def bytes_to_ndarray(image_bytes: bytes | bytearray | memoryview) -> np.ndarray | None:
+    """JPEGなどの画像のバイト列を、コピーせずにcv2で使えるNumPy配列に変換する
+
+    Args:
+        image_bytes (bytes | bytearray | memoryview): 画像のバイト列
+
+    Returns:
+        np.ndarray | None: 画像(BGR)。デコードできない場合はNone
+    """
+    np_array = np.frombuffer(image_bytes, np.uint8)
+    if np_array.size == 0:
+        return None
+    return cv2.imdecode(np_array, cv2.IMREAD_COLOR)
+
+
+def base64str_to_ndarray(base64str: str) -> np.ndarray | None:
+    """
+    base64形式の画像データを、cv2で使えるNumPy配列に変換する。
+    base64として正しくない場合は、デコードできない画像と同じくNoneを返す
+    """
+
+    # データURIスキームの場合、最初のコンマ以降を取り出す
+    if base64str.startswith("data:image"):
+        base64str = base64str[base64str.find(",") + 1 :]
+    try:
+        image_bytes = base64.b64decode(base64str)
+    except (binascii.Error, ValueError):
+        return None
+    return bytes_to_ndarray(image_bytes)
+
+
+def request_to_ndarray(request: Request) -> np.ndarray | None:
+    """リクエストから画像を取り出して、cv2で使えるNumPy配列に変換する
+
+    Args:
+        request (Request): Flaskのリクエスト
+
+    Returns:
+        np.ndarray | None: 画像(BGR)。画像がない・デコードできない場合はNone
+    """
+    # ---multipart/form-data
+    if request.mimetype == "multipart/form-data":
+        image_file = request.files.get("image")
+        if image_file is None:
+            return None
+        return bytes_to_ndarray(image_file.read())
+
+    # ---バイナリ(リクエストボディがそのまま画像)
+    if request.mimetype in BINARY_MIMETYPES:
+        return bytes_to_ndarray(request.get_data(cache=False))
+
+    # ---従来のbase64 JSON(dictでない・imageが文字列でない場合は、画像がないものとする)
+    request_data = request.get_json(silent=True)
+    if not isinstance(request_data, dict):
+        return None
+    image_base64 = request_data.get("image")
+    if not image_base64 or not isinstance(image_base64, str):
+        return None
+    return base64str_to_ndarray(image_base64)
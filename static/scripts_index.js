@@ -13,8 +13,8 @@ async function handleStartOrRetry() {
 
     return // [デバッグ用]
     // ---カメラを起動して画像を取得し、サーバーに送信する
-    const capturedBase64Image = await captureImage();
-    await startInference(capturedBase64Image);
+    const capturedImageBlob = await captureImage();
+    await startInference(capturedImageBlob);
 }
 
 /**
@@ -1200,7 +1200,24 @@ async function wait(ms) {
     return new Promise(resolve => setTimeout(resolve, ms));
 }
 
-var socket = io(); // Socket.IOの初期化
+// websocketだけで接続する(複数ワーカーでも、スティッキーセッションなしで動くように)
+var socket = io({ transports: ['websocket'] }); // Socket.IOの初期化
+
+// ---非同期の会計の結果を、この端末のroomで受け取る
+socket.emit('join', { room: document.getElementById('confirm-button').getAttribute('data-uuid') });
+// ジョブID -> 結果を待っているPromiseのresolve
+const pendingInferenceJobs = new Map();
+// 待ち始める前に届いた結果
+const arrivedInferenceResults = new Map();
+socket.on('inference_result', (job) => {
+    const resolve = pendingInferenceJobs.get(job.job_id);
+    if (resolve) {
+        pendingInferenceJobs.delete(job.job_id);
+        resolve(job);
+    } else {
+        arrivedInferenceResults.set(job.job_id, job);
+    }
+});
 
 ////////////////////////////////////////
 ///         確定ボタンクリック時         ///////
@@ -1236,8 +1253,8 @@ document.getElementById('confirm-button').addEventListener('click', async functi
     // ---最終的な結果(アノテーションなど)をログ用APIに送る
     // ----------
     // ---画像を取り出す
-    const detectImageElement = document.getElementById('detected-image');
-    const imageBase64 = detectImageElement.src;
+    // 推論はバイナリで送っているが、ログ用APIは従来どおりBase64で受け取るので、ここで変換する
+    const imageBase64 = await blobToDataURL(lastInferenceImage);
     // ---送信する
     await fetch("/logging", {
         method: 'POST',
@@ -1289,7 +1306,7 @@ document.getElementById('confirm-button').addEventListener('click', async functi
 });
 
 ////////////////////////////////////////
-///  カメラを起動し、画像をbase64で返す   ///
+///  カメラを起動し、画像をBlobで返す   ///
 ////////////////////////////////////////
 function captureImage() {
     return new Promise((resolve, reject) => {
@@ -1330,13 +1347,17 @@ function captureImage() {
                     const context = canvas.getContext('2d');
                     context.drawImage(video, 0, 0, canvas.width, canvas.height);
 
-                    // 画像をBase64形式で取得
-                    const imageData = canvas.toDataURL('image/jpeg');
-
                     // カメラのストリームを停止
                     stream.getTracks().forEach(track => track.stop());
 
-                    resolve(imageData);  // 画像データを返す
+                    // 画像をJPEGのBlobで取得する(base64にすると、サイズが約1.33倍になるため)
+                    canvas.toBlob((imageBlob) => {
+                        if (imageBlob) {
+                            resolve(imageBlob);  // 画像データを返す
+                        } else {
+                            reject(new Error("画像のキャプチャに失敗しました"));
+                        }
+                    }, 'image/jpeg');
                 });
             })
             .catch(function (err) {
@@ -1716,16 +1737,106 @@ async function drawNutritionChart(nutrition) {
 //     console.log('cache:\n', cache);
 // });
 
+// 非同期の会計の結果を待つ最大時間(ms)
+const INFERENCE_JOB_TIMEOUT_MS = 120000;
+
+/**
+ * 画像を非同期の会計に送り、結果が届くまで待つ
+ * - サーバーが混雑している(503)場合は、Retry-Afterだけ待ってから送り直す
+ * - Socket.IOで結果が届かない場合は、ポーリングで取りに行く(INFERENCE_JOB_TIMEOUT_MSまで)
+ * @param {Blob} imageBlob JPEG画像
+ * @returns {Promise<Object>} /start_inferenceのレスポンスと同じ形式の結果
+ */
+async function requestInference(imageBlob) {
+    const uuid = document.getElementById('confirm-button').getAttribute('data-uuid');
+    let response;
+    for (let retry = 0; retry < 10; retry++) {
+        response = await fetch(`/start_inference?async=1&room=${encodeURIComponent(uuid)}`, {
+            method: 'POST',
+            headers: { 'Content-Type': imageBlob.type || 'application/octet-stream' },
+            body: imageBlob
+        });
+        if (response.status !== 503) break;
+        const retryAfter = Number(response.headers.get('Retry-After') || 1);
+        document.getElementById('payment-message').innerHTML = '混み合っています。少々お待ちください';
+        await wait(retryAfter * 1000);
+    }
+    const submitted = await response.json();
+    if (response.status !== 202) return submitted; // 同期で結果が返ってきた・エラーの場合
+
+    // ---結果を待つ
+    const jobId = submitted['job_id'];
+    const deadline = Date.now() + INFERENCE_JOB_TIMEOUT_MS;
+    let job = arrivedInferenceResults.get(jobId);
+    arrivedInferenceResults.delete(jobId);
+    while (!job) {
+        job = await Promise.race([
+            new Promise(resolve => pendingInferenceJobs.set(jobId, resolve)),
+            wait(5000).then(() => null),
+        ]);
+        if (!job) {
+            // Socket.IOが切れていても結果を受け取れるように、ポーリングする
+            // ジョブはサーバーのワーカーごとに持っているので、別のワーカーに届くと404になる。その場合は待ち続ける
+            const pollResponse = await fetch(`/inference_jobs/${jobId}`);
+            if (pollResponse.ok) {
+                const polled = await pollResponse.json();
+                if (polled['status'] === 'done' || polled['status'] === 'error') {
+                    job = polled;
+                }
+            }
+            if (!job && Date.now() > deadline) {
+                job = { status: 'error', error: 'timeout' };
+            }
+            if (job) pendingInferenceJobs.delete(jobId);
+        }
+    }
+    if (job['status'] !== 'done') {
+        throw new Error(`推論に失敗しました: ${job['error']}`);
+    }
+    return job['result'];
+}
+
+// ---音声を先読みしておく(会計のときに、すぐに再生できるように)
+// URL -> Audio
+const preloadedVoices = new Map();
+fetch('/voices')
+    .then(response => response.json())
+    .then(voices => {
+        for (const voice of voices) {
+            const audio = new Audio(voice.url);
+            audio.preload = 'auto';
+            preloadedVoices.set(voice.url, audio);
+        }
+    })
+    .catch(err => console.error("音声の先読みに失敗しました: ", err));
+
+// 最後に推論した画像(ログ用APIに送る)
+let lastInferenceImage = null;
+
+/**
+ * Blobを、データURI(Base64)に変換する
+ * @param {Blob} blob
+ * @returns {Promise<string>}
+ */
+function blobToDataURL(blob) {
+    return new Promise((resolve, reject) => {
+        const reader = new FileReader();
+        reader.onload = () => resolve(reader.result);
+        reader.onerror = reject;
+        reader.readAsDataURL(blob);
+    });
+}
+
 /**
  * 指定した画像で、推論を開始する
- * @param {string} base64Image
+ * @param {Blob} imageBlob JPEG画像
  */
-async function startInference(base64Image) {
+async function startInference(imageBlob) {
+    lastInferenceImage = imageBlob;
     // ---画面リセット
     const nutritionChartDiv = document.getElementById('nutrition-chart-div');
     nutritionChartDiv.style.display = 'none';
 
-    const base64 = base64Image.includes(",") ? base64Image.split(",")[1] : base64Image;
     // ---時間を記録する
     const startTime = performance.now();
 
@@ -1734,7 +1845,8 @@ async function startInference(base64Image) {
 
     // ---入力された画像を表示する
     const detectedImageElement = document.getElementById("detected-image");
-    detectedImageElement.src = 'data:image/jpeg;base64,' + base64;
+    URL.revokeObjectURL(detectedImageElement.src);
+    detectedImageElement.src = URL.createObjectURL(imageBlob);
     // 画像の読み込みを待つ
     await new Promise(resolve => detectedImageElement.onload = resolve);
 
@@ -1747,12 +1859,8 @@ async function startInference(base64Image) {
     bboxesDiv.style.display = 'block';
 
     // ---推論を開始する
-    const response = await fetch('/start_inference', {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ image: base64 })
-    });
-    const json = await response.json();
+    // 画像はbase64にせず、そのままバイナリで送る。結果はSocket.IOで届く
+    const json = await requestInference(imageBlob);
 
     // ---検出画像を表示する
     // document.getElementById("detected-image").src = 'data:image/jpeg;base64,' + json['image'];
@@ -1791,9 +1899,12 @@ async function startInference(base64Image) {
     const voiceText = json['voice']["text"];
     document.getElementById('payment-message').innerHTML = voiceText;
 
-    const voiceWav = json['voice']["base64"];
-    const voiceBase64 = `data:audio/wav;base64,${voiceWav}`;
-    const audio = new Audio(voiceBase64);
+    // 音声はURLで返ってくる(先読み・ブラウザのキャッシュから再生する)。古いサーバーの場合はbase64
+    const voiceUrl = json['voice']["url"];
+    const audio = voiceUrl
+        ? (preloadedVoices.get(voiceUrl) || new Audio(voiceUrl))
+        : new Audio(`data:audio/wav;base64,${json['voice']["base64"]}`);
+    audio.currentTime = 0;
     audio.play();
 
 }
@@ -1809,12 +1920,7 @@ debugButton.addEventListener('click', async () => {
     fileInput.click();
     fileInput.addEventListener('change', async () => {
         const file = fileInput.files[0];
-        const reader = new FileReader();
-        reader.readAsDataURL(file);
-        reader.onload = async () => {
-            const base64Image = reader.result;
-            await startInference(base64Image);
-        }
+        await startInference(file);
     });
 
 });
@@ -16,7 +16,8 @@ window.onload = function() {
     }, 2000); // 2秒の遅延 
 };
 
-var socket = io(); // Socket.IOの初期化
+// websocketだけで接続する(複数ワーカーでも、スティッキーセッションなしで動くように)
+var socket = io({ transports: ['websocket'] }); // Socket.IOの初期化
 
 // 会計開始ボタンを押したときの処理
 document.getElementById('start-button').addEventListener('click', function() {
@@ -15,7 +15,6 @@ if platform.system() != 'Windows':
 from models.common import *
 from models.experimental import *
 from utils.general import LOGGER, check_version, check_yaml, make_divisible, print_args
-from utils.plots import feature_visualization
 from utils.torch_utils import (fuse_conv_and_bn, initialize_weights, model_info, profile, scale_img, select_device,
                                time_sync)
 from utils.tal.anchor_generator import make_anchors, dist2bbox
@@ -533,6 +532,8 @@ class BaseModel(nn.Module):
             x = m(x)  # run
             y.append(x if m.i in self.save else None)  # save output
             if visualize:
+                from utils.plots import feature_visualization  # lazy: matplotlib
+
                 feature_visualization(x, m.type, m.i, save_dir=visualize)
         return x
 